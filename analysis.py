@@ -1,23 +1,40 @@
 #!/usr/bin/env python3
 from pathlib import Path
+import pickle
+import subprocess
+import sys
 
+import click
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-sns.set_theme(
-    context="paper", style="whitegrid", font_scale=1.2, rc={"text.usetex": True}
-)
-
-from cryotrack_analysis.insertion_analysis.cryotrack_validation import run_cryotrack_analysis
-from cryotrack_analysis.insertion_analysis.CT_baseline import run_ctbaseline_analysis
-from cryotrack_analysis.video_annotation.extract_bookmarks import extract_bookmarks_from_playlist
+# Publication quality: LaTeX text at 600 dpi. LaTeX is only run once per
+# distinct label; matplotlib caches the rendered glyphs in its tex.cache
+# directory (see matplotlib.get_cachedir()) across runs.
+FINAL_RC = {"text.usetex": True, "savefig.dpi": 600}
+# Draft quality: mathtext at screen resolution, renders within seconds.
+DRAFT_RC = {"text.usetex": False, "savefig.dpi": 100}
+
+sns.set_theme(context="paper", style="whitegrid", font_scale=1.2, rc=FINAL_RC)
+
+from cryotrack_analysis.batch import load_study, export_spreadsheets, study_name
+from cryotrack_analysis.cache import RowCache
+from cryotrack_analysis.facts import MODALITY, fact_table, normalize_key_columns
+from cryotrack_analysis.insertion_analysis.cryotrack_validation import iter_cryotrack_analysis
+from cryotrack_analysis.insertion_analysis.CT_baseline import iter_ctbaseline_analysis
+from cryotrack_analysis.paths import DATA_PATH
+from cryotrack_analysis.results_db import ResultsDB
+from cryotrack_analysis.statistics import run_statistics
+from cryotrack_analysis.streaming import StreamingAggregate, write_parquet_dataset
+from cryotrack_analysis.video_annotation.extract_bookmarks import extract_bookmarks_from_folder
 from cryotrack_analysis.video_annotation.extract_from_mha import read_timestamps_file
 
 
 plot_path = Path("plots")
 plot_path.mkdir(exist_ok=True)
+draft_plot_path = plot_path / "draft"
 
 tables_path = Path("tables")
 tables_path.mkdir(exist_ok=True)
@@ -25,10 +42,46 @@ tables_path.mkdir(exist_ok=True)
 spreadsheets_path = Path("spreadsheets")
 spreadsheets_path.mkdir(exist_ok=True)
 
+# Parquet datasets written in streaming mode
+datasets_path = Path("datasets")
+
+# Per-insertion result rows, see cryotrack_analysis.cache
+cache_path = Path(".cache/rows")
+
+# Results of every run, see cryotrack_analysis.results_db
+results_db_path = Path("results.sqlite")
+
 
 latex_textwidth_LNCS = 347.12354  # in pt
 
 
+def configure_rendering(draft=False):
+    """
+    Switch between draft and final rendering. Draft plots are written to
+    plots/draft/ so that they never overwrite the final figures.
+    """
+    global plot_path
+    sns.set_theme(
+        context="paper",
+        style="whitegrid",
+        font_scale=1.2,
+        rc=DRAFT_RC if draft else FINAL_RC,
+    )
+    plot_path = draft_plot_path if draft else Path("plots")
+    plot_path.mkdir(exist_ok=True)
+
+
+def bold(text):
+    if plt.rcParams["text.usetex"]:
+        return r"\textbf{%s}" % text
+    return r"$\bf{%s}$" % text.replace(" ", r"\ ")
+
+
+def savefig(path, **kwargs):
+    plt.savefig(path, **kwargs)
+    plt.close()
+
+
 def make_plots_accuracy(df_cryotrack, df_ctbaseline):
     figsize = (4.5, 2.6)
 
@@ -58,14 +111,12 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
         palette=my_palette,
     )
     plt.xlabel("Target ID")
-    plt.ylabel(r"\textbf{Euclidean Error [mm]}")
-    plt.title(r"\textbf{With Cryotrack}")
+    plt.ylabel(bold("Euclidean Error [mm]"))
+    plt.title(bold("With Cryotrack"))
     plt.ylim((0, 50))
     plt.xticks([])
     plt.tight_layout()
-    plt.savefig(
-        plot_path / "cryotrack_euclidean_per_target.png", bbox_inches="tight", dpi=600
-    )
+    savefig(plot_path / "cryotrack_euclidean_per_target.png", bbox_inches="tight")
 
     plt.figure(figsize=figsize)
     sns.boxplot(
@@ -76,14 +127,13 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
         palette=my_palette,
     )
     plt.xlabel("Target ID")
-    plt.ylabel(r"\textbf{Distance to Risk [mm]}")
+    plt.ylabel(bold("Distance to Risk [mm]"))
     #plt.title("With Cryotrack")
     plt.ylim((0, 75))
     plt.tight_layout()
-    plt.savefig(
+    savefig(
         plot_path / "cryotrack_riskdistance_per_target.png",
         bbox_inches="tight",
-        dpi=600,
     )
 
     plt.figure(figsize=figsize)
@@ -95,13 +145,11 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
         palette=my_palette,
     )
     plt.xlabel("Target ID")
-    plt.ylabel(r"\textbf{Lateral Error [mm]}")
+    plt.ylabel(bold("Lateral Error [mm]"))
     plt.ylim((0, 50))
     plt.tight_layout()
     plt.xticks([])
-    plt.savefig(
-        plot_path / "cryotrack_lateral_per_target.png", bbox_inches="tight", dpi=600
-    )
+    savefig(plot_path / "cryotrack_lateral_per_target.png", bbox_inches="tight")
     plt.figure(figsize=figsize)
     sns.boxplot(
         data=df,
@@ -111,14 +159,12 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
         palette=my_palette,
     )
     plt.xlabel("")#"Target ID")
-    plt.ylabel(r"\textbf{Distance to Tumor [mm]}")
-    plt.title(r"\textbf{With Cryotrack}")
+    plt.ylabel(bold("Distance to Tumor [mm]"))
+    plt.title(bold("With Cryotrack"))
     plt.ylim((0, 40))
     plt.xticks([])
     plt.tight_layout()
-    plt.savefig(
-        plot_path / "cryotrack_tumor_per_target.png", bbox_inches="tight", dpi=600
-    )
+    savefig(plot_path / "cryotrack_tumor_per_target.png", bbox_inches="tight")
 
     plt.figure(figsize=figsize)
     sns.boxplot(
@@ -129,15 +175,14 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
         palette="Set3",
     )
     plt.xlabel("Target ID")
-    plt.ylabel(r"\textbf{Euclidean Error [mm]}")
-    plt.title(r"\textbf{With Cryotrack}")
+    plt.ylabel(bold("Euclidean Error [mm]"))
+    plt.title(bold("With Cryotrack"))
     plt.ylim((0, 50))
     plt.xticks([])
     plt.tight_layout()
-    plt.savefig(
+    savefig(
         plot_path / "cryotrack_euclidean_per_target_by_plane.png",
         bbox_inches="tight",
-        dpi=600,
     )
 
     plt.figure(figsize=figsize)
@@ -149,13 +194,12 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
         palette="Set3",
     )
     plt.xlabel("Target ID")
-    plt.ylabel(r"\textbf{Lateral Error [mm]}")
+    plt.ylabel(bold("Lateral Error [mm]"))
     plt.ylim((0, 50))
     plt.tight_layout()
-    plt.savefig(
+    savefig(
         plot_path / "cryotrack_lateral_per_target_by_plane.png",
         bbox_inches="tight",
-        dpi=600,
     )
 
     #### CT baseline ####
@@ -175,12 +219,10 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
     )
     plt.xlabel("Target ID")
     plt.ylabel("")  # r"\textbf{Euclidean Error [mm]}")
-    plt.title(r"\textbf{Without Cryotrack}")
+    plt.title(bold("Without Cryotrack"))
     plt.ylim((0, 50))
     plt.tight_layout()
-    plt.savefig(
-        plot_path / "ctbaseline_euclidean_per_target.png", bbox_inches="tight", dpi=600
-    )
+    savefig(plot_path / "ctbaseline_euclidean_per_target.png", bbox_inches="tight")
     plt.figure(figsize=figsize)
     sns.boxplot(
         data=df,
@@ -194,10 +236,9 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
     #plt.title("Without Cryotrack")
     plt.ylim((0, 75))
     plt.tight_layout()
-    plt.savefig(
+    savefig(
         plot_path / "ctbaseline_riskdistance_per_target.png",
         bbox_inches="tight",
-        dpi=600,
     )
     ## Lateral
     plt.figure(figsize=figsize)
@@ -208,9 +249,7 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
     plt.ylabel("")  # r"\textbf{Lateral Error [mm]}")
     plt.ylim((0, 50))
     plt.tight_layout()
-    plt.savefig(
-        plot_path / "ctbaseline_lateral_per_target.png", bbox_inches="tight", dpi=600
-    )
+    savefig(plot_path / "ctbaseline_lateral_per_target.png", bbox_inches="tight")
     ## Tumor distance
     plt.figure(figsize=figsize)
     sns.boxplot(
@@ -222,13 +261,11 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
     )
     plt.xlabel("")#Target ID")
     plt.ylabel("")  # r"\textbf{Euclidean Error [mm]}")
-    plt.title(r"\textbf{Without Cryotrack}")
+    plt.title(bold("Without Cryotrack"))
     plt.ylim((0, 40))
     plt.xticks([])
     plt.tight_layout()
-    plt.savefig(
-        plot_path / "ctbaseline_tumor_per_target.png", bbox_inches="tight", dpi=600
-    )
+    savefig(plot_path / "ctbaseline_tumor_per_target.png", bbox_inches="tight")
 
     ### Per target, grouped by plane
     ## Euclidean
@@ -242,13 +279,12 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
     )
     plt.xlabel("Target ID")
     plt.ylabel("")  # r"\textbf{Euclidean Error [mm]}")
-    plt.title(r"\textbf{Without Cryotrack}")
+    plt.title(bold("Without Cryotrack"))
     plt.ylim((0, 50))
     plt.tight_layout()
-    plt.savefig(
+    savefig(
         plot_path / "ctbaseline_euclidean_per_target_by_plane.png",
         bbox_inches="tight",
-        dpi=600,
     )
     ## Lateral
     plt.figure(figsize=figsize)
@@ -259,10 +295,9 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
     plt.ylabel("")  # r"\textbf{Lateral Error [mm]}")
     plt.ylim((0, 50))
     plt.tight_layout()
-    plt.savefig(
+    savefig(
         plot_path / "ctbaseline_lateral_per_target_by_plane.png",
         bbox_inches="tight",
-        dpi=600,
     )
 
     ### Per target, grouped by strokes (ss / sw)
@@ -277,13 +312,12 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
     )
     plt.xlabel("Target ID")
     plt.ylabel("")  # r"\textbf{Euclidean Error [mm]}")
-    plt.title(r"\textbf{Without Cryotrack}")
+    plt.title(bold("Without Cryotrack"))
     plt.ylim((0, 50))
     plt.tight_layout()
-    plt.savefig(
+    savefig(
         plot_path / "ctbaseline_euclidean_per_target_by_strokes.png",
         bbox_inches="tight",
-        dpi=600,
     )
     ## Lateral
     plt.figure(figsize=figsize)
@@ -294,10 +328,9 @@ def make_plots_accuracy(df_cryotrack, df_ctbaseline):
     plt.ylabel("")  # r"\textbf{Lateral Error [mm]}")
     plt.ylim((0, 50))
     plt.tight_layout()
-    plt.savefig(
+    savefig(
         plot_path / "ctbaseline_lateral_per_target_by_strokes.png",
         bbox_inches="tight",
-        dpi=600,
     )
 
 
@@ -307,34 +340,31 @@ def make_plots_time(df_cryotrack_time, df_ctbaseline_time):
     plt.figure(figsize=figsize)
     sns.boxplot(data=df, x="target_index", y="planning time [s]", palette="Blues")
     plt.xlabel("Target ID")
-    plt.ylabel(r"\textbf{Planning time [s]}")
+    plt.ylabel(bold("Planning time [s]"))
     sns.despine()
     plt.ylim((0, 750))
     plt.tight_layout()
-    plt.savefig(plot_path / "cryotrack_planning_time_per_target.png", dpi=600)
+    savefig(plot_path / "cryotrack_planning_time_per_target.png")
 
     plt.figure(figsize=figsize)
     sns.boxplot(data=df, x="target_index", y="insertion time [s]", palette="Blues")
     plt.xlabel("Target ID")
-    plt.ylabel(r"\textbf{Insertion time [s]}")
+    plt.ylabel(bold("Insertion time [s]"))
     sns.despine()
     plt.ylim((0, 750))
     plt.tight_layout()
-    plt.savefig(
+    savefig(
         plot_path / "cryotrack_insertion_time_per_target.png",
         bbox_inches="tight",
-        dpi=600,
     )
     plt.figure(figsize=figsize)
     sns.boxplot(data=df, x="target_index", y="total time [s]", palette="Blues")
     plt.xlabel("Target ID")
-    plt.ylabel(r"\textbf{Total time [s]}")
+    plt.ylabel(bold("Total time [s]"))
     plt.ylim((0, 750))
-    plt.title(r"\textbf{With Cryotrack}")
+    plt.title(bold("With Cryotrack"))
     plt.tight_layout()
-    plt.savefig(
-        plot_path / "cryotrack_duration_per_target.png", bbox_inches="tight", dpi=600
-    )
+    savefig(plot_path / "cryotrack_duration_per_target.png", bbox_inches="tight")
 
     ##### CT BASELINE #####
     df = df_ctbaseline_time
@@ -342,12 +372,10 @@ def make_plots_time(df_cryotrack_time, df_ctbaseline_time):
     sns.boxplot(data=df, x="target_index", y="duration", palette="Blues")
     plt.xlabel("Target ID")
     plt.ylabel("")
-    plt.title(r"\textbf{Without Cryotrack}")
+    plt.title(bold("Without Cryotrack"))
     plt.ylim((0, 750))
     plt.tight_layout()
-    plt.savefig(
-        plot_path / "ctbaseline_duration_per_target.png", bbox_inches="tight", dpi=600
-    )
+    savefig(plot_path / "ctbaseline_duration_per_target.png", bbox_inches="tight")
 
 
 def make_plots(df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack):
@@ -355,106 +383,517 @@ def make_plots(df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrac
     make_plots_accuracy(df_cryotrack, df_ctbaseline)
 
 
-def export_tables(df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack):
-    d = {
-        "Operator": [],
-        "Plane": [],
-        "Strokes": [],
-        "Tumor distance [mm]": [],
-        "Risk distance [mm]": [],
-        "Total time [s]": []
-    }
+OPERATOR_ALIASES = {"JV": "S", "JM": "N1", "HK": "N2"}
 
-    for operator in ("S", "N1", "N2"):
-        for plane in ("ip", "oop"):
-            df_sub = df_cryotrack_time.replace("JV", "S")
-            df_sub = df_sub.replace("JM", "N1")
-            df_sub = df_sub.replace("HK", "N2")
-            df_sub = df_sub[df_sub["Operator"] == operator]
-            df_sub = df_sub[df_sub["Plane"] == plane]
-            t_total = df_sub["total time [s]"].mean()
-
-            p = plane if plane != "oop" else "op"
-            df_sub = df_cryotrack.replace("JV", "S")
-            df_sub = df_sub.replace("JM", "N1")
-            df_sub = df_sub.replace("HK", "N2")
-            df_sub = df_sub[df_sub["Operator"] == operator]
-            df_sub = df_sub[df_sub["Plane"] == p]
-            tip_to_tumor = df_sub["Euclidean (tip to tumor)"].mean()
-            d_risk = df_sub["D_risk_min"].mean()
-
-            d["Operator"].append(operator)
-            d["Plane"].append(plane.upper())
-            d["Strokes"].append(1)
-            d["Tumor distance [mm]"].append(tip_to_tumor)
-            d["Risk distance [mm]"].append(d_risk)
-            d["Total time [s]"].append(t_total)
-    
-    df = pd.DataFrame(d)
-    df = df.sort_values(by="Operator")
-    print(df[["Tumor distance [mm]", "Risk distance [mm]", "Total time [s]"]].mean())
 
-    styler = df.style.format(precision=2).hide(axis="index")
-    styler.to_latex(tables_path / "cryotrack.tex")
+def lookup(means, key, column):
+    if column not in means:
+        return np.nan
+    return means[column].get(key, np.nan)
+
+
+# Group means in the LaTeX tables
+SUMMARY_BY = [MODALITY, "Operator", "Plane", "Strokes"]
+SUMMARY_COLUMNS = ["Euclidean (tip to tumor)", "D_risk_min", "Tip in tumor", "time [s]"]
+PLANE_LABELS = {"ip": "IP", "op": "OOP"}
+
+
+def summary_rows(df, modality, operator=None):
+    """
+    Rows with normalised keys for the summary means; cryotrack operators are
+    anonymised.
+    """
+    df = normalize_key_columns(df, operator)
+    df[MODALITY] = modality
+    if modality == "with":
+        df["Operator"] = df["Operator"].replace(OPERATOR_ALIASES)
+    return df
+
+
+def summary_means(df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack):
+    """
+    Group means needed for the LaTeX tables, computed in a single pass over
+    the per-insertion fact table.
+    """
+    facts = fact_table(
+        df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack
+    ).reset_index()
+    with_cryotrack = facts[MODALITY] == "with"
+    facts.loc[with_cryotrack, "Operator"] = facts.loc[with_cryotrack, "Operator"].replace(
+        OPERATOR_ALIASES
+    )
+    facts[SUMMARY_COLUMNS] = facts[SUMMARY_COLUMNS].astype(float)
+    return facts.groupby(SUMMARY_BY)[SUMMARY_COLUMNS].mean()
 
+
+def summary_table(means, modality, rows):
     d = {
         "Operator": [],
         "Plane": [],
         "Strokes": [],
         "Tumor distance [mm]": [],
         "Risk distance [mm]": [],
+        "Hit rate [%]": [],
         "Total time [s]": []
     }
+    for operator, plane, strokes in rows:
+        key = (modality, operator, plane, strokes)
+        d["Operator"].append(operator)
+        d["Plane"].append(PLANE_LABELS[plane])
+        d["Strokes"].append(1 if strokes == "ss" else 3)
+        d["Tumor distance [mm]"].append(lookup(means, key, "Euclidean (tip to tumor)"))
+        d["Risk distance [mm]"].append(lookup(means, key, "D_risk_min"))
+        d["Hit rate [%]"].append(100 * lookup(means, key, "Tip in tumor"))
+        d["Total time [s]"].append(lookup(means, key, "time [s]"))
+    return pd.DataFrame(d)
+
+
+def write_tables(means):
+    columns = ["Tumor distance [mm]", "Risk distance [mm]", "Hit rate [%]", "Total time [s]"]
+
+    rows = [(operator, plane, "ss") for operator in ("S", "N1", "N2") for plane in ("ip", "op")]
+    df = summary_table(means, "with", rows)
+    df = df.sort_values(by="Operator")
+    print(df[columns].mean())
+    styler = df.style.format(precision=2).hide(axis="index")
+    styler.to_latex(tables_path / "cryotrack.tex")
 
-    for Strokes in set(df_ctbaseline.Strokes):
-        for plane in ("IP", "OoP"):
-            df_sub = df_ctbaseline_time
-            df_sub = df_sub[df_sub["Plane"] == plane]
-            df_sub = df_sub[df_sub["Strokes"] == Strokes]
-            t_total = df_sub["duration"].mean()
-
-            p = plane.lower() if plane != "OoP" else "op"
-            df_sub = df_ctbaseline
-            df_sub = df_sub[df_sub["Plane"] == p]
-            df_sub = df_sub[df_sub["Strokes"] == Strokes]
-            tip_to_tumor = df_sub["Euclidean (tip to tumor)"].mean()
-            d_risk = df_sub["D_risk_min"].mean()
-
-            d["Operator"].append("JV")
-            d["Plane"].append(plane.upper())
-            d["Strokes"].append(1 if Strokes == "ss" else 3)
-            d["Tumor distance [mm]"].append(tip_to_tumor)
-            d["Risk distance [mm]"].append(d_risk)
-            d["Total time [s]"].append(t_total)
-    
-    df = pd.DataFrame(d)
+    strokes = sorted(set(means.loc["without"].index.get_level_values("Strokes")))
+    rows = [("JV", plane, s) for s in strokes for plane in ("ip", "op")]
+    df = summary_table(means, "without", rows)
     df = df.sort_values(by="Strokes")
-    print(df[["Tumor distance [mm]", "Risk distance [mm]", "Total time [s]"]].std())
+    print(df[columns].std())
     styler = df.style.format(precision=2).hide(axis="index")
     styler.to_latex(tables_path / "ctbaseline.tex")
 
 
-
-def run_all_analyses():
-    video_dfs = []
-    for path in Path("data/cryotrack_validation/video_bookmarks").glob("*.xspf"):
-        dfs = extract_bookmarks_from_playlist(path, exclude_invalid=True)
-        video_dfs.extend(dfs)
-    # These are the three dataframes to analyze:
-    df_cryotrack_time = pd.concat(video_dfs)
-    df_ctbaseline_time = read_timestamps_file("timestamps.json")
-    df_ctbaseline = run_ctbaseline_analysis()
-    df_cryotrack = run_cryotrack_analysis()
+def export_tables(df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack):
+    means = summary_means(df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack)
+    write_tables(means)
+    return means
+
+
+# Streaming mode: (aggregate, y, file name, y label, y limits, title)
+STREAMING_PLOTS = [
+    (
+        "cryotrack_by_operator",
+        "Euclidean Error (final)",
+        "cryotrack_euclidean_per_target.png",
+        "Euclidean Error [mm]",
+        (0, 50),
+        "With Cryotrack",
+    ),
+    (
+        "cryotrack_by_operator",
+        "D_risk_min",
+        "cryotrack_riskdistance_per_target.png",
+        "Distance to Risk [mm]",
+        (0, 75),
+        None,
+    ),
+    (
+        "cryotrack_by_operator",
+        "Lateral Error (final)",
+        "cryotrack_lateral_per_target.png",
+        "Lateral Error [mm]",
+        (0, 50),
+        None,
+    ),
+    (
+        "cryotrack_by_operator",
+        "Euclidean (tip to tumor)",
+        "cryotrack_tumor_per_target.png",
+        "Distance to Tumor [mm]",
+        (0, 40),
+        "With Cryotrack",
+    ),
+    (
+        "cryotrack_by_plane",
+        "Euclidean Error (final)",
+        "cryotrack_euclidean_per_target_by_plane.png",
+        "Euclidean Error [mm]",
+        (0, 50),
+        "With Cryotrack",
+    ),
+    (
+        "cryotrack_by_plane",
+        "Lateral Error (final)",
+        "cryotrack_lateral_per_target_by_plane.png",
+        "Lateral Error [mm]",
+        (0, 50),
+        None,
+    ),
+    (
+        "ctbaseline_by_operator",
+        "Euclidean Error (final)",
+        "ctbaseline_euclidean_per_target.png",
+        "",
+        (0, 50),
+        "Without Cryotrack",
+    ),
+    (
+        "ctbaseline_by_operator",
+        "D_risk_min",
+        "ctbaseline_riskdistance_per_target.png",
+        "",
+        (0, 75),
+        None,
+    ),
+    (
+        "ctbaseline_by_operator",
+        "Lateral Error",
+        "ctbaseline_lateral_per_target.png",
+        "",
+        (0, 50),
+        None,
+    ),
+    (
+        "ctbaseline_by_operator",
+        "Euclidean (tip to tumor)",
+        "ctbaseline_tumor_per_target.png",
+        "",
+        (0, 40),
+        "Without Cryotrack",
+    ),
+    (
+        "ctbaseline_by_plane",
+        "Euclidean Error (final)",
+        "ctbaseline_euclidean_per_target_by_plane.png",
+        "",
+        (0, 50),
+        "Without Cryotrack",
+    ),
+    (
+        "ctbaseline_by_plane",
+        "Lateral Error",
+        "ctbaseline_lateral_per_target_by_plane.png",
+        "",
+        (0, 50),
+        None,
+    ),
+    (
+        "ctbaseline_by_strokes",
+        "Euclidean Error (final)",
+        "ctbaseline_euclidean_per_target_by_strokes.png",
+        "",
+        (0, 50),
+        "Without Cryotrack",
+    ),
+    (
+        "ctbaseline_by_strokes",
+        "Lateral Error",
+        "ctbaseline_lateral_per_target_by_strokes.png",
+        "",
+        (0, 50),
+        None,
+    ),
+    (
+        "cryotrack_time_by_target",
+        "planning time [s]",
+        "cryotrack_planning_time_per_target.png",
+        "Planning time [s]",
+        (0, 750),
+        None,
+    ),
+    (
+        "cryotrack_time_by_target",
+        "insertion time [s]",
+        "cryotrack_insertion_time_per_target.png",
+        "Insertion time [s]",
+        (0, 750),
+        None,
+    ),
+    (
+        "cryotrack_time_by_target",
+        "total time [s]",
+        "cryotrack_duration_per_target.png",
+        "Total time [s]",
+        (0, 750),
+        "With Cryotrack",
+    ),
+    (
+        "ctbaseline_time_by_target",
+        "duration",
+        "ctbaseline_duration_per_target.png",
+        "",
+        (0, 750),
+        "Without Cryotrack",
+    ),
+]
+
+
+def export_statistics(tables, n_permutations=10000, jobs=None):
+    df = run_statistics(tables, n_permutations, jobs=jobs)
+    print(df[["dataset", "grouping", "metric", "effect_size", "p_value"]])
+    df.to_excel(spreadsheets_path / "statistics.xlsx")
+    styler = df.style.format(precision=3).hide(axis="index")
+    styler.to_latex(tables_path / "statistics.tex")
+    return df
+
+
+def streaming_aggregates():
+    tumor_and_risk = ["Euclidean (tip to tumor)", "D_risk_min"]
+    accuracy_cryotrack = ["Euclidean Error (final)", "Lateral Error (final)"] + tumor_and_risk
+    accuracy_ctbaseline = ["Euclidean Error (final)", "Lateral Error"] + tumor_and_risk
+    return dict(
+        summary=StreamingAggregate(SUMMARY_BY, SUMMARY_COLUMNS),
+        cryotrack_by_operator=StreamingAggregate(
+            ["target_index", "Operator"], accuracy_cryotrack
+        ),
+        cryotrack_by_plane=StreamingAggregate(["target_index", "Plane"], accuracy_cryotrack),
+        ctbaseline_by_operator=StreamingAggregate(
+            ["target_index", "Operator"], accuracy_ctbaseline
+        ),
+        ctbaseline_by_plane=StreamingAggregate(["target_index", "Plane"], accuracy_ctbaseline),
+        ctbaseline_by_strokes=StreamingAggregate(
+            ["target_index", "Strokes"], accuracy_ctbaseline
+        ),
+        cryotrack_time_by_target=StreamingAggregate(
+            ["target_index"], ["planning time [s]", "insertion time [s]", "total time [s]"]
+        ),
+        ctbaseline_time_by_target=StreamingAggregate(["target_index"], ["duration"]),
+    )
+
+
+def summary_boxplot(aggregate, y, palette="Set3"):
+    """
+    Grouped boxplot in the style of sns.boxplot(x=by[0], hue=by[1]), drawn
+    from the boxplot statistics of a StreamingAggregate.
+    """
+    keys = [key for key in aggregate.groups() if (key, y) in aggregate.stats]
+    xs = sorted({key[0] for key in keys})
+    if len(aggregate.by) > 1:
+        # S, N1, N2 rather than N1, N2, S
+        hues = sorted({key[1] for key in keys}, key=lambda h: (len(str(h)), str(h)))
+    else:
+        hues = [None]
+    colors = sns.color_palette(palette, len(hues))
+    width = 0.8 / len(hues)
+    ax = plt.gca()
+    for j, hue in enumerate(hues):
+        stats, positions = [], []
+        for i, x in enumerate(xs):
+            key = (x, hue) if hue is not None else (x,)
+            if (key, y) not in aggregate.stats:
+                continue
+            stats.append(aggregate.boxplot_stats(key, y))
+            positions.append(i - 0.4 + width * (j + 0.5))
+        if not stats:
+            continue
+        ax.bxp(
+            stats,
+            positions=positions,
+            widths=0.8 * width,
+            patch_artist=True,
+            boxprops=dict(facecolor=colors[j]),
+            medianprops=dict(color="0.3"),
+            label=str(hue),
+        )
+    ax.set_xticks(range(len(xs)), [str(x) for x in xs])
+    ax.set_xlim(-0.5, len(xs) - 0.5)
+    if hues != [None]:
+        ax.legend(title=aggregate.by[1])
+
+
+def make_plots_streaming(aggregates):
+    for name, y, filename, ylabel, ylim, title in STREAMING_PLOTS:
+        aggregate = aggregates[name]
+        if not aggregate.stats:
+            continue
+        plt.figure(figsize=(4.5, 2.6) if name.startswith("cryotrack") else (3.0, 2.6))
+        summary_boxplot(aggregate, y)
+        plt.xlabel("Target ID")
+        plt.ylabel(bold(ylabel) if ylabel else "")
+        if title:
+            plt.title(bold(title))
+        plt.ylim(ylim)
+        plt.tight_layout()
+        savefig(plot_path / filename, bbox_inches="tight")
+
+
+def run_streaming_analyses(data_path=DATA_PATH, chunk_size=64, cache=None, jobs=1, db=None):
+    """
+    Bounded memory variant of run_all_analyses: insertions are evaluated in
+    chunks of chunk_size, every chunk is appended to a Parquet dataset in
+    datasets/ and folded into streaming aggregates, from which tables and
+    plots are produced. No complete result frame is ever held in memory, so
+    only the summary means are recorded in the results database db.
+    """
+    data_path = Path(data_path)
+    aggregates = streaming_aggregates()
+
+    cryotrack_time = extract_bookmarks_from_folder(
+        data_path / "cryotrack_validation/video_bookmarks", exclude_invalid=True
+    )
+    write_parquet_dataset(
+        [cryotrack_time],
+        datasets_path / "cryotrack_time",
+        [aggregates["cryotrack_time_by_target"]],
+    )
+    aggregates["summary"].update(summary_rows(cryotrack_time, "with"))
+    del cryotrack_time
+
+    ctbaseline_time = read_timestamps_file(
+        "timestamps.json", data_path=data_path / "CT_baseline"
+    )
+    write_parquet_dataset(
+        [ctbaseline_time],
+        datasets_path / "ctbaseline_time",
+        [aggregates["ctbaseline_time_by_target"]],
+    )
+    aggregates["summary"].update(summary_rows(ctbaseline_time, "without"))
+    del ctbaseline_time
+
+    def ctbaseline_chunks():
+        for chunk in iter_ctbaseline_analysis(data_path, chunk_size, cache=cache, jobs=jobs):
+            aggregates["summary"].update(summary_rows(chunk, "without"))
+            renamed = chunk.replace(OPERATOR_ALIASES)
+            aggregates["ctbaseline_by_operator"].update(renamed)
+            aggregates["ctbaseline_by_plane"].update(renamed)
+            aggregates["ctbaseline_by_strokes"].update(renamed)
+            yield chunk
+
+    write_parquet_dataset(ctbaseline_chunks(), datasets_path / "ctbaseline")
+
+    def cryotrack_chunks():
+        for chunk in iter_cryotrack_analysis(data_path, chunk_size, cache=cache, jobs=jobs):
+            aggregates["summary"].update(summary_rows(chunk, "with"))
+            renamed = chunk.replace(OPERATOR_ALIASES)
+            # exclude JN; only performed 1 or 2 insertions
+            renamed = renamed[chunk["Operator"] != "JN"]
+            aggregates["cryotrack_by_operator"].update(renamed)
+            aggregates["cryotrack_by_plane"].update(renamed)
+            yield chunk
+
+    write_parquet_dataset(cryotrack_chunks(), datasets_path / "cryotrack")
+
+    with open(datasets_path / "aggregates.pkl", "wb") as f:
+        pickle.dump(aggregates, f)
+
+    means = aggregates["summary"].mean()
+    write_tables(means)
+    if db is not None:
+        run_id = db.record_run(
+            study_name(data_path), data_path, {}, summaries=means.reset_index(), options=dict(streaming=True)
+        )
+        print(f"Recorded run {run_id} in {db.path}")
+    make_plots_streaming(aggregates)
+
+
+def load_spreadsheets():
+    tables = {}
+    for name in ("cryotrack_time", "ctbaseline_time", "ctbaseline", "cryotrack"):
+        tables[name] = pd.read_excel(spreadsheets_path / f"{name}.xlsx", index_col=0)
+    return tables
+
+
+def load_aggregates():
+    with open(datasets_path / "aggregates.pkl", "rb") as f:
+        return pickle.load(f)
+
+
+def render_final_in_background(streaming=False):
+    """
+    Re-render all plots at publication quality in a detached process, which
+    reads the spreadsheets (or, in streaming mode, the aggregates) that were
+    just exported.
+    """
+    args = ["--render-only"] + (["--streaming"] if streaming else [])
+    return subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve())] + args,
+        stdout=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def run_all_analyses(data_path=DATA_PATH, n_permutations=10000, cache=None, jobs=1, db=None):
+    # These are the four dataframes to analyze:
+    tables = load_study(data_path, cache, jobs)
+    df_cryotrack_time = tables["cryotrack_time"]
+    df_ctbaseline_time = tables["ctbaseline_time"]
+    df_ctbaseline = tables["ctbaseline"]
+    df_cryotrack = tables["cryotrack"]
 
     # Export spreadsheets
-    df_cryotrack_time.to_excel(spreadsheets_path / "cryotrack_time.xlsx")
-    df_ctbaseline_time.to_excel(spreadsheets_path / "ctbaseline_time.xlsx")
-    df_ctbaseline.to_excel(spreadsheets_path / "ctbaseline.xlsx")
-    df_cryotrack.to_excel(spreadsheets_path / "cryotrack.xlsx")
-
-    export_tables(df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack)
+    export_spreadsheets(tables, spreadsheets_path)
+
+    means = export_tables(df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack)
+    statistics = export_statistics(tables, n_permutations, jobs=jobs) if n_permutations else None
+    if db is not None:
+        run_id = db.record_run(
+            study_name(data_path),
+            data_path,
+            tables,
+            summaries=means.reset_index(),
+            statistics=statistics,
+            options=dict(permutations=n_permutations),
+        )
+        print(f"Recorded run {run_id} in {db.path}")
     make_plots(df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack)
 
 
+@click.command()
+@click.option("--draft", is_flag=True, help="Render quick low resolution plots without LaTeX to plots/draft/.")
+@click.option("--no-final", is_flag=True, help="In draft mode, skip the background publication quality render.")
+@click.option("--render-only", is_flag=True, help="Only render plots from previously exported spreadsheets.")
+@click.option(
+    "--streaming",
+    is_flag=True,
+    help="Evaluate insertions in chunks and stream results to Parquet datasets in datasets/.",
+)
+@click.option("--chunk-size", default=64, show_default=True, help="Number of insertions per chunk in streaming mode.")
+@click.option(
+    "--permutations",
+    default=10000,
+    show_default=True,
+    help="Number of permutations for the statistical tests (0 to skip).",
+)
+@click.option("--no-cache", is_flag=True, help="Re-evaluate all insertions instead of reusing cached rows from .cache/.")
+@click.option("--cache-size", default=64, show_default=True, help="Maximum size of the row cache in MiB.")
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    show_default=True,
+    help="Number of worker processes evaluating insertions (0 for one per core).",
+)
+@click.option(
+    "--db",
+    "db_path",
+    default=str(results_db_path),
+    show_default=True,
+    type=click.Path(dir_okay=False),
+    help="SQLite database the results of this run are appended to.",
+)
+@click.option("--no-db", is_flag=True, help="Do not record the results of this run.")
+def main(draft, no_final, render_only, streaming, chunk_size, permutations, no_cache, cache_size, jobs, db_path, no_db):
+    configure_rendering(draft)
+    if render_only and streaming:
+        make_plots_streaming(load_aggregates())
+        return
+    if render_only:
+        tables = load_spreadsheets()
+        make_plots(
+            tables["cryotrack_time"],
+            tables["ctbaseline_time"],
+            tables["ctbaseline"],
+            tables["cryotrack"],
+        )
+        return
+    cache = None if no_cache else RowCache(cache_path, max_bytes=cache_size * 2**20)
+    db = None if no_db else ResultsDB(db_path)
+    if streaming:
+        run_streaming_analyses(chunk_size=chunk_size, cache=cache, jobs=jobs or None, db=db)
+    else:
+        run_all_analyses(n_permutations=permutations, cache=cache, jobs=jobs or None, db=db)
+    if db is not None:
+        db.close()
+    if cache is not None:
+        print(cache)
+    if draft and not no_final:
+        process = render_final_in_background(streaming)
+        print(f"Rendering final plots in background (pid {process.pid})")
+
+
 if __name__ == "__main__":
-    run_all_analyses()
+    main()
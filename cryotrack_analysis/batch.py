@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import click
+import pandas as pd
+
+from .insertion_analysis.cryotrack_validation import run_cryotrack_analysis
+from .insertion_analysis.CT_baseline import run_ctbaseline_analysis
+from .results_db import ResultsDB
+from .video_annotation.extract_bookmarks import extract_bookmarks_from_folder
+from .video_annotation.extract_from_mha import read_timestamps_file
+
+# Result tables of a single study, in the order they are exported.
+TABLES = ("cryotrack_time", "ctbaseline_time", "ctbaseline", "cryotrack")
+
+
+def load_study(data_path, cache=None, jobs=1) -> Dict[str, pd.DataFrame]:
+    """
+    Run all analyses of a single study root. A study root has the same layout
+    as data/, i.e. a cryotrack_validation/ and/or a CT_baseline/ directory.
+    Tables whose inputs are missing in the study are left out. With a
+    RowCache, only new or changed insertions are evaluated; jobs is the number
+    of worker processes evaluating them.
+    """
+    data_path = Path(data_path)
+    tables = {}
+    cryotrack_path = data_path / "cryotrack_validation"
+    ctbaseline_path = data_path / "CT_baseline"
+    if (cryotrack_path / "video_bookmarks").is_dir():
+        tables["cryotrack_time"] = extract_bookmarks_from_folder(
+            cryotrack_path / "video_bookmarks", exclude_invalid=True
+        )
+    if (ctbaseline_path / "timestamps.json").is_file():
+        tables["ctbaseline_time"] = read_timestamps_file(
+            "timestamps.json", data_path=ctbaseline_path
+        )
+    if ctbaseline_path.is_dir():
+        tables["ctbaseline"] = run_ctbaseline_analysis(data_path, cache=cache, jobs=jobs)
+    if cryotrack_path.is_dir():
+        tables["cryotrack"] = run_cryotrack_analysis(data_path, cache=cache, jobs=jobs)
+    return tables
+
+
+def export_spreadsheets(tables: Dict[str, pd.DataFrame], output_path):
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    for name, df in tables.items():
+        df.to_excel(output_path / f"{name}.xlsx")
+
+
+def analyze_study(data_path, output_path) -> Dict[str, pd.DataFrame]:
+    """
+    Worker entry point: analyze one study and write its spreadsheets to
+    output_path/<study>/.
+    """
+    tables = load_study(data_path)
+    export_spreadsheets(tables, Path(output_path) / study_name(data_path))
+    return tables
+
+
+def study_name(data_path) -> str:
+    return Path(data_path).resolve().name
+
+
+def combine_studies(results: Dict[str, Dict[str, pd.DataFrame]]) -> Dict[str, pd.DataFrame]:
+    """
+    Concatenate the per-study tables into cross-study tables with a leading
+    "study" column.
+    """
+    combined = {}
+    for name in TABLES:
+        dfs = []
+        for study, tables in results.items():
+            if name not in tables:
+                continue
+            df = tables[name].copy()
+            df.insert(0, "study", study)
+            dfs.append(df)
+        if dfs:
+            combined[name] = pd.concat(dfs, ignore_index=True)
+    return combined
+
+
+def run_batch(study_paths: List, output_path="spreadsheets", jobs=None, db_path=None) -> Dict[str, pd.DataFrame]:
+    """
+    Analyze every study root in its own worker process (at most `jobs` at a
+    time, defaulting to the number of cores) and export per-study as well as
+    combined spreadsheets. Results are combined in the order of study_paths.
+    With db_path, the tables of every study are appended to that results
+    database as one run each (written from this process only).
+    """
+    names = [study_name(p) for p in study_paths]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise Exception(f"Study names must be unique, got duplicates {sorted(duplicates)}")
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(analyze_study, path, output_path) for path in study_paths
+        ]
+        results = {name: future.result() for name, future in zip(names, futures)}
+
+    if db_path is not None:
+        with ResultsDB(db_path) as db:
+            for path, (name, tables) in zip(study_paths, results.items()):
+                run_id = db.record_run(name, path, tables, options=dict(batch=True))
+                print(f"Recorded {name} as run {run_id} in {db.path}")
+
+    combined = combine_studies(results)
+    export_spreadsheets(combined, Path(output_path) / "combined")
+    return combined
+
+
+@click.command()
+@click.argument("study_paths", nargs=-1, required=True, type=click.Path(exists=True, file_okay=False))
+@click.option("--output", "output_path", default="spreadsheets", show_default=True, type=click.Path(file_okay=False))
+@click.option("--jobs", "-j", default=None, type=int, help="Number of worker processes [default: number of cores]")
+@click.option(
+    "--db", "db_path", default=None, type=click.Path(dir_okay=False), help="SQLite database to append the results to"
+)
+def main(study_paths, output_path, jobs, db_path):
+    run_batch(study_paths, output_path, jobs, db_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+# Bump when the evaluation changes, so that stale rows are not reused.
+CACHE_VERSION = "3"
+
+
+def file_hash(path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def model_hashes(model_path) -> Dict[str, str]:
+    """
+    Content hash of every mesh in a models directory, by file stem.
+    """
+    return {p.stem: file_hash(p) for p in sorted(Path(model_path).glob("*.vtk"))}
+
+
+def cache_key(*parts) -> str:
+    """
+    Key of a result row from everything it depends on: strings, numbers and
+    arrays (hashed by value).
+    """
+    h = hashlib.sha256(CACHE_VERSION.encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part, dtype=float).tobytes()
+        elif not isinstance(part, bytes):
+            part = repr(part).encode()
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
+class RowCache:
+    """
+    On-disk cache of result rows (one pickle file per row) with LRU eviction:
+    every hit refreshes the file's modification time, and when the cache
+    grows beyond max_bytes the least recently used rows are deleted.
+    """
+
+    def __init__(self, path, max_bytes=64 * 2**20):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _file(self, key):
+        return self.path / f"{key}.pkl"
+
+    def get(self, key):
+        path = self._file(key)
+        try:
+            with open(path, "rb") as f:
+                row = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return row
+
+    def put(self, key, row):
+        # write to a temporary file first, so that a crash never leaves a
+        # truncated row behind
+        path = self._file(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(row, f)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        files = [(p.stat().st_mtime_ns, p.stat().st_size, p) for p in self.path.glob("*.pkl")]
+        size = sum(s for _, s, _ in files)
+        for _, s, p in sorted(files, key=lambda f: f[0]):
+            if size <= self.max_bytes:
+                break
+            p.unlink()
+            size -= s
+            self.evictions += 1
+
+    def clear(self):
+        for p in self.path.glob("*.pkl"):
+            p.unlink()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def __str__(self):
+        return f"Row cache {self.path}: {self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
+
+def memoized_rows(items: List, keys: List[str], evaluate: Callable, cache: RowCache) -> pd.DataFrame:
+    """
+    Rows for all items, taking cached rows where available and calling
+    evaluate(items) -> DataFrame only for the missing ones.
+    """
+    rows = [cache.get(key) for key in keys]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        computed = evaluate([items[i] for i in missing]).to_dict("records")
+        for i, row in zip(missing, computed):
+            cache.put(keys[i], row)
+            rows[i] = row
+        cache.evict()
+    return pd.DataFrame(rows)
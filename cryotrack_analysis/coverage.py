@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+from itertools import combinations
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+import vtk
+
+from .geometry import SurfaceIndex
+
+
+class Iceball:
+    """
+    Ice ball of a single probe, modelled as an ellipsoid of revolution around
+    the needle axis. Take the dimensions of the isotherm of interest (e.g.
+    -20 °C) from the isotherm charts of the probe and freeze protocol used.
+
+    :param length: extent along the needle [mm]
+    :param diameter: extent perpendicular to the needle [mm]
+    :param distal: how far the ice ball reaches beyond the needle tip [mm]
+    """
+
+    def __init__(self, length, diameter, distal=5.0):
+        self.length = length
+        self.diameter = diameter
+        self.distal = distal
+
+    def volume(self):
+        return 4 / 3 * np.pi * (self.length / 2) * (self.diameter / 2) ** 2
+
+    def axes(self, entry_points, tip_points):
+        """
+        Centers and unit needle directions of the ice balls of all insertions,
+        each (N, 3).
+        """
+        entry_points = np.asarray(entry_points, dtype=float).reshape(-1, 3)
+        tip_points = np.asarray(tip_points, dtype=float).reshape(-1, 3)
+        directions = tip_points - entry_points
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        centers = tip_points - directions * (self.length / 2 - self.distal)
+        return centers, directions
+
+    def contains(self, points, centers, directions):
+        """
+        (N, M) inside flags of M points for the ice balls of N insertions.
+        """
+        d = np.asarray(points, dtype=float)[None, :, :] - centers[:, None, :]
+        axial = np.einsum("nmk,nk->nm", d, directions)
+        radial2 = np.einsum("nmk,nmk->nm", d, d) - axial**2
+        return (axial / (self.length / 2)) ** 2 + radial2 / (self.diameter / 2) ** 2 <= 1
+
+    def half_extents(self, directions):
+        """
+        Half extents of the axis aligned bounding boxes of the ice balls, (N, 3).
+        """
+        a, b = self.length / 2, self.diameter / 2
+        return np.sqrt(a**2 * directions**2 + b**2 * (1 - directions**2))
+
+    def __str__(self):
+        return f"Iceball {self.length:g} x {self.diameter:g} mm, {self.distal:g} mm beyond the tip"
+
+
+def grid_points(lower, upper, spacing):
+    """
+    Voxel centers of a regular grid covering the box [lower, upper], (M, 3).
+    """
+    axes = [np.arange(lo + spacing / 2, hi, spacing) for lo, hi in zip(lower, upper)]
+    return np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+class VoxelizedSurface:
+    """
+    Voxel centers inside a closed surface (e.g. a tumor) on a grid with the
+    given spacing [mm].
+    """
+
+    def __init__(self, polydata: vtk.vtkPolyData, spacing=1.0):
+        self.spacing = spacing
+        bounds = np.array(polydata.GetBounds()).reshape(3, 2)
+        points = grid_points(bounds[:, 0], bounds[:, 1] + spacing, spacing)
+        self.points = points[SurfaceIndex(polydata).contains(points)]
+        self.voxel_volume = spacing**3
+
+    def volume(self):
+        return len(self.points) * self.voxel_volume
+
+
+def probe_combinations(target_ids, n_probes=2) -> List[tuple]:
+    """
+    All combinations of n_probes insertions aimed at the same target, as
+    tuples of insertion indices.
+    """
+    target_ids = np.asarray(target_ids)
+    sets = []
+    for target_id in np.unique(target_ids):
+        sets += list(combinations(np.flatnonzero(target_ids == target_id).tolist(), n_probes))
+    return sets
+
+
+def union_points(iceball: Iceball, centers, directions, probe_sets, spacing):
+    """
+    Voxel centers inside the union of the ice balls of every probe set,
+    concatenated, with the index of their probe set.
+    """
+    if len(probe_sets) == 0:
+        return np.empty((0, 3)), np.empty(0, dtype=int)
+    half_extents = iceball.half_extents(directions)
+    points, set_ids = [], []
+    for i, probes in enumerate(probe_sets):
+        probes = list(probes)
+        lower = (centers[probes] - half_extents[probes]).min(axis=0)
+        upper = (centers[probes] + half_extents[probes]).max(axis=0)
+        # snap to a common lattice, so that voxels of different sets line up
+        lower = np.floor(lower / spacing) * spacing
+        grid = grid_points(lower, upper + spacing, spacing)
+        inside = iceball.contains(grid, centers[probes], directions[probes]).any(axis=0)
+        points.append(grid[inside])
+        set_ids.append(np.full(inside.sum(), i))
+    return np.concatenate(points), np.concatenate(set_ids)
+
+
+def overlap_volumes(points, set_ids, n_sets, polydata: vtk.vtkPolyData, spacing):
+    """
+    Volume of every probe set's ice ball inside a closed surface. Points
+    outside the surface's bounds are discarded, and voxels shared by several
+    probe sets (they all lie on one lattice) are tested only once.
+    """
+    bounds = np.array(polydata.GetBounds()).reshape(3, 2)
+    candidates = np.flatnonzero(((points >= bounds[:, 0]) & (points <= bounds[:, 1])).all(axis=1))
+    if len(candidates) == 0:
+        return np.zeros(n_sets)
+    voxels, inverse = np.unique(
+        np.floor(points[candidates] / spacing).astype(np.int64), axis=0, return_inverse=True
+    )
+    inside = SurfaceIndex(polydata).contains((voxels + 0.5) * spacing)[inverse.ravel()]
+    return np.bincount(set_ids[candidates[inside]], minlength=n_sets) * spacing**3
+
+
+def iceball_coverage(
+    entry_points,
+    tip_points,
+    target_ids,
+    tumors: Dict[int, vtk.vtkPolyData],
+    risks: Dict[str, vtk.vtkPolyData],
+    iceball: Iceball,
+    spacing=1.0,
+    probe_sets: Sequence[Sequence[int]] = None,
+) -> pd.DataFrame:
+    """
+    Expected ice ball coverage of the target tumors, one row per probe set
+    (by default, every insertion on its own). The ice balls of all
+    insertions are tested against every voxel of their tumor at once; the
+    ice ball of a probe set is the union of the ice balls of its insertions,
+    which all have to aim at the same target.
+
+    :param entry_points: (N, 3) entry points of the insertions
+    :param tip_points: (N, 3) final tip positions of the insertions
+    :param target_ids: N keys into tumors
+    :param tumors: tumor meshes by target id
+    :param risks: risk structure meshes by name; empty meshes are skipped
+    :param iceball: ice ball dimensions of a single probe
+    :param spacing: voxel size [mm] for tumors and ice balls
+    :param probe_sets: tuples of insertion indices, e.g. probe_combinations(target_ids)
+                       (which is empty if no target has enough insertions)
+    """
+    target_ids = np.asarray(target_ids)
+    centers, directions = iceball.axes(entry_points, tip_points)
+    if probe_sets is None:
+        probe_sets = [(i,) for i in range(len(target_ids))]
+    probe_sets = [tuple(probes) for probes in probe_sets]
+    for probes in probe_sets:
+        if len(set(target_ids[list(probes)].tolist())) != 1:
+            raise Exception(f"Probe set {probes} aims at more than one target")
+
+    # (insertions, tumor voxels) inside flags, one batched test per tumor
+    voxels = {}
+    covered = {}
+    for target_id in np.unique(target_ids):
+        voxels[target_id] = VoxelizedSurface(tumors[target_id], spacing)
+        insertions = np.flatnonzero(target_ids == target_id)
+        inside = iceball.contains(voxels[target_id].points, centers[insertions], directions[insertions])
+        covered.update(zip(insertions.tolist(), inside))
+
+    points, set_ids = union_points(iceball, centers, directions, probe_sets, spacing)
+    iceball_volumes = np.bincount(set_ids, minlength=len(probe_sets)) * spacing**3
+    risk_volumes = {
+        name: overlap_volumes(points, set_ids, len(probe_sets), polydata, spacing)
+        for name, polydata in risks.items()
+        if polydata.GetNumberOfPolys() > 0
+    }
+
+    columns = [
+        "probes",
+        "Tumor volume [ml]",
+        "Iceball volume [ml]",
+        "Tumor coverage",
+        "Uncovered tumor [ml]",
+    ] + [f"Ice in {name} [ml]" for name in risk_volumes]
+    rows = []
+    for i, probes in enumerate(probe_sets):
+        target_id = target_ids[probes[0]]
+        inside = np.any([covered[p] for p in probes], axis=0)
+        tumor_volume = voxels[target_id].volume()
+        row = {
+            "probes": probes,
+            "Tumor volume [ml]": tumor_volume / 1000,
+            "Iceball volume [ml]": iceball_volumes[i] / 1000,
+            "Tumor coverage": inside.mean() if len(inside) else np.nan,
+            "Uncovered tumor [ml]": (~inside).sum() * voxels[target_id].voxel_volume / 1000,
+        }
+        for name, volumes in risk_volumes.items():
+            row[f"Ice in {name} [ml]"] = volumes[i] / 1000
+        rows.append(row)
+    return pd.DataFrame(rows, columns=columns)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from .enums import plane2str, str2plane
+
+# Normalised per-insertion key shared by all timing and accuracy tables
+KEY = ["target", "Operator", "Plane", "Strokes", "attempt"]
+# Leading index level of the fact table
+MODALITY = "Cryotrack"
+# Metrics that are named differently in the cryotrack and CT baseline tables
+HARMONIZED_COLUMNS = {
+    "Lateral Error (final)": "Lateral Error",
+    "total time [s]": "time [s]",
+    "duration": "time [s]",
+}
+
+
+def normalize_plane(plane):
+    """
+    "ip" or "op" for any plane spelling ("IP", "OoP", "oop", ...).
+    """
+    return plane2str(str2plane(str(plane)))
+
+
+def normalize_key_columns(df: pd.DataFrame, operator=None, strokes="ss") -> pd.DataFrame:
+    """
+    Copy of df with harmonised metric names and with target, Operator, Plane
+    and Strokes in normalised form. Tables without an operator or strokes
+    column get the given defaults (all cryotrack insertions are single-stroke).
+    """
+    df = df.rename(columns=HARMONIZED_COLUMNS)
+    df["target"] = df["target"].str.lower()
+    if "Operator" not in df.columns:
+        df["Operator"] = df["operator"] if "operator" in df.columns else operator
+        df = df.drop(columns=["operator"], errors="ignore")
+    df["Plane"] = df["Plane"].map(normalize_plane)
+    if "Strokes" not in df.columns:
+        df["Strokes"] = strokes
+    df["Strokes"] = df["Strokes"].str.lower()
+    return df
+
+
+def keyed(df: pd.DataFrame, order=None, operator=None, strokes="ss") -> pd.DataFrame:
+    """
+    df indexed by the normalised KEY. The attempt is the repetition of the
+    same target, operator, plane and strokes, counted in chronological order
+    (given by the sort key `order`, else the row order); the source's own
+    attempt numbering, if any, is kept as "attempt (source)".
+    """
+    df = normalize_key_columns(df, operator, strokes)
+    df = df.rename(columns={"attempt": "attempt (source)"})
+    rank = np.arange(len(df)) if order is None else np.asarray(order)
+    chronological = np.argsort(rank, kind="stable")
+    attempts = np.empty(len(df), dtype=int)
+    attempts[chronological] = df.iloc[chronological].groupby(KEY[:-1], sort=False).cumcount() + 1
+    df["attempt"] = attempts
+    df = df.set_index(KEY).sort_index()
+    if not df.index.is_unique:
+        raise Exception("Normalised insertion keys are not unique")
+    return df
+
+
+def join_timing(accuracy: pd.DataFrame, timing: pd.DataFrame) -> pd.DataFrame:
+    """
+    Outer join of keyed accuracy and timing rows on their sorted key index.
+    """
+    timing = timing.drop(columns=["target_index"], errors="ignore")
+    return accuracy.join(timing, how="outer", rsuffix=" (time)")
+
+
+def keyed_tables(tables: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+    """
+    Every available study table ("cryotrack", "cryotrack_time", "ctbaseline",
+    "ctbaseline_time") indexed by the normalised KEY.
+    """
+    result = {}
+    if "cryotrack" in tables:
+        result["cryotrack"] = keyed(tables["cryotrack"])
+    if "cryotrack_time" in tables:
+        result["cryotrack_time"] = keyed(tables["cryotrack_time"])
+    if "ctbaseline" in tables:
+        # insertions are numbered chronologically by the leading number of their name
+        df = tables["ctbaseline"]
+        result["ctbaseline"] = keyed(
+            df, order=df["name"].str.split(" ").str[0].astype(int), operator="JV"
+        )
+    if "ctbaseline_time" in tables:
+        df = tables["ctbaseline_time"]
+        result["ctbaseline_time"] = keyed(df, order=df["start_timestamp"])
+    return result
+
+
+def fact_table(
+    df_cryotrack_time, df_ctbaseline_time, df_ctbaseline, df_cryotrack
+) -> pd.DataFrame:
+    """
+    One row per insertion with its accuracy and timing, indexed by
+    (Cryotrack, *KEY) where Cryotrack is "with" or "without". Metrics that
+    are named differently per study are harmonised ("Lateral Error",
+    "time [s]"); insertions that only have accuracy or only timing data have
+    NaN in the other columns.
+    """
+    tables = keyed_tables(
+        dict(
+            cryotrack_time=df_cryotrack_time,
+            ctbaseline_time=df_ctbaseline_time,
+            ctbaseline=df_ctbaseline,
+            cryotrack=df_cryotrack,
+        )
+    )
+    return pd.concat(
+        {
+            "with": join_timing(tables["cryotrack"], tables["cryotrack_time"]),
+            "without": join_timing(tables["ctbaseline"], tables["ctbaseline_time"]),
+        },
+        names=[MODALITY],
+    )
+
+
+def paired(facts: pd.DataFrame, columns) -> pd.DataFrame:
+    """
+    Insertions that have all given columns, e.g. ["time [s]", "D_risk_min"]
+    for time vs accuracy analyses.
+    """
+    return facts.dropna(subset=list(columns))
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+# Risk structures, stored as <name in lower case>.vtk in a models directory
+RISK_STRUCTURES = ["Airway", "Hepatic", "Portal"]  # , "Liver", "Lungs"]
+
+
+def load_polydata(path):
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(str(path))
+    reader.ReadAllScalarsOn()
+    reader.ReadAllVectorsOn()
+    reader.Update()
+    return reader.GetOutput()
+
+
+def load_risk_models(model_path) -> Dict[str, vtk.vtkPolyData]:
+    """
+    Meshes of all RISK_STRUCTURES found in a models directory.
+    """
+    model_path = Path(model_path)
+    models = {}
+    for risk in RISK_STRUCTURES:
+        risk_path = model_path / (risk.lower() + ".vtk")
+        if not risk_path.exists():
+            print(f"No model for risk structure {risk} in {model_path}")
+            continue
+        models[risk] = load_polydata(risk_path)
+    return models
+
+
+def point_distance_to_polydata(point, polydata):
+    implicitPolyDataDistance = vtk.vtkImplicitPolyDataDistance()
+    implicitPolyDataDistance.SetInput(polydata)
+    closestPoint = np.zeros(3)
+    distance = implicitPolyDataDistance.EvaluateFunctionAndGetClosestPoint(
+        point, closestPoint
+    )
+    return closestPoint, distance
+
+
+class SurfaceIndex:
+    """
+    Prebuilt signed distance function of a closed surface (e.g. a tumor) for
+    batched queries: every method evaluates all given points in one call.
+    """
+
+    def __init__(self, polydata):
+        self.polydata = polydata
+        self.implicit_distance = vtk.vtkImplicitPolyDataDistance()
+        self.implicit_distance.SetInput(polydata)
+        # built once, so that the cell locator of the surface is reused
+        self.enclosed_points = vtk.vtkSelectEnclosedPoints()
+        self.enclosed_points.Initialize(polydata)
+
+    def signed_distances(self, points):
+        """
+        Signed distances of all points to the surface, negative inside.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        distances = vtk.vtkDoubleArray()
+        self.implicit_distance.FunctionValue(numpy_to_vtk(points, deep=True), distances)
+        return vtk_to_numpy(distances).copy()
+
+    def contains(self, points):
+        """
+        Inside/outside classification of all points by the enclosed points
+        test (ray casting against the surface).
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        return np.array([bool(self.enclosed_points.IsInsideSurface(*point)) for point in points], dtype=bool)
+
+
+def classify_points(points, surface_ids, surfaces: Dict[int, SurfaceIndex]):
+    """
+    Signed distance and inside flag of every point with respect to its own
+    surface, e.g. every tip with respect to the tumor it was aimed at. Points
+    are grouped by surface so that every surface is queried once.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    surface_ids = np.asarray(surface_ids)
+    distances = np.full(len(points), np.nan)
+    inside = np.zeros(len(points), dtype=bool)
+    for surface_id in np.unique(surface_ids):
+        mask = surface_ids == surface_id
+        surface = surfaces[surface_id]
+        distances[mask] = surface.signed_distances(points[mask])
+        inside[mask] = surface.contains(points[mask])
+    return distances, inside
+
+
+class RiskIndex:
+    """
+    One cell locator over the union of all risk structure meshes. Every cell
+    carries the index of the structure it belongs to, so a single closest
+    point query yields the closest structure and the closest point.
+
+    Distances are signed (negative inside a structure) with the same
+    convention as vtkImplicitPolyDataDistance: the sign is taken from the
+    face normal, or from the averaged normals if the closest point lies on an
+    edge or a vertex. The risk distance is the minimum of the signed
+    distances to all structures: inside a structure, that is the (negative)
+    distance to the structure the point is deepest in, even if the surface
+    of another structure is closer. Only structures whose bounds contain the
+    point can contain it, so only those are queried on their own.
+    """
+
+    def __init__(self, models: Dict[str, vtk.vtkPolyData]):
+        self.models = models
+        self.names = list(models.keys())
+        self._implicit_distances = {}
+        self.bounds = {
+            name: np.array(polydata.GetBounds()).reshape(3, 2)
+            for name, polydata in models.items()
+            if polydata.GetNumberOfPolys() > 0
+        }
+
+        append = vtk.vtkAppendPolyData()
+        for label, (name, polydata) in enumerate(models.items()):
+            if polydata.GetNumberOfPolys() == 0:
+                print(f"Risk structure {name} has no polygons and is ignored")
+                continue
+            labelled = vtk.vtkPolyData()
+            labelled.ShallowCopy(polydata)
+            labels = numpy_to_vtk(
+                np.full(labelled.GetNumberOfCells(), label, dtype=np.int32),
+                deep=True,
+                array_type=vtk.VTK_INT,
+            )
+            labels.SetName("Structure")
+            labelled.GetCellData().AddArray(labels)
+            append.AddInputData(labelled)
+        if append.GetNumberOfInputConnections(0) == 0:
+            self.polydata = None
+            return
+
+        # Same preprocessing as vtkImplicitPolyDataDistance.SetInput
+        triangles = vtk.vtkTriangleFilter()
+        triangles.SetInputConnection(append.GetOutputPort())
+        triangles.PassVertsOff()
+        triangles.PassLinesOff()
+        normals = vtk.vtkPolyDataNormals()
+        normals.SetInputConnection(triangles.GetOutputPort())
+        normals.ComputeCellNormalsOn()
+        normals.ComputePointNormalsOn()
+        normals.SplittingOff()
+        normals.Update()
+        self.polydata = normals.GetOutput()
+        self.polydata.BuildLinks()
+
+        self.labels = vtk_to_numpy(self.polydata.GetCellData().GetArray("Structure"))
+        self.cell_normals = vtk_to_numpy(self.polydata.GetCellData().GetNormals())
+        self.point_normals = vtk_to_numpy(self.polydata.GetPointData().GetNormals())
+        self.locator = vtk.vtkStaticCellLocator()
+        self.locator.SetDataSet(self.polydata)
+        self.locator.BuildLocator()
+        self._cell = vtk.vtkGenericCell()
+
+    def _normal(self, cell_id, closest_point):
+        # barycentric weights of the closest point decide face / edge / vertex
+        weights = [0.0, 0.0, 0.0]
+        self._cell.EvaluatePosition(
+            closest_point, [0.0, 0.0, 0.0], vtk.reference(0), [0.0, 0.0, 0.0],
+            vtk.reference(0.0), weights,
+        )
+        point_ids = [
+            self._cell.GetPointId(i)
+            for i in range(self._cell.GetNumberOfPoints())
+            if weights[i] >= 1e-12
+        ]
+        if len(point_ids) == 1:
+            return self.point_normals[point_ids[0]]
+        if len(point_ids) == 2:
+            neighbors = vtk.vtkIdList()
+            self.polydata.GetCellEdgeNeighbors(cell_id, point_ids[0], point_ids[1], neighbors)
+            normal = self.cell_normals[cell_id].copy()
+            for i in range(neighbors.GetNumberOfIds()):
+                normal += self.cell_normals[neighbors.GetId(i)]
+            return normal
+        return self.cell_normals[cell_id]
+
+    def query(self, point):
+        """
+        :return: minimum signed distance over all risk structures, the name
+                 of that structure and the closest point on its surface
+        """
+        if self.polydata is None:
+            return np.nan, None, np.full(3, np.nan)
+        point = np.asarray(point, dtype=float)
+        closest_point = np.zeros(3)
+        cell_id = vtk.reference(0)
+        dist2 = vtk.reference(0.0)
+        self.locator.FindClosestPoint(
+            point, closest_point, self._cell, cell_id, vtk.reference(0), dist2
+        )
+        cell_id = int(cell_id)
+        distance = np.sqrt(float(dist2))
+        if np.dot(point - closest_point, self._normal(cell_id, closest_point)) < 0:
+            distance = -distance
+        nearest = self.names[self.labels[cell_id]]
+
+        # structures that may contain the point, and so have a smaller signed distance
+        for name, bounds in self.bounds.items():
+            if name == nearest or not ((point >= bounds[:, 0]) & (point <= bounds[:, 1])).all():
+                continue
+            other_point = np.zeros(3)
+            other = self._implicit_distance(name).EvaluateFunctionAndGetClosestPoint(point, other_point)
+            if other < distance:
+                distance, nearest, closest_point = other, name, other_point
+        return distance, nearest, closest_point
+
+    def query_points(self, points):
+        results = [self.query(point) for point in points]
+        distances = np.array([r[0] for r in results])
+        names = [r[1] for r in results]
+        closest_points = np.array([r[2] for r in results]).reshape(-1, 3)
+        return distances, names, closest_points
+
+    def risk_distances(self, points):
+        """
+        :return: minimum signed distances over all risk structures, the names
+                 of those structures and a mask of which results are exact
+                 (all of them)
+        """
+        distances, names, _ = self.query_points(points)
+        return distances, names, np.ones(len(distances), dtype=bool)
+
+    def distance_to(self, point, name):
+        """
+        Signed distance to a single risk structure, computed on demand.
+        """
+        if self.models[name].GetNumberOfPolys() == 0:
+            return np.nan
+        return self._implicit_distance(name).EvaluateFunction(point)
+
+    def _implicit_distance(self, name):
+        if name not in self._implicit_distances:
+            implicit_distance = vtk.vtkImplicitPolyDataDistance()
+            implicit_distance.SetInput(self.models[name])
+            self._implicit_distances[name] = implicit_distance
+        return self._implicit_distances[name]
+
+
+def triangulate(polydata):
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputData(polydata)
+    triangles.PassVertsOff()
+    triangles.PassLinesOff()
+    triangles.Update()
+    return triangles.GetOutput()
+
+
+def decimate(polydata, reduction=0.9):
+    """
+    Coarse proxy of a mesh with about (1 - reduction) of its triangles.
+    """
+    decimation = vtk.vtkQuadricDecimation()
+    decimation.SetInputData(triangulate(polydata))
+    decimation.SetTargetReduction(reduction)
+    decimation.Update()
+    return decimation.GetOutput()
+
+
+def directed_hausdorff_bound(source, target: SurfaceIndex, spacing=1.0):
+    """
+    Upper bound of the directed Hausdorff distance from the triangle mesh
+    source to the target surface. Every triangle is sampled on a barycentric
+    grid whose edges are at most `spacing` long; since the distance to target
+    is 1-Lipschitz, no point of the triangle is farther from target than its
+    farthest sample plus the longest grid edge.
+    """
+    points = vtk_to_numpy(source.GetPoints().GetData()).astype(float)
+    triangles = vtk_to_numpy(source.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    corners = points[triangles]
+    edges = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2).max(axis=1)
+    n = np.maximum(1, np.ceil(edges / spacing)).astype(int)
+    samples = [points]
+    for k in np.unique(n[n > 1]):
+        i, j = np.nonzero(np.add.outer(np.arange(k + 1), np.arange(k + 1)) <= k)
+        weights = np.stack([k - i - j, i, j], axis=1) / k
+        samples.append(np.einsum("mc,tcd->tmd", weights, corners[n == k]).reshape(-1, 3))
+    distances = np.abs(target.signed_distances(np.concatenate(samples)))
+    return distances.max() + (edges / n).max()
+
+
+class LodRiskIndex:
+    """
+    Level-of-detail variant of RiskIndex. Every risk structure has a decimated
+    proxy whose symmetric Hausdorff distance to the full mesh is at most
+    `bounds[name]`, so the unsigned distance to the full mesh lies within
+    +-bound of the distance to the proxy (and the sign only agrees where the
+    proxy distance exceeds the bound).
+
+    All points are first evaluated against the proxies. A structure is only
+    refined on the full mesh for points where it may have the minimum signed
+    distance, and with a clearance threshold, points whose lower bound to
+    every structure already exceeds the threshold are answered from the
+    proxies alone. All other results are exact and identical to RiskIndex.
+    """
+
+    def __init__(self, models: Dict[str, vtk.vtkPolyData], threshold=None, reduction=0.9, spacing=1.0):
+        self.models = models
+        self.threshold = threshold
+        self.names = [name for name, m in models.items() if m.GetNumberOfPolys() > 0]
+        self.fine = {}
+        self.coarse = {}
+        self.bounds = {}
+        for name in self.names:
+            fine = triangulate(models[name])
+            coarse = decimate(fine, reduction)
+            self.fine[name] = SurfaceIndex(fine)
+            self.coarse[name] = SurfaceIndex(coarse)
+            self.bounds[name] = max(
+                directed_hausdorff_bound(fine, self.coarse[name], spacing),
+                directed_hausdorff_bound(coarse, self.fine[name], spacing),
+            )
+            print(
+                f"Risk structure {name}: {coarse.GetNumberOfPolys()} of "
+                f"{fine.GetNumberOfPolys()} triangles, Hausdorff bound {self.bounds[name]:.2f}"
+            )
+        self.refined = 0
+        self.queried = 0
+
+    def query_points(self, points):
+        """
+        :return: minimum signed distances over all risk structures, the names
+                 of those structures and a mask of which results are exact
+                 (False only for points clearly beyond the threshold, whose
+                 distance is the proxy estimate and whose nearest structure
+                 is the one closest on the proxies, not necessarily on the
+                 full meshes)
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n = len(points)
+        if not self.names:
+            return np.full(n, np.nan), [None] * n, np.ones(n, dtype=bool)
+        bounds = np.array([self.bounds[name] for name in self.names])
+        coarse = np.stack([self.coarse[name].signed_distances(points) for name in self.names], axis=1)
+        # bounds of the signed distances to the full meshes
+        sign_known = np.abs(coarse) > bounds
+        lower = np.where(sign_known, coarse - bounds, -np.abs(coarse) - bounds)
+        upper = np.where(sign_known, coarse + bounds, np.abs(coarse) + bounds)
+        # structures that may still have the minimum signed distance
+        candidates = lower <= upper.min(axis=1, keepdims=True)
+        exact = np.ones(n, dtype=bool)
+        if self.threshold is not None:
+            exact = lower.min(axis=1) <= self.threshold
+            candidates &= exact[:, None]
+
+        distances = np.where(candidates, np.nan, coarse)
+        for j, name in enumerate(self.names):
+            mask = candidates[:, j]
+            if mask.any():
+                distances[mask, j] = self.fine[name].signed_distances(points[mask])
+        self.refined += int(candidates.sum())
+        self.queried += n * len(self.names)
+
+        # exact results only compare refined structures, approximate ones all
+        closest = np.where(candidates | ~exact[:, None], distances, np.inf).argmin(axis=1)
+        names = [self.names[j] for j in closest]
+        return distances[np.arange(n), closest], names, exact
+
+    def risk_distances(self, points):
+        return self.query_points(points)
+
+    def query(self, point):
+        distances, names, exact = self.query_points([point])
+        return distances[0], names[0], exact[0]
+
+    def distance_to(self, point, name):
+        if name not in self.fine:
+            return np.nan
+        return self.fine[name].signed_distances(point)[0]
+
+    def __str__(self):
+        return f"LOD risk index: refined {self.refined} of {self.queried} structure queries"
+
+
+def build_risk_index(models: Dict[str, vtk.vtkPolyData], lod=False, threshold=None):
+    """
+    Exact RiskIndex, or with lod=True a LodRiskIndex that only resolves
+    distances exactly up to the clearance threshold (everywhere if None).
+    """
+    if lod:
+        return LodRiskIndex(models, threshold)
+    return RiskIndex(models)
@@ -1 +1 @@
-from .analyze_ctbaseline import run_ctbaseline_analysis
\ No newline at end of file
+from .analyze_ctbaseline import run_ctbaseline_analysis, iter_ctbaseline_analysis
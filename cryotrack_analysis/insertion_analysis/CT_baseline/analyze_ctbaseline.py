@@ -5,24 +5,42 @@ import re
 
 import numpy as np
 import pandas as pd
-import vtk
 
+from ...cache import cache_key, file_hash, memoized_rows, model_hashes
+from ...coverage import iceball_coverage, probe_combinations
+from ...geometry import (
+    RISK_STRUCTURES,
+    SurfaceIndex,
+    build_risk_index,
+    classify_points,
+    load_polydata,
+    load_risk_models,
+)
 from ...metrics import lateral_error, euclidean_error
-
-# Load ground truth target positions. We will need them in PlannedTarget.load
-# to determine if final and entry points have been mapped correctly.
-with open("data/CT_baseline/markups/tumor.mrk.json", "r") as f:
-    d = json.load(f)
+from ...parallel import parallel
+from ...paths import DATA_PATH
+from ...planning import ClearanceField, candidate_directions, relative_clearances, safest_trajectory
+from ...streaming import chunked
+
+
+def load_tumor_points(data_path=DATA_PATH):
+    """
+    Load ground truth target positions. We will need them in LineMarkup.load
+    to determine if final and entry points have been mapped correctly.
+    """
+    with open(Path(data_path) / "CT_baseline/markups/tumor.mrk.json", "r") as f:
+        d = json.load(f)
     markups = d["markups"]
     controlPoints = markups[0]["controlPoints"]
     positions = [np.array(p["position"]) for p in controlPoints]
-    tumor_points = np.array(positions)
+    return np.array(positions)
 
 
 class LineMarkup:
-    def __init__(self, path, target_index):
+    def __init__(self, path, target_index, tumor_points):
         self.path = path
         self.target_index = target_index
+        self.tumor_points = tumor_points
         self.entry_point = None
         self.final_point = None
         self.load()
@@ -42,19 +60,20 @@ class LineMarkup:
         # A simple and safe heuristic is to check the distance between final point and actual target position.
         self.final_point = np.array(controlPoints[0]["position"])
         self.entry_point = np.array(controlPoints[1]["position"])
-        if np.linalg.norm(
-            tumor_points[self.target_index] - self.entry_point
-        ) < np.linalg.norm(tumor_points[self.target_index] - self.final_point):
+        tumor_point = self.tumor_points[self.target_index]
+        if np.linalg.norm(tumor_point - self.entry_point) < np.linalg.norm(
+            tumor_point - self.final_point
+        ):
             self.final_point = np.array(controlPoints[1]["position"])
             self.entry_point = np.array(controlPoints[0]["position"])
 
 
 class PlannedTarget(LineMarkup):
-    def __init__(self, name, path, plane):
+    def __init__(self, name, path, plane, tumor_points):
         self.name = name
         self.index = int(self.name[1:]) - 1
         self.plane = plane.lower()
-        super(PlannedTarget, self).__init__(path, self.index)
+        super(PlannedTarget, self).__init__(path, self.index, tumor_points)
 
     @staticmethod
     def is_target_markup_path(path):
@@ -62,21 +81,21 @@ class PlannedTarget(LineMarkup):
         return re.match("^t[0-9]-(IP|OoP|OP|OOP)$", stem) is not None
 
     @staticmethod
-    def from_path(path):
+    def from_path(path, tumor_points):
         stem = path.stem[: -len(".mrk")]
         tokens = stem.split("-")
         name = tokens[0]
         plane = tokens[1].lower()
         if plane == "oop":
             plane = "op"
-        return PlannedTarget(name, path, plane)
+        return PlannedTarget(name, path, plane, tumor_points)
 
     def __str__(self):
         return f"PlannedTarget {self.name}: plane={self.plane}"
 
 
 class Insertion(LineMarkup):
-    def __init__(self, index, path, target, plane, strokes, attempt=0):
+    def __init__(self, index, path, target, plane, strokes, tumor_points, attempt=0):
         self.index = index
         self.path = path
         self.target = target
@@ -84,7 +103,7 @@ class Insertion(LineMarkup):
         self.plane = plane
         self.strokes = strokes
         self.attempt = attempt
-        super(Insertion, self).__init__(path, self.index)
+        super(Insertion, self).__init__(path, self.index, tumor_points)
 
     def row(self):
         return dict(
@@ -104,7 +123,7 @@ class Insertion(LineMarkup):
         )
 
     @staticmethod
-    def from_path(path):
+    def from_path(path, tumor_points):
         stem = path.stem[: -len(".mrk")]
         tokens = stem.replace("-", " ").split(" ")
         index = int(tokens[0])
@@ -112,90 +131,140 @@ class Insertion(LineMarkup):
         plane = tokens[2].lower()
         strokes = tokens[3].lower()
         attempt = int(tokens[4])
-        return Insertion(index, path, target, plane, strokes, attempt)
+        return Insertion(index, path, target, plane, strokes, tumor_points, attempt)
 
     def __str__(self):
         return f"Insertion {self.index}: target={self.target} plane={self.plane} strokes={self.strokes} attempt={self.attempt}"
 
 
-def load_tumor_meshes():
-    model_path = Path("data") / "CT_baseline" / "models"
+def load_tumor_meshes(data_path=DATA_PATH):
+    model_path = Path(data_path) / "CT_baseline" / "models"
     tumor_paths = model_path.glob("tumor*.vtk")
     models = {}
     for tumor_path in tumor_paths:
         stem = tumor_path.stem
         target_index = int(stem[len("tumor-")]) - 1
-        reader = vtk.vtkPolyDataReader()
-        reader.SetFileName(str(tumor_path))
-        reader.ReadAllScalarsOn()
-        reader.ReadAllVectorsOn()
-        reader.Update()
-        polydata = reader.GetOutput()
-        models[target_index] = polydata
+        models[target_index] = load_polydata(tumor_path)
     return models
 
 
-def load_risk_meshes():
-    model_path = Path("data") / "CT_baseline" / "models"
-    risk_structures = ["Airway", "Hepatic", "Portal"]#, "Liver", "Lungs"]
-    models = {}
-    for risk in risk_structures:
-        risk_path = model_path / (risk.lower() + ".vtk")
-        reader = vtk.vtkPolyDataReader()
-        reader.SetFileName(str(risk_path))
-        reader.ReadAllScalarsOn()
-        reader.ReadAllVectorsOn()
-        reader.Update()
-        polydata = reader.GetOutput()
-        models[risk] = polydata
-    return models
+def load_tumor_indexes(data_path=DATA_PATH):
+    return {i: SurfaceIndex(m) for i, m in load_tumor_meshes(data_path).items()}
 
 
-def point_distance_to_polydata(point, polydata):
-    implicitPolyDataDistance = vtk.vtkImplicitPolyDataDistance()
-    implicitPolyDataDistance.SetInput(polydata)
-    closestPoint = np.zeros(3)
-    distance = implicitPolyDataDistance.EvaluateFunctionAndGetClosestPoint(
-        point, closestPoint
-    )
-    return closestPoint, distance
+def load_risk_meshes(data_path=DATA_PATH):
+    return load_risk_models(Path(data_path) / "CT_baseline" / "models")
 
 
-def run_ctbaseline_analysis() -> pd.DataFrame:
-    insertions = []
+def load_planned_targets(data_path=DATA_PATH, tumor_points=None):
+    if tumor_points is None:
+        tumor_points = load_tumor_points(data_path)
     targets = {}
-
-    for p in Path("data/CT_baseline/markups/").glob("*.mrk.json"):
-        if Insertion.is_insertion_markup_path(p):
-            insertions.append(Insertion.from_path(p))
+    for p in sorted((Path(data_path) / "CT_baseline/markups").glob("*.mrk.json")):
         if PlannedTarget.is_target_markup_path(p):
-            t = PlannedTarget.from_path(p)
+            t = PlannedTarget.from_path(p, tumor_points)
             targets[(t.name, t.plane)] = t
+    return targets
 
-    print("CT BASELINE")
 
-    tumor_models = load_tumor_meshes()
-    risk_models = load_risk_meshes()
+def iter_insertions(data_path=DATA_PATH, tumor_points=None):
+    """
+    Lazily load insertion markups, so that only the current chunk of
+    insertions has to be held in memory.
+    """
+    if tumor_points is None:
+        tumor_points = load_tumor_points(data_path)
+    for p in sorted((Path(data_path) / "CT_baseline/markups").glob("*.mrk.json")):
+        if Insertion.is_insertion_markup_path(p):
+            yield Insertion.from_path(p, tumor_points)
+
+
+def load_indexes(data_path=DATA_PATH, lod=False, risk_threshold=None):
+    risk_index = build_risk_index(load_risk_meshes(data_path), lod, risk_threshold)
+    return load_tumor_indexes(data_path), risk_index
+
+
+def mesh_hashes(data_path=DATA_PATH):
+    """
+    Content hashes of the tumor meshes (by stem) and one combined hash of all
+    risk structure meshes.
+    """
+    hashes = model_hashes(Path(data_path) / "CT_baseline" / "models")
+    risk_hash = cache_key(*[(risk, hashes.get(risk.lower())) for risk in RISK_STRUCTURES])
+    return hashes, risk_hash
+
+
+class LazyEvaluator:
+    """
+    Evaluates chunks of insertions, building the tumor and risk indexes only
+    once the first insertion actually needs to be evaluated.
+    """
+
+    def __init__(self, data_path, targets, per_structure=False, lod=False, risk_threshold=None):
+        self.data_path = data_path
+        self.targets = targets
+        self.per_structure = per_structure
+        self.lod = lod
+        self.risk_threshold = risk_threshold
+        self.indexes = None
+
+    def __call__(self, insertions) -> pd.DataFrame:
+        if self.indexes is None:
+            self.indexes = load_indexes(self.data_path, self.lod, self.risk_threshold)
+        return evaluate_insertions(insertions, self.targets, *self.indexes, self.per_structure)
+
+    def key(self, insertion, hashes, risk_hash):
+        """
+        Cache key of an insertion's row: its own and its planned target's
+        markup, the tumor point used to orient both and the meshes it is
+        evaluated against.
+        """
+        target = self.targets[(insertion.target, insertion.plane)]
+        return cache_key(
+            insertion.path.name,
+            file_hash(insertion.path),
+            file_hash(target.path),
+            insertion.tumor_points[insertion.index],
+            hashes.get(f"tumor-{insertion.index + 1}"),
+            risk_hash,
+            self.per_structure,
+            self.lod,
+            self.risk_threshold,
+        )
+
+
+def evaluate_cached(insertions, evaluate, cache, hashes, risk_hash):
+    keys = [evaluate.key(insertion, hashes, risk_hash) for insertion in insertions]
+    return memoized_rows(insertions, keys, evaluate, cache)
+
 
-    # convert to pandas dataframe and save it
+def evaluate_insertions(
+    insertions, targets, tumor_indexes, risk_index, per_structure=False
+) -> pd.DataFrame:
+    # one batched query per tumor for all tips of this chunk
+    tip_to_tumor, tip_in_tumor = classify_points(
+        [insertion.final_point for insertion in insertions],
+        [insertion.index for insertion in insertions],
+        tumor_indexes,
+    )
+    D_risk_min, nearest_risk, D_risk_min_exact = risk_index.risk_distances(
+        [insertion.final_point for insertion in insertions]
+    )
     rows = []
-    for insertion in insertions:
+    for i, insertion in enumerate(insertions):
         row = insertion.row()
         target_index = (insertion.target, insertion.plane)
         target = targets[target_index]
 
-        tumor_model = tumor_models[insertion.index]
-        closestPoint, distance = point_distance_to_polydata(insertion.final_point, tumor_model)
-        
-        E_tip_to_tumor = np.abs(distance)
+        E_tip_to_tumor = np.abs(tip_to_tumor[i])
         E_final_euclidean = euclidean_error(target.final_point, insertion.final_point)
         E_entry_euclidean = euclidean_error(target.entry_point, insertion.entry_point)
         E_lateral = lateral_error(
             target.final_point, insertion.entry_point, insertion.final_point
         )
-        for name, m in risk_models.items():
-            _, tip_to_risk = point_distance_to_polydata(insertion.final_point, m)
-            row[f"D_{name}"] = tip_to_risk
+        if per_structure:
+            for name in risk_index.names:
+                row[f"D_{name}"] = risk_index.distance_to(insertion.final_point, name)
 
         row.update(
             {
@@ -203,11 +272,151 @@ def run_ctbaseline_analysis() -> pd.DataFrame:
                 "Euclidean Error (final)": E_final_euclidean,
                 "Entry Point Error": E_entry_euclidean,
                 "Euclidean (tip to tumor)": E_tip_to_tumor,
+                "Signed (tip to tumor)": tip_to_tumor[i],
+                "Tip in tumor": tip_in_tumor[i],
                 "Lateral Error": E_lateral,
-                "Target Depth": target.depth()
+                "Target Depth": target.depth(),
+                "D_risk_min": D_risk_min[i],
+                "Nearest risk": nearest_risk[i],
+                "D_risk_min exact": D_risk_min_exact[i],
             }
         )
         rows.append(row)
-    df = pd.DataFrame(rows)
-    df["D_risk_min"] = df[["D_" + name for name in risk_models.keys()]].min(1)
+    return pd.DataFrame(rows)
+
+
+def iter_ctbaseline_analysis(
+    data_path=DATA_PATH,
+    chunk_size=64,
+    per_structure=False,
+    cache=None,
+    lod=False,
+    risk_threshold=None,
+    jobs=1,
+):
+    """
+    Evaluate insertions in chunks of at most chunk_size and yield one
+    DataFrame per chunk. With jobs, every chunk is split over the worker
+    processes.
+    """
+    tumor_points = load_tumor_points(data_path)
+    targets = load_planned_targets(data_path, tumor_points)
+
+    print("CT BASELINE")
+
+    evaluate = LazyEvaluator(data_path, targets, per_structure, lod, risk_threshold)
+    if cache is not None:
+        hashes, risk_hash = mesh_hashes(data_path)
+    with parallel(evaluate, jobs) as evaluate:
+        for insertions in chunked(iter_insertions(data_path, tumor_points), chunk_size):
+            if cache is None:
+                yield evaluate(insertions)
+            else:
+                yield evaluate_cached(insertions, evaluate, cache, hashes, risk_hash)
+
+
+def run_ctbaseline_analysis(
+    data_path=DATA_PATH, per_structure=False, cache=None, lod=False, risk_threshold=None, jobs=1
+) -> pd.DataFrame:
+    """
+    :param per_structure: additionally report the distance to every single
+                          risk structure in D_<structure> columns
+    :param cache: optional RowCache; only insertions whose markups or meshes
+                  changed are evaluated
+    :param lod: answer risk distances from decimated meshes where their
+                Hausdorff bound decides the result (see LodRiskIndex)
+    :param risk_threshold: with lod, D_risk_min is only exact up to this
+                           clearance; larger values are proxy estimates
+    :param jobs: number of worker processes evaluating the insertions, each
+                 with its own tumor and risk indexes (None for one per core);
+                 the result is identical to the serial one (jobs=1)
+    """
+    tumor_points = load_tumor_points(data_path)
+    targets = load_planned_targets(data_path, tumor_points)
+    insertions = list(iter_insertions(data_path, tumor_points))
+
+    print("CT BASELINE")
+
+    evaluate = LazyEvaluator(data_path, targets, per_structure, lod, risk_threshold)
+    with parallel(evaluate, jobs) as evaluate:
+        if cache is None:
+            return evaluate(insertions)
+        return evaluate_cached(insertions, evaluate, cache, *mesh_hashes(data_path))
+
+
+def run_ctbaseline_coverage(iceball, data_path=DATA_PATH, spacing=1.0, n_probes=1) -> pd.DataFrame:
+    """
+    Expected ice ball coverage of the target tumor and ice ball volume inside
+    every risk structure, for every insertion or (with n_probes > 1) every
+    combination of n_probes insertions aimed at the same target.
+
+    :param iceball: coverage.Iceball with the isotherm dimensions of the probe
+    :param spacing: voxel size [mm]
+    """
+    insertions = list(iter_insertions(data_path))
+
+    print("CT BASELINE COVERAGE")
+
+    target_ids = [insertion.index for insertion in insertions]
+    df = iceball_coverage(
+        [insertion.entry_point for insertion in insertions],
+        [insertion.final_point for insertion in insertions],
+        target_ids,
+        load_tumor_meshes(data_path),
+        load_risk_meshes(data_path),
+        iceball,
+        spacing,
+        probe_combinations(target_ids, n_probes) if n_probes > 1 else None,
+    )
+    names = [insertion.row()["name"] for insertion in insertions]
+    df.insert(0, "name", [" + ".join(names[p] for p in probes) for probes in df["probes"]])
+    df.insert(1, "target", [insertions[probes[0]].target for probes in df["probes"]])
     return df
+
+
+def run_ctbaseline_planning(
+    data_path=DATA_PATH, n_candidates=4096, cone_angle=45.0, max_clearance=50.0, tolerance=0.25
+):
+    """
+    Planning benchmark: the safest straight trajectory to every planned
+    target, searched among n_candidates entry directions within cone_angle
+    [deg] of the planned trajectory (on the whole sphere if None) at the
+    planned depth, and the clearance of every insertion relative to it.
+
+    :return: one row per planned target and one row per insertion
+    """
+    tumor_points = load_tumor_points(data_path)
+    targets = load_planned_targets(data_path, tumor_points)
+    insertions = list(iter_insertions(data_path, tumor_points))
+    field = ClearanceField(load_risk_meshes(data_path), max_clearance)
+
+    print("CT BASELINE PLANNING")
+
+    rows = []
+    for (name, plane), target in targets.items():
+        axis = target.entry_point - target.final_point
+        row = dict(target=name, Plane=plane)
+        row.update(
+            safest_trajectory(
+                field,
+                target.final_point,
+                candidate_directions(n_candidates, axis, cone_angle),
+                target.depth(),
+                tolerance,
+            )
+        )
+        rows.append(row)
+    df_targets = pd.DataFrame(rows)
+
+    optimal = df_targets.set_index(["target", "Plane"])["Clearance (optimal)"]
+    df_insertions = relative_clearances(
+        field,
+        [insertion.entry_point for insertion in insertions],
+        [insertion.final_point for insertion in insertions],
+        [optimal[(insertion.target, insertion.plane)] for insertion in insertions],
+        tolerance,
+    )
+    df_insertions.insert(0, "name", [insertion.row()["name"] for insertion in insertions])
+    df_insertions.insert(1, "target", [insertion.target for insertion in insertions])
+    df_insertions.insert(2, "Plane", [insertion.plane for insertion in insertions])
+    return df_targets, df_insertions
@@ -1 +1 @@
-from .analyze_cryotrack import run_cryotrack_analysis
+from .analyze_cryotrack import run_cryotrack_analysis, iter_cryotrack_analysis
@@ -1,14 +1,32 @@
 #!/usr/bin/env python3
 import json
 from enum import Enum
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import vtk
 
+from ...cache import cache_key, memoized_rows, model_hashes
+from ...coverage import iceball_coverage, probe_combinations
+from ...geometry import (
+    RISK_STRUCTURES,
+    SurfaceIndex,
+    build_risk_index,
+    classify_points,
+    load_polydata,
+    load_risk_models,
+)
 from ...enums import Plane, str2plane, plane2str
 from ...metrics import lateral_error, euclidean_error
+from ...parallel import parallel
+from ...planning import ClearanceField, candidate_directions, relative_clearances, safest_trajectory
 from ...paths import DATA_PATH
+from ...registration import LandmarkRegistration, transform_positions
+from ...streaming import chunked
+
+# To-2 has no counterpart in From, the remaining fiducials are in the same order
+FIDUCIAL_PAIRS = {1: 1, 2: 3, 3: 4, 4: 5, 5: 6, 6: 7, 7: 8, 8: 9, 9: 10}
+REGISTRATIONS = ("rigid", "similarity")
 
 
 class Acquisition:
@@ -59,15 +77,22 @@ class Acquisition:
         return s
 
 
-def load_acquisitions():
-    filename = DATA_PATH / "cryotrack_validation/acquisitions.txt"
+def load_acquisitions(data_path=DATA_PATH):
+    filename = Path(data_path) / "cryotrack_validation/acquisitions.txt"
     with open(filename, "r") as f:
         lines = f.readlines()
     return [Acquisition.from_string(line) for line in lines]
 
 
-def load_tip_positions():
-    with open(DATA_PATH / "cryotrack_validation/markups/tip.mrk.json", "r") as f:
+def iter_acquisitions(data_path=DATA_PATH):
+    filename = Path(data_path) / "cryotrack_validation/acquisitions.txt"
+    with open(filename, "r") as f:
+        for line in f:
+            yield Acquisition.from_string(line)
+
+
+def load_tip_positions(data_path=DATA_PATH):
+    with open(Path(data_path) / "cryotrack_validation/markups/tip.mrk.json", "r") as f:
         d = json.load(f)
     markups = d["markups"]
     controlPoints = markups[0]["controlPoints"]
@@ -75,9 +100,9 @@ def load_tip_positions():
     return positions
 
 
-def load_entry_points():
+def load_entry_points(data_path=DATA_PATH):
     with open(
-        DATA_PATH / "cryotrack_validation/markups/entry-point.mrk.json", "r"
+        Path(data_path) / "cryotrack_validation/markups/entry-point.mrk.json", "r"
     ) as f:
         d = json.load(f)
     markups = d["markups"]
@@ -86,8 +111,8 @@ def load_entry_points():
     return positions
 
 
-def load_targets():
-    with open(DATA_PATH / "cryotrack_validation/markups/target.mrk.json", "r") as f:
+def load_targets(data_path=DATA_PATH):
+    with open(Path(data_path) / "cryotrack_validation/markups/target.mrk.json", "r") as f:
         d = json.load(f)
     markups = d["markups"]
     controlPoints = markups[0]["controlPoints"]
@@ -95,86 +120,341 @@ def load_targets():
     return positions
 
 
-def load_tumor_meshes():
-    model_path = DATA_PATH / "cryotrack_validation" / "models"
+def load_tumor_meshes(data_path=DATA_PATH):
+    model_path = Path(data_path) / "cryotrack_validation" / "models"
     tumor_paths = model_path.glob("tumor*.vtk")
     models = {}
     for tumor_path in tumor_paths:
         stem = tumor_path.stem
         target_index = int(stem[len("tumor-")]) - 1
-        reader = vtk.vtkPolyDataReader()
-        reader.SetFileName(str(tumor_path))
-        reader.ReadAllScalarsOn()
-        reader.ReadAllVectorsOn()
-        reader.Update()
-        polydata = reader.GetOutput()
-        models[target_index] = polydata
+        models[target_index] = load_polydata(tumor_path)
     return models
 
 
-def load_risk_meshes():
-    model_path = DATA_PATH / "cryotrack_validation/models"
-    risk_structures = ["Airway", "Hepatic", "Portal"]
-    models = {}
-    for risk in risk_structures:
-        risk_path = model_path / (risk.lower() + ".vtk")
-        reader = vtk.vtkPolyDataReader()
-        reader.SetFileName(str(risk_path))
-        reader.ReadAllScalarsOn()
-        reader.ReadAllVectorsOn()
-        reader.Update()
-        polydata = reader.GetOutput()
-        models[risk] = polydata
-    return models
+def load_risk_meshes(data_path=DATA_PATH):
+    return load_risk_models(Path(data_path) / "cryotrack_validation/models")
 
 
-def point_distance_to_polydata(point, polydata):
-    implicitPolyDataDistance = vtk.vtkImplicitPolyDataDistance()
-    implicitPolyDataDistance.SetInput(polydata)
-    closestPoint = np.zeros(3)
-    distance = implicitPolyDataDistance.EvaluateFunctionAndGetClosestPoint(
-        point, closestPoint
-    )
-    return closestPoint, distance
+def load_registration(data_path=DATA_PATH, similarity=False) -> LandmarkRegistration:
+    """
+    Registration of the intraoperative frame (To fiducials, in which the
+    measured tips and entry points are given) to the planning frame (From
+    fiducials, in which targets and models are given).
+    """
+    markup_path = Path(data_path) / "cryotrack_validation/markups"
+    registration = LandmarkRegistration.from_markups(
+        markup_path / "From.mrk.json",
+        markup_path / "To.mrk.json",
+        FIDUCIAL_PAIRS,
+        similarity,
+    ).inverse()
+    print(registration)
+    return registration
 
 
-def run_cryotrack_analysis() -> pd.DataFrame:
-    acquisitions = load_acquisitions()
-    target_points = load_targets()
-    tip_positions = load_tip_positions()
-    entry_points = load_entry_points()
-    models = load_tumor_meshes()
-    risk_models = load_risk_meshes()
+def load_points(data_path=DATA_PATH, registration=None):
+    """
+    Target, tip and entry point markups. With registration ("rigid" or
+    "similarity"), tips and entry points are mapped to the planning frame of
+    the targets and models; the matrix they are mapped with is returned as
+    well (None without registration). It is always rigid, so that distances
+    are not rescaled: a similarity registration only reports its scale.
+    """
+    target_points = load_targets(data_path)
+    tip_positions = load_tip_positions(data_path)
+    entry_points = load_entry_points(data_path)
+    matrix = None
+    if registration is not None:
+        if registration not in REGISTRATIONS:
+            raise Exception(f"Unknown registration {registration}, expected one of {REGISTRATIONS}")
+        matrix = load_registration(data_path, registration == "similarity").rigid_matrix
+        tip_positions = transform_positions(matrix, tip_positions)
+        entry_points = transform_positions(matrix, entry_points)
+    return target_points, tip_positions, entry_points, matrix
 
-    print("CRYOTRACK")
 
+def load_indexes(data_path=DATA_PATH, lod=False, risk_threshold=None):
+    """
+    Prebuilt tumor and risk indexes.
+    """
+    tumor_meshes = load_tumor_meshes(data_path)
+    risk_meshes = load_risk_meshes(data_path)
+    tumor_indexes = {i: SurfaceIndex(m) for i, m in tumor_meshes.items()}
+    return tumor_indexes, build_risk_index(risk_meshes, lod, risk_threshold)
+
+
+def mesh_hashes(data_path=DATA_PATH):
+    """
+    Content hashes of the tumor meshes (by stem) and one combined hash of all
+    risk structure meshes.
+    """
+    hashes = model_hashes(Path(data_path) / "cryotrack_validation" / "models")
+    risk_hash = cache_key(*[(risk, hashes.get(risk.lower())) for risk in RISK_STRUCTURES])
+    return hashes, risk_hash
+
+
+class LazyEvaluator:
+    """
+    Evaluates chunks of acquisitions, building the tumor and risk indexes
+    only once the first acquisition actually needs to be evaluated.
+    """
+
+    def __init__(self, data_path, points, per_structure=False, lod=False, risk_threshold=None):
+        self.data_path = data_path
+        self.target_points, self.tip_positions, self.entry_points, self.matrix = points
+        self.per_structure = per_structure
+        self.lod = lod
+        self.risk_threshold = risk_threshold
+        self.indexes = None
+
+    def __call__(self, acquisitions) -> pd.DataFrame:
+        if self.indexes is None:
+            self.indexes = load_indexes(self.data_path, self.lod, self.risk_threshold)
+        return evaluate_acquisitions(
+            acquisitions,
+            self.target_points,
+            self.tip_positions,
+            self.entry_points,
+            *self.indexes,
+            self.per_structure,
+        )
+
+    def key(self, acquisition, hashes, risk_hash):
+        """
+        Cache key of an acquisition's row: its descriptor, its markup points
+        and the meshes (and registration) it is evaluated with.
+        """
+        idx = acquisition.indices[0]
+        return cache_key(
+            acquisition.name,
+            acquisition.indices,
+            self.tip_positions[idx],
+            self.entry_points[idx],
+            self.target_points[acquisition.target_index],
+            hashes.get(f"tumor-{acquisition.target_index + 1}"),
+            risk_hash,
+            self.matrix if self.matrix is not None else "",
+            self.per_structure,
+            self.lod,
+            self.risk_threshold,
+        )
+
+
+def evaluate_cached(acquisitions, evaluate, cache, hashes, risk_hash):
+    keys = [evaluate.key(acquisition, hashes, risk_hash) for acquisition in acquisitions]
+    return memoized_rows(acquisitions, keys, evaluate, cache)
+
+
+def evaluate_acquisitions(
+    acquisitions,
+    target_points,
+    tip_positions,
+    entry_points,
+    tumor_indexes,
+    risk_index,
+    per_structure=False,
+) -> pd.DataFrame:
+    # one batched query per tumor for all tips of this chunk
+    tip_to_tumor, tip_in_tumor = classify_points(
+        [tip_positions[acquisition.indices[0]] for acquisition in acquisitions],
+        [acquisition.target_index for acquisition in acquisitions],
+        tumor_indexes,
+    )
+    D_risk_min, nearest_risk, D_risk_min_exact = risk_index.risk_distances(
+        [tip_positions[acquisition.indices[0]] for acquisition in acquisitions]
+    )
     rows = []
-    for acquisition in acquisitions:
+    for i, acquisition in enumerate(acquisitions):
         row = acquisition.row()
         idx = acquisition.indices[0]
         tip_position = tip_positions[idx]
         entry_point = entry_points[idx]
         target_point = target_points[acquisition.target_index]
-        model = models[acquisition.target_index]
-        closestPoint, distance = point_distance_to_polydata(tip_position, model)
 
-        for name, m in risk_models.items():
-            _, tip_to_risk = point_distance_to_polydata(tip_position, m)
-            row[f"D_{name}"] = tip_to_risk
+        if per_structure:
+            for name in risk_index.names:
+                row[f"D_{name}"] = risk_index.distance_to(tip_position, name)
 
         E_euclidean = euclidean_error(tip_position, target_point)
         # E_entry_euclidean = euclidean_error(entry_point, )
         E_lateral = lateral_error(target_point, entry_point, tip_position)
-        E_tip_to_tumor = np.abs(distance)
+        E_tip_to_tumor = np.abs(tip_to_tumor[i])
 
         row.update(
             {
                 "Euclidean Error (final)": E_euclidean,
                 "Lateral Error (final)": E_lateral,
                 "Euclidean (tip to tumor)": E_tip_to_tumor,
+                "Signed (tip to tumor)": tip_to_tumor[i],
+                "Tip in tumor": tip_in_tumor[i],
+                "D_risk_min": D_risk_min[i],
+                "Nearest risk": nearest_risk[i],
+                "D_risk_min exact": D_risk_min_exact[i],
             }
         )
         rows.append(row)
-    df = pd.DataFrame(rows)
-    df["D_risk_min"] = df[["D_" + name for name in risk_models.keys()]].min(1)
+    return pd.DataFrame(rows)
+
+
+def iter_cryotrack_analysis(
+    data_path=DATA_PATH,
+    chunk_size=64,
+    per_structure=False,
+    registration=None,
+    cache=None,
+    lod=False,
+    risk_threshold=None,
+    jobs=1,
+):
+    """
+    Evaluate acquisitions in chunks of at most chunk_size and yield one
+    DataFrame per chunk. With jobs, every chunk is split over the worker
+    processes.
+    """
+    evaluate = LazyEvaluator(
+        data_path, load_points(data_path, registration), per_structure, lod, risk_threshold
+    )
+
+    print("CRYOTRACK")
+
+    if cache is not None:
+        hashes, risk_hash = mesh_hashes(data_path)
+    with parallel(evaluate, jobs) as evaluate:
+        for acquisitions in chunked(iter_acquisitions(data_path), chunk_size):
+            if cache is None:
+                yield evaluate(acquisitions)
+            else:
+                yield evaluate_cached(acquisitions, evaluate, cache, hashes, risk_hash)
+
+
+def run_cryotrack_analysis(
+    data_path=DATA_PATH,
+    per_structure=False,
+    registration=None,
+    cache=None,
+    lod=False,
+    risk_threshold=None,
+    jobs=1,
+) -> pd.DataFrame:
+    """
+    :param per_structure: additionally report the distance to every single
+                          risk structure in D_<structure> columns
+    :param registration: "rigid" or "similarity" to map tips and entry points
+                         to the planning frame given by the From/To fiducials
+                         (see load_points)
+    :param cache: optional RowCache; only acquisitions whose markups or meshes
+                  changed are evaluated
+    :param lod: answer risk distances from decimated meshes where their
+                Hausdorff bound decides the result (see LodRiskIndex)
+    :param risk_threshold: with lod, D_risk_min is only exact up to this
+                           clearance; larger values are proxy estimates
+    :param jobs: number of worker processes evaluating the acquisitions, each
+                 with its own tumor and risk indexes (None for one per core);
+                 the result is identical to the serial one (jobs=1)
+    """
+    acquisitions = load_acquisitions(data_path)
+    evaluate = LazyEvaluator(
+        data_path, load_points(data_path, registration), per_structure, lod, risk_threshold
+    )
+
+    print("CRYOTRACK")
+
+    with parallel(evaluate, jobs) as evaluate:
+        if cache is None:
+            return evaluate(acquisitions)
+        return evaluate_cached(acquisitions, evaluate, cache, *mesh_hashes(data_path))
+
+
+def run_cryotrack_coverage(
+    iceball, data_path=DATA_PATH, spacing=1.0, n_probes=1, registration=None
+) -> pd.DataFrame:
+    """
+    Expected ice ball coverage of the target tumor and ice ball volume inside
+    every risk structure, for every acquisition or (with n_probes > 1) every
+    combination of n_probes acquisitions aimed at the same target.
+
+    :param iceball: coverage.Iceball with the isotherm dimensions of the probe
+    :param spacing: voxel size [mm]
+    :param registration: "rigid" or "similarity", see run_cryotrack_analysis
+    """
+    acquisitions = load_acquisitions(data_path)
+    _, tip_positions, entry_points, _ = load_points(data_path, registration)
+    tumor_meshes = load_tumor_meshes(data_path)
+    risk_meshes = load_risk_meshes(data_path)
+
+    print("CRYOTRACK COVERAGE")
+
+    target_ids = [acquisition.target_index for acquisition in acquisitions]
+    df = iceball_coverage(
+        [entry_points[acquisition.indices[0]] for acquisition in acquisitions],
+        [tip_positions[acquisition.indices[0]] for acquisition in acquisitions],
+        target_ids,
+        tumor_meshes,
+        risk_meshes,
+        iceball,
+        spacing,
+        probe_combinations(target_ids, n_probes) if n_probes > 1 else None,
+    )
+    names = [acquisition.name for acquisition in acquisitions]
+    df.insert(0, "name", [" + ".join(names[p] for p in probes) for probes in df["probes"]])
+    df.insert(1, "target", [acquisitions[probes[0]].target for probes in df["probes"]])
     return df
+
+
+def run_cryotrack_planning(
+    data_path=DATA_PATH,
+    n_candidates=4096,
+    cone_angle=45.0,
+    max_clearance=50.0,
+    tolerance=0.25,
+    registration=None,
+):
+    """
+    Planning benchmark: the safest straight trajectory to every target of
+    target.mrk.json, searched among n_candidates entry directions within
+    cone_angle [deg] of the mean direction of the acquisitions on that
+    target (on the whole sphere if None) at their mean depth, and the
+    clearance of every acquisition relative to it.
+
+    :param registration: "rigid" or "similarity", see run_cryotrack_analysis
+    :return: one row per target and one row per acquisition
+    """
+    acquisitions = load_acquisitions(data_path)
+    target_points, tip_positions, entry_points, _ = load_points(data_path, registration)
+    risk_meshes = load_risk_meshes(data_path)
+    field = ClearanceField(risk_meshes, max_clearance)
+
+    print("CRYOTRACK PLANNING")
+
+    tips = np.array([tip_positions[acquisition.indices[0]] for acquisition in acquisitions])
+    entries = np.array([entry_points[acquisition.indices[0]] for acquisition in acquisitions])
+    target_ids = np.array([acquisition.target_index for acquisition in acquisitions])
+    needles = entries - tips
+    depths = np.linalg.norm(needles, axis=1)
+
+    rows = []
+    for target_index, target_point in sorted(target_points.items()):
+        mask = target_ids == target_index
+        if not mask.any():
+            continue
+        axis = (needles[mask] / depths[mask, None]).mean(axis=0)
+        row = dict(target=f"t{target_index + 1}")
+        row.update(
+            safest_trajectory(
+                field,
+                target_point,
+                candidate_directions(n_candidates, axis, cone_angle),
+                depths[mask].mean(),
+                tolerance,
+            )
+        )
+        rows.append(row)
+    df_targets = pd.DataFrame(rows)
+
+    optimal = df_targets.set_index("target")["Clearance (optimal)"]
+    df_acquisitions = relative_clearances(
+        field, entries, tips, [optimal[acquisition.target] for acquisition in acquisitions], tolerance
+    )
+    df_acquisitions.insert(0, "name", [acquisition.name for acquisition in acquisitions])
+    df_acquisitions.insert(1, "target", [acquisition.target for acquisition in acquisitions])
+    return df_targets, df_acquisitions
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+from pathlib import Path
+import sys
+import time
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import click
+import numpy as np
+import vtk
+
+from .geometry import SurfaceIndex, build_risk_index, load_polydata, load_risk_models
+from .video_annotation.mha_sequence import MhaSequence
+
+Sample = Tuple[float, np.ndarray]
+
+
+class TipMonitor:
+    """
+    Distances of a tracked needle tip to the target tumor and to every risk
+    structure, evaluated one sample at a time, with the same risk index (and
+    sign convention) as the offline analysis. All locators and distance
+    functions are built up front, so that processing a sample only runs the
+    closest point queries (well below a millisecond each).
+    """
+
+    def __init__(self, tumor: Optional[vtk.vtkPolyData], risk_models: Dict[str, vtk.vtkPolyData]):
+        self.tumor = SurfaceIndex(tumor) if tumor is not None else None
+        risk_models = {name: m for name, m in risk_models.items() if m.GetNumberOfPolys() > 0}
+        self.risk_index = build_risk_index(risk_models)
+        self.risks = {name: SurfaceIndex(polydata) for name, polydata in risk_models.items()}
+        self.latencies = []
+
+    @staticmethod
+    def from_models(model_path, target=None):
+        """
+        :param model_path: models directory with tumor-<n>.vtk and risk
+                           structure meshes (e.g. data/cryotrack_validation/models)
+        :param target: number n of the target tumor, or None
+        """
+        tumor = None
+        if target is not None:
+            tumor = load_polydata(Path(model_path) / f"tumor-{target}.vtk")
+        return TipMonitor(tumor, load_risk_models(model_path))
+
+    def process(self, t, position) -> dict:
+        """
+        Signed distances of one tip position (negative inside); NaN while the
+        tip is not tracked. The processing latency is recorded.
+        """
+        start = time.perf_counter_ns()
+        position = np.asarray(position, dtype=float)
+        tracked = not np.isnan(position).any()
+        result = {"time": float(t)}
+        if self.tumor is not None:
+            result["Tumor"] = self.tumor.signed_distances(position)[0] if tracked else np.nan
+        for name, surface in self.risks.items():
+            result[name] = surface.signed_distances(position)[0] if tracked else np.nan
+        D_risk_min, nearest = np.nan, None
+        if tracked and self.risks:
+            D_risk_min, nearest, _ = self.risk_index.query(position)
+        result["D_risk_min"] = D_risk_min
+        result["Nearest risk"] = nearest
+        latency = (time.perf_counter_ns() - start) / 1e6
+        self.latencies.append(latency)
+        result["latency [ms]"] = latency
+        return result
+
+    def latency_percentiles(self, percentiles=(50, 95, 99)) -> Dict[str, float]:
+        if not self.latencies:
+            return {}
+        latencies = np.array(self.latencies)
+        stats = {f"p{p}": float(np.percentile(latencies, p)) for p in percentiles}
+        stats["max"] = float(latencies.max())
+        stats["samples"] = len(latencies)
+        return stats
+
+
+async def replay_sequence(path, transform, tip_offset=(0.0, 0.0, 0.0), speed=1.0) -> AsyncIterator[Sample]:
+    """
+    Tip positions of a recorded MHA sequence, paced by the frame timestamps
+    (divided by speed; speed=None replays as fast as possible).
+    """
+    timestamps, positions = MhaSequence(path).tip_trajectory(transform, tip_offset)
+    start = time.perf_counter()
+    for t, position in zip(timestamps, positions):
+        if speed:
+            delay = (t - timestamps[0]) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield t, position
+
+
+def format_sample(t, position) -> bytes:
+    return f"{t} {position[0]} {position[1]} {position[2]}\n".encode()
+
+
+def parse_sample(line: bytes) -> Sample:
+    values = line.split()
+    return float(values[0]), np.array([float(v) for v in values[1:4]])
+
+
+async def socket_source(host, port) -> AsyncIterator[Sample]:
+    """
+    Tip positions from a tracker stand-in that sends one "t x y z" line per
+    sample over TCP, until the connection is closed.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                yield parse_sample(line)
+    finally:
+        writer.close()
+
+
+async def serve_samples(source: AsyncIterator[Sample], host="127.0.0.1", port=18944):
+    """
+    Tracker stand-in: wait for one client and stream all samples of source to
+    it as "t x y z" lines.
+    """
+    done = asyncio.Event()
+
+    async def handle(reader, writer):
+        async for t, position in source:
+            writer.write(format_sample(t, position))
+            await writer.drain()
+        writer.close()
+        done.set()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await done.wait()
+
+
+async def run_monitor(source: AsyncIterator[Sample], monitor: TipMonitor, emit=None):
+    """
+    Process every sample of source as soon as it arrives and pass the result
+    to emit (if given).
+    """
+    async for t, position in source:
+        result = monitor.process(t, position)
+        if emit is not None:
+            emit(result)
+    return monitor.latency_percentiles()
+
+
+def emit_json(result):
+    print(json.dumps({k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in result.items()}))
+
+
+@click.group()
+def main():
+    """Live tip-to-tumor and tip-to-risk distance monitoring."""
+
+
+@main.command()
+@click.argument("sequence", type=click.Path(exists=True, dir_okay=False))
+@click.option("--models", "model_path", required=True, type=click.Path(exists=True, file_okay=False))
+@click.option("--target", type=int, default=None, help="Number of the target tumor (tumor-<n>.vtk).")
+@click.option("--transform", default="NeedleToTracker", show_default=True)
+@click.option("--tip-offset", nargs=3, type=float, default=(0.0, 0.0, 0.0), help="Tip position in tool coordinates.")
+@click.option("--speed", type=float, default=1.0, show_default=True, help="Replay speed, 0 for as fast as possible.")
+@click.option("--quiet", is_flag=True, help="Only report latency percentiles.")
+def replay(sequence, model_path, target, transform, tip_offset, speed, quiet):
+    """Replay the tip trajectory of a recorded MHA sequence."""
+    monitor = TipMonitor.from_models(model_path, target)
+    source = replay_sequence(sequence, transform, tip_offset, speed or None)
+    stats = asyncio.run(run_monitor(source, monitor, None if quiet else emit_json))
+    print(f"Latency [ms]: {stats}", file=sys.stderr)
+
+
+@main.command()
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=18944, show_default=True)
+@click.option("--models", "model_path", required=True, type=click.Path(exists=True, file_okay=False))
+@click.option("--target", type=int, default=None, help="Number of the target tumor (tumor-<n>.vtk).")
+@click.option("--quiet", is_flag=True, help="Only report latency percentiles.")
+def connect(host, port, model_path, target, quiet):
+    """Monitor "t x y z" samples streamed over TCP."""
+    monitor = TipMonitor.from_models(model_path, target)
+    stats = asyncio.run(run_monitor(socket_source(host, port), monitor, None if quiet else emit_json))
+    print(f"Latency [ms]: {stats}", file=sys.stderr)
+
+
+@main.command()
+@click.argument("sequence", type=click.Path(exists=True, dir_okay=False))
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=18944, show_default=True)
+@click.option("--transform", default="NeedleToTracker", show_default=True)
+@click.option("--tip-offset", nargs=3, type=float, default=(0.0, 0.0, 0.0))
+@click.option("--speed", type=float, default=1.0, show_default=True)
+def serve(sequence, host, port, transform, tip_offset, speed):
+    """Tracker stand-in streaming a recorded MHA sequence over TCP."""
+    asyncio.run(serve_samples(replay_sequence(sequence, transform, tip_offset, speed or None), host, port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import os
+from typing import Callable, List
+
+import pandas as pd
+
+# Evaluator of the current worker process, set once by init_worker
+worker_evaluate = None
+
+
+def init_worker(evaluate):
+    global worker_evaluate
+    worker_evaluate = evaluate
+
+
+def evaluate_chunk(items) -> List[dict]:
+    return worker_evaluate(items).to_dict("records")
+
+
+def split(items: List, n_chunks) -> List[List]:
+    """
+    Split items into at most n_chunks contiguous chunks of (almost) equal size.
+    """
+    n_chunks = max(1, min(n_chunks, len(items)))
+    size, remainder = divmod(len(items), n_chunks)
+    chunks, start = [], 0
+    for i in range(n_chunks):
+        stop = start + size + (i < remainder)
+        chunks.append(items[start:stop])
+        start = stop
+    return chunks
+
+
+class ParallelEvaluator:
+    """
+    Evaluates items (insertions, acquisitions) with a pool of `jobs` worker
+    processes. Every worker gets its own copy of `evaluate` once, when it
+    starts, so that meshes are loaded and locators built once per worker and
+    then reused for all chunks it is given. The items of every call are split
+    into contiguous chunks (tasks_per_job per worker, for load balancing) and
+    the rows are merged in the order of the items into one frame, so the
+    result is identical to evaluate(items).
+
+    Use as a context manager; other attributes (e.g. key) are those of
+    evaluate.
+    """
+
+    def __init__(self, evaluate: Callable, jobs=None, tasks_per_job=4):
+        self.evaluate = evaluate
+        self.jobs = jobs or os.cpu_count()
+        self.tasks_per_job = tasks_per_job
+        self.executor = None
+
+    def __enter__(self):
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.jobs, initializer=init_worker, initargs=(self.evaluate,)
+        )
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown()
+        self.executor = None
+
+    def __getattr__(self, name):
+        return getattr(self.evaluate, name)
+
+    def __call__(self, items) -> pd.DataFrame:
+        if self.executor is None:
+            raise Exception("ParallelEvaluator must be used as a context manager")
+        chunks = split(list(items), self.jobs * self.tasks_per_job)
+        # one frame from all rows, built like the serial one (same block layout)
+        rows = [row for chunk in self.executor.map(evaluate_chunk, chunks) for row in chunk]
+        return pd.DataFrame(rows)
+
+
+def parallel(evaluate: Callable, jobs=1):
+    """
+    Context manager yielding a ParallelEvaluator for evaluate, or evaluate
+    itself for jobs=1 (no worker processes).
+    """
+    if jobs == 1:
+        return nullcontext(evaluate)
+    return ParallelEvaluator(evaluate, jobs)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+import vtk
+
+from .geometry import SurfaceIndex
+
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
+
+
+def fibonacci_directions(n) -> np.ndarray:
+    """
+    n almost uniformly distributed unit vectors on the sphere, (n, 3).
+    """
+    return cone_directions((0.0, 0.0, 1.0), np.pi, n)
+
+
+def cone_directions(axis, half_angle, n) -> np.ndarray:
+    """
+    n almost uniformly distributed unit vectors within half_angle [rad] of
+    axis (a Fibonacci lattice on the spherical cap), (n, 3).
+    """
+    i = np.arange(n) + 0.5
+    z = 1 - (1 - np.cos(half_angle)) * i / n
+    r = np.sqrt(1 - z**2)
+    phi = i * GOLDEN_ANGLE
+    local = np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=1)
+
+    # rotate the z axis onto axis
+    axis = np.asarray(axis, dtype=float)
+    axis = axis / np.linalg.norm(axis)
+    helper = np.array([1.0, 0.0, 0.0]) if abs(axis[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+    u = np.cross(axis, helper)
+    u /= np.linalg.norm(u)
+    v = np.cross(axis, u)
+    return local @ np.stack([u, v, axis])
+
+
+class ClearanceField:
+    """
+    Signed distance to the closest risk structure (negative inside), exact up
+    to max_clearance: beyond that, a trajectory is considered equally safe.
+    Every structure has its own prebuilt distance function (locator); points
+    whose distance to a structure's bounding box already exceeds
+    max_clearance are not queried against it, and the box distance (a lower
+    bound) is used instead.
+    """
+
+    def __init__(self, models: Dict[str, vtk.vtkPolyData], max_clearance=50.0):
+        self.max_clearance = max_clearance
+        self.surfaces = {}
+        self.bounds = {}
+        for name, polydata in models.items():
+            if polydata.GetNumberOfPolys() == 0:
+                print(f"Risk structure {name} has no polygons and is ignored")
+                continue
+            self.surfaces[name] = SurfaceIndex(polydata)
+            self.bounds[name] = np.array(polydata.GetBounds()).reshape(3, 2)
+        self.queries = 0
+
+    def distances(self, points) -> np.ndarray:
+        """
+        Signed distances of all points to every structure, (M, S); exact
+        below max_clearance, lower bounds above.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        distances = np.full((len(points), len(self.surfaces)), np.inf)
+        for j, (name, surface) in enumerate(self.surfaces.items()):
+            lower, upper = self.bounds[name][:, 0], self.bounds[name][:, 1]
+            box_distance = np.linalg.norm(np.maximum(np.maximum(lower - points, points - upper), 0), axis=1)
+            near = np.flatnonzero(box_distance < self.max_clearance)
+            distances[:, j] = box_distance
+            if len(near):
+                distances[near, j] = surface.signed_distances(points[near])
+            self.queries += len(near)
+        return distances
+
+    def __call__(self, points) -> np.ndarray:
+        return self.distances(points).min(axis=1, initial=np.inf)
+
+    def nearest(self, point):
+        """
+        Clipped clearance of a point and the name of the closest structure
+        (None beyond max_clearance).
+        """
+        distances = self.distances(point)[0]
+        if len(distances) == 0 or distances.min() >= self.max_clearance:
+            return self.max_clearance, None
+        j = distances.argmin()
+        return distances[j], list(self.surfaces)[j]
+
+
+def segment_clearances(field: ClearanceField, starts, ends, tolerance=0.25, step=16.0, prune=False):
+    """
+    Minimum clearance along every segment, by branch and bound over all
+    segments at once: the distance field is 1-Lipschitz, so a sample at the
+    center of an interval of half width h bounds the minimum on the interval
+    from below by d - h (also where d is only a lower bound of the
+    distance, beyond max_clearance). Every round queries all remaining
+    interval centers in one batch and only splits intervals that may still lower their
+    segment's minimum by more than tolerance.
+
+    With prune=True, segments that can no longer beat the best one by more
+    than tolerance are dropped early (to find the safest of many
+    candidates); their clearance is then only an upper bound.
+
+    :return: clearances (N,) clipped at field.max_clearance, positions of
+             the minima (N, 3) and a mask of which clearances are exact (to
+             within tolerance)
+    """
+    starts = np.asarray(starts, dtype=float).reshape(-1, 3)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 3)
+    n = len(starts)
+    lengths = np.linalg.norm(ends - starts, axis=1)
+    directions = (ends - starts) / np.where(lengths > 0, lengths, 1)[:, None]
+
+    counts = np.maximum(np.ceil(lengths / step).astype(int), 1)
+    segment = np.repeat(np.arange(n), counts)
+    h = (lengths / (2 * counts))[segment]
+    t = (2 * (np.arange(len(segment)) - np.repeat(np.cumsum(counts) - counts, counts)) + 1) * h
+
+    clearances = np.full(n, np.inf)
+    minima = starts.copy()
+    exact = np.ones(n, dtype=bool)
+    while len(segment):
+        points = starts[segment] + directions[segment] * t[:, None]
+        d = field(points)
+        clipped = np.minimum(d, field.max_clearance)
+        np.minimum.at(clearances, segment, clipped)
+        is_min = clipped == clearances[segment]
+        minima[segment[is_min]] = points[is_min]
+
+        lower = d - h
+        keep = (lower < clearances[segment] - tolerance) & (h > tolerance / 2)
+        if prune:
+            lower_bounds = np.where(exact, clearances - tolerance, -np.inf)
+            np.minimum.at(lower_bounds, segment[keep], lower[keep])
+            # the segment with the best lower bound is within tolerance of the
+            # optimum unless another one may beat it by more than tolerance
+            best = lower_bounds.argmax()
+            candidate = clearances > lower_bounds[best] + tolerance
+            candidate[best] = True
+            exact &= candidate
+            keep &= candidate[segment]
+        segment, t, h = segment[keep], t[keep], h[keep] / 2
+        segment = np.repeat(segment, 2)
+        t = np.stack([t - h, t + h], axis=1).ravel()
+        h = np.repeat(h, 2)
+    return clearances, minima, exact
+
+
+def safest_trajectory(field: ClearanceField, target, directions, depth, tolerance=0.25) -> dict:
+    """
+    Safest straight trajectory to target among the candidate entry directions
+    (unit vectors pointing from the target towards the entry point), all
+    with the same depth [mm].
+    """
+    target = np.asarray(target, dtype=float)
+    entries = target + directions * depth
+    queries = field.queries
+    clearances, minima, exact = segment_clearances(
+        field, np.tile(target, (len(directions), 1)), entries, tolerance, prune=True
+    )
+    best = np.argmax(np.where(exact, clearances, -np.inf))
+    _, nearest = field.nearest(minima[best])
+    return {
+        "Clearance (optimal)": clearances[best],
+        "Nearest risk (optimal)": nearest,
+        "Entry point (optimal)": entries[best],
+        "Direction (optimal)": directions[best],
+        "Depth": depth,
+        "Candidates": len(directions),
+        "Distance queries": field.queries - queries,
+    }
+
+
+def candidate_directions(n_candidates, axis=None, cone_angle=None) -> np.ndarray:
+    """
+    Fibonacci directions on the whole sphere, or within cone_angle [deg] of
+    axis.
+    """
+    if cone_angle is None:
+        return fibonacci_directions(n_candidates)
+    if axis is None:
+        raise Exception("A cone of candidate directions needs an axis")
+    return cone_directions(axis, np.radians(cone_angle), n_candidates)
+
+
+def relative_clearances(field: ClearanceField, entries, finals, optimal, tolerance=0.25) -> pd.DataFrame:
+    """
+    Clearance of every actual insertion (along its whole path from entry to
+    final point) relative to the optimal clearance for its target. A
+    negative deficit means that the insertion stayed farther from the risk
+    structures than any trajectory ending at the target could, usually
+    because its tip missed the target.
+
+    :param optimal: (N,) optimal clearance of each insertion's target
+    """
+    clearances, minima, _ = segment_clearances(field, finals, entries, tolerance)
+    optimal = np.asarray(optimal, dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = clearances / optimal
+    return pd.DataFrame(
+        {
+            "Clearance": clearances,
+            "Nearest risk": [field.nearest(point)[1] for point in minima],
+            "Clearance (optimal)": optimal,
+            "Clearance deficit": optimal - clearances,
+            "Clearance ratio": ratio,
+        }
+    )
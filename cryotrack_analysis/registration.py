@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import json
+from typing import Dict
+
+import numpy as np
+
+
+def load_markup_points(path) -> Dict[int, np.ndarray]:
+    with open(path, "r") as f:
+        d = json.load(f)
+    controlPoints = d["markups"][0]["controlPoints"]
+    return {int(p["id"]): np.array(p["position"]) for p in controlPoints}
+
+
+def fiducial_pairs(source: Dict[int, np.ndarray], target: Dict[int, np.ndarray], pairs=None):
+    """
+    Corresponding fiducials as two (N, 3) arrays. Without explicit
+    pairs ({source id: target id}), fiducials are paired by id.
+    """
+    if pairs is None:
+        pairs = {i: i for i in sorted(source) if i in target}
+    if len(pairs) < 3:
+        raise Exception(f"At least 3 fiducial pairs are needed, got {len(pairs)}")
+    source_points = np.array([source[i] for i in pairs])
+    target_points = np.array([target[j] for j in pairs.values()])
+    return source_points, target_points
+
+
+def register_points(source, target, similarity=False):
+    """
+    Closed-form least-squares rigid (or similarity) transform mapping source
+    onto target (Umeyama). Works on stacks of point sets: source and target of
+    shape (..., N, 3) give transforms of shape (..., 4, 4).
+    """
+    source = np.asarray(source, dtype=float)
+    target = np.asarray(target, dtype=float)
+    source_mean = source.mean(axis=-2, keepdims=True)
+    target_mean = target.mean(axis=-2, keepdims=True)
+    a = source - source_mean
+    b = target - target_mean
+    covariance = np.swapaxes(b, -1, -2) @ a / source.shape[-2]
+    U, S, Vt = np.linalg.svd(covariance)
+    # avoid reflections
+    d = np.ones(S.shape)
+    d[..., 2] = np.sign(np.linalg.det(U @ Vt))
+    R = U @ (d[..., :, None] * Vt)
+    if similarity:
+        variance = (a**2).sum(axis=(-1, -2)) / source.shape[-2]
+        scale = (S * d).sum(axis=-1) / variance
+    else:
+        scale = np.ones(S.shape[:-1])
+    A = scale[..., None, None] * R
+    t = target_mean[..., 0, :] - (A @ source_mean[..., 0, :, None])[..., 0]
+    matrix = np.zeros(source.shape[:-2] + (4, 4))
+    matrix[..., :3, :3] = A
+    matrix[..., :3, 3] = t
+    matrix[..., 3, 3] = 1.0
+    return matrix
+
+
+def apply_transform(matrix, points):
+    """
+    Transform (..., 3) points with a 4x4 matrix (or a stack of matrices
+    broadcasting against the points).
+    """
+    points = np.asarray(points, dtype=float)
+    return points @ np.swapaxes(matrix[..., :3, :3], -1, -2) + matrix[..., None, :3, 3]
+
+
+def transform_positions(matrix, positions: Dict[int, np.ndarray]) -> Dict[int, np.ndarray]:
+    """
+    Transform a dict of markup positions with a single matrix multiply.
+    """
+    keys = list(positions)
+    points = apply_transform(matrix, np.array([positions[k] for k in keys]).reshape(-1, 3))
+    return dict(zip(keys, points))
+
+
+def fiducial_registration_error(matrix, source, target):
+    """
+    :return: RMS fiducial registration error and the per-fiducial residuals
+    """
+    residuals = np.linalg.norm(apply_transform(matrix, source) - target, axis=-1)
+    return np.sqrt(np.mean(residuals**2)), residuals
+
+
+def leave_one_out_tre(source, target, similarity=False):
+    """
+    Target registration error of every fiducial when it is left out of the
+    registration, with all N registrations solved as one batch.
+    """
+    source = np.asarray(source, dtype=float)
+    target = np.asarray(target, dtype=float)
+    n = len(source)
+    keep = ~np.eye(n, dtype=bool)
+    # row i holds all fiducials except fiducial i
+    matrices = register_points(
+        source[np.nonzero(keep)[1]].reshape(n, n - 1, 3),
+        target[np.nonzero(keep)[1]].reshape(n, n - 1, 3),
+        similarity,
+    )
+    predicted = apply_transform(matrices, source[:, None, :])[:, 0]
+    return np.linalg.norm(predicted - target, axis=-1)
+
+
+class LandmarkRegistration:
+    """
+    Registration from fiducial pairs, with its fiducial registration error
+    (FRE) and leave-one-out target registration error (TRE). rigid_matrix is
+    the rigid registration of the same fiducials, i.e. the matrix without the
+    scale of a similarity registration.
+    """
+
+    def __init__(self, source, target, similarity=False):
+        self.source = np.asarray(source, dtype=float)
+        self.target = np.asarray(target, dtype=float)
+        self.similarity = similarity
+        self.matrix = register_points(self.source, self.target, similarity)
+        self.rigid_matrix = register_points(self.source, self.target) if similarity else self.matrix
+        self.scale = float(np.cbrt(np.linalg.det(self.matrix[:3, :3])))
+        self.fre, self.residuals = fiducial_registration_error(
+            self.matrix, self.source, self.target
+        )
+        self.loo_tre = leave_one_out_tre(self.source, self.target, similarity)
+
+    @staticmethod
+    def from_markups(source_path, target_path, pairs=None, similarity=False):
+        source, target = fiducial_pairs(
+            load_markup_points(source_path), load_markup_points(target_path), pairs
+        )
+        return LandmarkRegistration(source, target, similarity)
+
+    def inverse(self):
+        return LandmarkRegistration(self.target, self.source, self.similarity)
+
+    def __str__(self):
+        kind = "similarity" if self.similarity else "rigid"
+        return (
+            f"Landmark registration ({kind}, {len(self.source)} fiducials): "
+            f"FRE={self.fre:.2f}, TRE (leave-one-out) mean={self.loo_tre.mean():.2f} "
+            f"max={self.loo_tre.max():.2f}"
+            + (f", scale={self.scale:.4f}" if self.similarity else "")
+        )
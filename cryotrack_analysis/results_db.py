@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import sqlite3
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from .cache import cache_key, file_hash
+from .facts import KEY, MODALITY, keyed_tables
+
+# Leading columns of every result table
+RECORD_COLUMNS = {"run_id": "INTEGER NOT NULL REFERENCES runs(run_id)", "study": "TEXT", "input_hash": "TEXT"}
+# Study tables that hold one row per insertion, with or without Cryotrack
+SOURCES = {"cryotrack": "with", "cryotrack_time": "with", "ctbaseline": "without", "ctbaseline_time": "without"}
+INDEXED_COLUMNS = {
+    "insertions": ["run_id", "study", "Operator", "target", "Plane", "Strokes"],
+    "summaries": ["run_id", "study"],
+    "statistics": ["run_id", "study"],
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created TEXT NOT NULL,
+    study TEXT NOT NULL,
+    data_path TEXT,
+    input_hash TEXT NOT NULL,
+    options TEXT
+);
+CREATE TABLE IF NOT EXISTS inputs (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    path TEXT NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inputs_run_id ON inputs (run_id);
+"""
+
+
+def quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_type(values: pd.Series) -> str:
+    # from the values, since e.g. a flag missing in some tables is an object column
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind in ("boolean", "integer"):
+        return "INTEGER"
+    if kind in ("floating", "mixed-integer-float"):
+        return "REAL"
+    return "TEXT"
+
+
+# Files of a study root the analysis reads, relative to it; recordings and
+# other large files next to them are not hashed
+INPUT_PATTERNS = [
+    "*/acquisitions.txt",
+    "*/timestamps.json",
+    "*/markups/*.mrk.json",
+    "*/models/*.vtk",
+    "*/video_bookmarks/*.xspf",
+]
+
+
+def input_hashes(data_path) -> Dict[str, str]:
+    """
+    Content hash of every input file of a study root (see INPUT_PATTERNS), by
+    path relative to it.
+    """
+    data_path = Path(data_path)
+    paths = {p for pattern in INPUT_PATTERNS for p in data_path.glob(pattern) if p.is_file()}
+    return {p.relative_to(data_path).as_posix(): file_hash(p) for p in sorted(paths)}
+
+
+class ResultsDB:
+    """
+    Local SQLite database to which every run appends its per-insertion,
+    summary and statistics results. Every record carries the run id, the
+    study and the hash of all the study's inputs; the per-file input hashes
+    of a run are kept in the inputs table.
+
+    Result tables grow a column for every new metric, so that dashboards can
+    query metrics by name. All writes of a run go through executemany in a
+    single transaction, so a run is either stored completely or not at all.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+            for table, columns in INDEXED_COLUMNS.items():
+                self._create_table(table)
+                for column in columns:
+                    self.connection.execute(
+                        f"CREATE INDEX IF NOT EXISTS {quote(f'{table}_{column}')} "
+                        f"ON {quote(table)} ({quote(column)})"
+                    )
+
+    def _create_table(self, table):
+        columns = dict(RECORD_COLUMNS)
+        if table == "insertions":
+            columns.update({"source": "TEXT", MODALITY: "TEXT"})
+            columns.update({column: "TEXT" for column in KEY})
+            columns["attempt"] = "INTEGER"
+        definition = ", ".join(f"{quote(name)} {kind}" for name, kind in columns.items())
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {quote(table)} ({definition})")
+
+    def columns(self, table):
+        return [row[1] for row in self.connection.execute(f"PRAGMA table_info({quote(table)})")]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _append(self, table, df: pd.DataFrame, run_id, study, input_hash):
+        if df is None or len(df) == 0:
+            return
+        df = df.reset_index(drop=True)
+        existing = set(self.columns(table))
+        for column in df.columns:
+            if column not in existing:
+                self.connection.execute(
+                    f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {sql_type(df[column])}"
+                )
+        columns = list(RECORD_COLUMNS) + list(df.columns)
+        # to_dict converts numpy scalars to Python ones; NaN is stored as NULL
+        rows = [
+            (run_id, study, input_hash, *row)
+            for row in df.astype(object).where(df.notna(), None).to_dict("split")["data"]
+        ]
+        self.connection.executemany(
+            f"INSERT INTO {quote(table)} ({', '.join(quote(c) for c in columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})",
+            rows,
+        )
+
+    def record_run(
+        self,
+        study,
+        data_path,
+        tables: Dict[str, pd.DataFrame],
+        summaries: Optional[pd.DataFrame] = None,
+        statistics: Optional[pd.DataFrame] = None,
+        options: Optional[dict] = None,
+    ) -> int:
+        """
+        Append the results of one run of one study and return its run id.
+
+        :param tables: study tables (see batch.load_study), stored as one
+                       insertions table with normalised key columns,
+                       harmonised metric names (see facts.keyed_tables) and
+                       the name of the table in "source"
+        :param summaries: group means, e.g. analysis.summary_means
+        :param statistics: permutation tests, see statistics.run_statistics
+        """
+        hashes = input_hashes(data_path)
+        input_hash = cache_key(*sorted(hashes.items()))
+        insertions = pd.concat(
+            [
+                df.reset_index().assign(source=name, **{MODALITY: SOURCES[name]})
+                for name, df in keyed_tables(tables).items()
+            ],
+            ignore_index=True,
+        ) if tables else None
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (created, study, data_path, input_hash, options) VALUES (?, ?, ?, ?, ?)",
+                (
+                    datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                    study,
+                    str(Path(data_path).resolve()),
+                    input_hash,
+                    json.dumps(options or {}),
+                ),
+            )
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO inputs (run_id, path, hash) VALUES (?, ?, ?)",
+                [(run_id, path, h) for path, h in hashes.items()],
+            )
+            self._append("insertions", insertions, run_id, study, input_hash)
+            self._append("summaries", summaries, run_id, study, input_hash)
+            self._append("statistics", statistics, run_id, study, input_hash)
+        return run_id
+
+    def query(self, sql, params=()) -> pd.DataFrame:
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def runs(self, study=None) -> pd.DataFrame:
+        if study is None:
+            return self.query("SELECT * FROM runs ORDER BY run_id")
+        return self.query("SELECT * FROM runs WHERE study = ? ORDER BY run_id", (study,))
+
+    def latest_run(self, study=None) -> Optional[int]:
+        if study is None:
+            row = self.connection.execute("SELECT MAX(run_id) FROM runs").fetchone()
+        else:
+            row = self.connection.execute("SELECT MAX(run_id) FROM runs WHERE study = ?", (study,)).fetchone()
+        return row[0]
+
+    def _select(self, table, run="latest", study=None, **filters) -> pd.DataFrame:
+        conditions, params = [], []
+        if run == "latest":
+            run = self.latest_run(study)
+        if run is not None and run != "all":
+            conditions.append("run_id = ?")
+            params.append(run)
+        if study is not None:
+            conditions.append("study = ?")
+            params.append(study)
+        for column, value in filters.items():
+            if value is None:
+                continue
+            values = [value] if isinstance(value, (str, int, float, np.integer)) else list(value)
+            conditions.append(f"{quote(column)} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self.query(f"SELECT * FROM {quote(table)}{where} ORDER BY rowid", params)
+
+    def insertions(
+        self, run="latest", study=None, source=None, operator=None, target=None, plane=None, strokes=None
+    ) -> pd.DataFrame:
+        """
+        Per-insertion results of a run (the latest one by default, "all" for
+        every run), with all columns of the table; metrics a run did not
+        record are NULL. Every filter is a single value or a list of values,
+        in normalised form (e.g. plane "ip"/"op", target "t1").
+        """
+        return self._select(
+            "insertions", run, study, source=source, Operator=operator, target=target, Plane=plane, Strokes=strokes
+        )
+
+    def summaries(self, run="latest", study=None) -> pd.DataFrame:
+        return self._select("summaries", run, study)
+
+    def statistics(self, run="latest", study=None) -> pd.DataFrame:
+        return self._select("statistics", run, study)
+
+    def __str__(self):
+        n_runs = self.connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+        return f"Results database {self.path}: {n_runs} runs"
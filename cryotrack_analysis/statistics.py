@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .facts import normalize_key_columns
+
+# Accuracy metrics shared by both insertion tables, named as in
+# facts.HARMONIZED_COLUMNS
+ACCURACY_METRICS = [
+    "Euclidean Error (final)",
+    "Lateral Error",
+    "Euclidean (tip to tumor)",
+    "Signed (tip to tumor)",
+    "Tip in tumor",
+    "D_risk_min",
+]
+TIME_METRICS = ["time [s]"]
+
+
+def group_sums(codes, values, weights, n_groups):
+    """
+    Per-group weighted sums, counts and sums of squares of all value columns
+    for a stack of label vectors.
+
+    :param codes: (P, N) group codes, one row per labelling
+    :param values: (N, M) metric values, NaN replaced by 0
+    :param weights: (N, M) 1 for valid values, 0 for missing ones
+    :return: three (P, K, M) arrays
+    """
+    one_hot = (codes[:, None, :] == np.arange(n_groups)[None, :, None]).astype(float)
+    return one_hot @ weights, one_hot @ values, one_hot @ values**2
+
+
+def group_statistics(codes, values, weights, n_groups):
+    """
+    Difference of the group means (second minus first group) for two groups,
+    between-group sum of squares otherwise. Shape (P, M).
+    """
+    counts, sums, _ = group_sums(codes, values, weights, n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    if n_groups == 2:
+        return means[:, 1] - means[:, 0]
+    grand_mean = values.sum(axis=0) / weights.sum(axis=0)
+    return np.nansum(counts * (means - grand_mean) ** 2, axis=1)
+
+
+def count_exceedances(codes, values, weights, n_groups, observed, n_permutations, seed):
+    """
+    Worker for one shard: number of permuted labellings whose statistic is at
+    least as extreme as the observed one.
+    """
+    rng = np.random.default_rng(seed)
+    permuted = rng.permuted(np.tile(codes, (n_permutations, 1)), axis=1)
+    statistics = group_statistics(permuted, values, weights, n_groups)
+    if n_groups == 2:
+        return (np.abs(statistics) >= np.abs(observed) - 1e-12).sum(axis=0)
+    return (statistics >= observed - 1e-12).sum(axis=0)
+
+
+def effect_sizes(codes, values, weights, n_groups):
+    """
+    Cohen's d (pooled standard deviation) for two groups, eta squared
+    otherwise.
+    """
+    counts, sums, squares = group_sums(codes[None], values, weights, n_groups)
+    counts, sums, squares = counts[0], sums[0], squares[0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        within = (squares - counts * means**2).sum(axis=0)
+        if n_groups == 2:
+            pooled = np.sqrt(within / (counts.sum(axis=0) - 2))
+            return "Cohen's d", (means[1] - means[0]) / pooled
+        n = weights.sum(axis=0)
+        total = (values**2).sum(axis=0) - (values.sum(axis=0)) ** 2 / n
+        return "eta^2", 1 - within / total
+
+
+def permutation_test(
+    df: pd.DataFrame,
+    group,
+    columns: List[str],
+    n_permutations=10000,
+    seed=0,
+    jobs=None,
+    shard_size=2500,
+    executor: Optional[Executor] = None,
+) -> pd.DataFrame:
+    """
+    Permutation test of every metric column against the labels in the column
+    `group`, with all metrics and all permutations of a shard evaluated by
+    matrix products. Shards are spread over the given executor, or else over
+    `jobs` worker processes (in-process if jobs=1), and each shard has its
+    own seed, so the p-values only depend on seed and shard_size, not on the
+    number of jobs.
+    """
+    columns = [c for c in columns if c in df.columns]
+    df = df[df[group].notna()]
+    levels = sorted(df[group].unique(), key=str)
+    codes = pd.Categorical(df[group], categories=levels).codes.astype(np.int64)
+    values = df[columns].astype(float).to_numpy()
+    weights = (~np.isnan(values)).astype(float)
+    values = np.nan_to_num(values)
+    n_groups = len(levels)
+    if n_groups < 2:
+        return pd.DataFrame()
+
+    observed = group_statistics(codes[None], values, weights, n_groups)[0]
+    shards = [shard_size] * (n_permutations // shard_size)
+    if n_permutations % shard_size:
+        shards.append(n_permutations % shard_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(shards))
+    args = [(codes, values, weights, n_groups, observed, n, s) for n, s in zip(shards, seeds)]
+    if len(shards) == 1 or (executor is None and jobs == 1):
+        exceedances = [count_exceedances(*a) for a in args]
+    elif executor is not None:
+        exceedances = list(executor.map(count_exceedances, *zip(*args)))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            exceedances = list(executor.map(count_exceedances, *zip(*args)))
+    p_values = (1 + np.sum(exceedances, axis=0)) / (n_permutations + 1)
+
+    effect_size_name, effect_size = effect_sizes(codes, values, weights, n_groups)
+    return pd.DataFrame(
+        dict(
+            grouping=group,
+            groups=" vs ".join(str(level) for level in levels),
+            metric=columns,
+            n=weights.sum(axis=0).astype(int),
+            statistic="mean difference" if n_groups == 2 else "between-group SS",
+            observed=observed,
+            effect_size_name=effect_size_name,
+            effect_size=effect_size,
+            p_value=p_values,
+        )
+    )
+
+
+def comparison_datasets(tables: Dict[str, pd.DataFrame]):
+    """
+    Accuracy and time tables with harmonized column names and plane spellings,
+    each with the groupings to test on it.
+    """
+    cryotrack = normalize_key_columns(tables["cryotrack"])
+    ctbaseline = normalize_key_columns(tables["ctbaseline"])
+    cryotrack_time = normalize_key_columns(tables["cryotrack_time"])
+    ctbaseline_time = normalize_key_columns(tables["ctbaseline_time"])
+    accuracy = pd.concat(
+        [cryotrack.assign(Cryotrack="with"), ctbaseline.assign(Cryotrack="without")],
+        ignore_index=True,
+    )
+    time = pd.concat(
+        [cryotrack_time.assign(Cryotrack="with"), ctbaseline_time.assign(Cryotrack="without")],
+        ignore_index=True,
+    )
+    return [
+        ("accuracy", accuracy, ["Cryotrack"], ACCURACY_METRICS),
+        ("time", time, ["Cryotrack"], TIME_METRICS),
+        ("cryotrack", cryotrack, ["Operator", "Plane"], ACCURACY_METRICS),
+        ("cryotrack_time", cryotrack_time, ["Operator", "Plane"], TIME_METRICS),
+        ("ctbaseline", ctbaseline, ["Plane", "Strokes"], ACCURACY_METRICS),
+        ("ctbaseline_time", ctbaseline_time, ["Plane", "Strokes"], TIME_METRICS),
+    ]
+
+
+def run_statistics(
+    tables: Dict[str, pd.DataFrame], n_permutations=10000, seed=0, jobs=None, shard_size=2500
+) -> pd.DataFrame:
+    """
+    p-values and effect sizes of all metrics for with vs without Cryotrack,
+    operator, plane and strokes. All tests share one pool of `jobs` worker
+    processes, which is only started if there is more than one shard.
+    """
+    if jobs == 1 or n_permutations <= shard_size:
+        pool = nullcontext()
+    else:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+    results = []
+    with pool as executor:
+        for name, df, groupings, metrics in comparison_datasets(tables):
+            for group in groupings:
+                result = permutation_test(
+                    df, group, metrics, n_permutations, seed, jobs, shard_size, executor
+                )
+                result.insert(0, "dataset", name)
+                results.append(result)
+    return pd.concat(results, ignore_index=True)
@@ -0,0 +1,174 @@
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+
+def chunked(iterable: Iterable, chunk_size) -> Iterable[List]:
+    """
+    Split an iterable into lists of at most chunk_size elements. With
+    chunk_size=None, everything ends up in a single chunk.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class StreamingAggregate:
+    """
+    Per-group summary statistics of a set of value columns, updated one chunk
+    at a time. For every (group, column) it keeps the count, mean, sum of
+    squared deviations (merged with Chan's parallel update), extrema and a
+    sparse histogram with fixed bin width, from which quantiles and boxplot
+    statistics are estimated to within half a bin width.
+
+    Memory depends on the number of groups and on the value range, but not on
+    the number of rows.
+    """
+
+    def __init__(self, by, columns, bin_width=0.1):
+        self.by = list(by)
+        self.columns = list(columns)
+        self.bin_width = bin_width
+        self.stats = {}
+
+    def update(self, df: pd.DataFrame):
+        columns = [c for c in self.columns if c in df.columns]
+        for key, sub in df.groupby(self.by, sort=False):
+            for column in columns:
+                values = sub[column].to_numpy(dtype=float)
+                values = values[~np.isnan(values)]
+                if len(values) == 0:
+                    continue
+                self._update(key, column, values)
+        return self
+
+    def _update(self, key, column, values):
+        s = self.stats.setdefault(
+            (key, column),
+            dict(count=0, mean=0.0, m2=0.0, min=np.inf, max=-np.inf, hist={}),
+        )
+        n_b = len(values)
+        mean_b = values.mean()
+        m2_b = ((values - mean_b) ** 2).sum()
+        n = s["count"] + n_b
+        delta = mean_b - s["mean"]
+        s["mean"] += delta * n_b / n
+        s["m2"] += m2_b + delta**2 * s["count"] * n_b / n
+        s["count"] = n
+        s["min"] = min(s["min"], values.min())
+        s["max"] = max(s["max"], values.max())
+        bins, counts = np.unique(
+            np.floor(values / self.bin_width).astype(np.int64), return_counts=True
+        )
+        hist = s["hist"]
+        for b, c in zip(bins.tolist(), counts.tolist()):
+            hist[b] = hist.get(b, 0) + c
+
+    def groups(self):
+        return sorted({key for key, _ in self.stats})
+
+    def _table(self, f) -> pd.DataFrame:
+        keys = self.groups()
+        data = {
+            column: [
+                f(self.stats[(key, column)]) if (key, column) in self.stats else np.nan
+                for key in keys
+            ]
+            for column in self.columns
+        }
+        if len(self.by) == 1:
+            index = pd.Index([key[0] for key in keys], name=self.by[0])
+        else:
+            index = pd.MultiIndex.from_tuples(keys, names=self.by)
+        return pd.DataFrame(data, index=index)
+
+    def count(self) -> pd.DataFrame:
+        return self._table(lambda s: s["count"])
+
+    def mean(self) -> pd.DataFrame:
+        return self._table(lambda s: s["mean"])
+
+    def std(self) -> pd.DataFrame:
+        # sample standard deviation, like pandas
+        return self._table(
+            lambda s: np.sqrt(s["m2"] / (s["count"] - 1)) if s["count"] > 1 else np.nan
+        )
+
+    def _order_statistic(self, s, k):
+        """
+        k-th smallest value, approximated by the center of its histogram bin.
+        """
+        if k == 0:
+            return s["min"]
+        if k == s["count"] - 1:
+            return s["max"]
+        bins = sorted(s["hist"])
+        cumulative = np.cumsum([s["hist"][b] for b in bins])
+        i = np.searchsorted(cumulative, k, side="right")
+        return float(np.clip((bins[i] + 0.5) * self.bin_width, s["min"], s["max"]))
+
+    def quantile(self, key, column, q):
+        """
+        q-quantile with linear interpolation between order statistics, like
+        np.quantile, accurate to half a bin width.
+        """
+        s = self.stats[(key, column)]
+        rank = q * (s["count"] - 1)
+        lo = int(np.floor(rank))
+        hi = int(np.ceil(rank))
+        v_lo = self._order_statistic(s, lo)
+        v_hi = self._order_statistic(s, hi)
+        return v_lo + (rank - lo) * (v_hi - v_lo)
+
+    def boxplot_stats(self, key, column, whis=1.5):
+        """
+        Statistics in the format expected by matplotlib's Axes.bxp. Fliers are
+        represented by the centers of the histogram bins outside the whiskers.
+        """
+        s = self.stats[(key, column)]
+        q1 = self.quantile(key, column, 0.25)
+        med = self.quantile(key, column, 0.5)
+        q3 = self.quantile(key, column, 0.75)
+        iqr = q3 - q1
+        centers = np.clip(
+            (np.array(sorted(s["hist"])) + 0.5) * self.bin_width, s["min"], s["max"]
+        )
+        inside = centers[(centers >= q1 - whis * iqr) & (centers <= q3 + whis * iqr)]
+        whislo = inside.min() if len(inside) else q1
+        whishi = inside.max() if len(inside) else q3
+        fliers = centers[(centers < whislo) | (centers > whishi)]
+        return dict(
+            med=med,
+            q1=q1,
+            q3=q3,
+            whislo=min(whislo, q1),
+            whishi=max(whishi, q3),
+            fliers=fliers,
+            mean=s["mean"],
+        )
+
+
+def write_parquet_dataset(chunks: Iterable[pd.DataFrame], path, aggregates=()):
+    """
+    Append every chunk as a separate part file to the Parquet dataset in the
+    directory `path` and feed it to the given StreamingAggregate instances.
+    The dataset can be read back as a whole with pd.read_parquet(path).
+    Returns the number of rows written.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    for old_part in path.glob("part-*.parquet"):
+        old_part.unlink()
+    n_rows = 0
+    for i, chunk in enumerate(chunks):
+        chunk.to_parquet(path / f"part-{i:05d}.parquet", index=False)
+        for aggregate in aggregates:
+            aggregate.update(chunk)
+        n_rows += len(chunk)
+    return n_rows
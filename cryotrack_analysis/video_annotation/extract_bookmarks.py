@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
-from typing import List, Dict
+from pathlib import Path
+from typing import List, Dict, Tuple
 import xml.etree.ElementTree as ET
 
 import click
 import pandas as pd
 
+# Bookmark marking the first tracked frame of an MHA recording in the video,
+# either "SYNC" or "SYNC_<recording>" (see sync.py)
+SYNC_EVENT = "SYNC"
+
 
 def convert_time_string_to_ms(s: str) -> float:
     """
@@ -36,8 +41,9 @@ def record_to_dict(record: List) -> Dict:
     operator = tokens[2]
     plane = tokens[3]
     attempt = 1
-    if len(tokens) > 4:
-        attempt = tokens[4]
+    # e.g. "P_t3_HK_oop_003"; trailing tokens like "invalid" are kept in the name only
+    if len(tokens) > 4 and tokens[4].isdigit():
+        attempt = int(tokens[4])
     return {
         "name": name,
         "t": t,
@@ -49,15 +55,27 @@ def record_to_dict(record: List) -> Dict:
     }
 
 
-def parse_bookmarks_record(bookmarks: str) -> List[Dict]:
+def parse_bookmark_times(bookmarks: str) -> List[Tuple[str, float]]:
+    """
+    (name, time [ms]) of every bookmark in a VLC bookmarks option.
+    """
     records = bookmarks.split("},")
     records = [record[1:] for record in records]
     pairs = [record.split(",time=") for record in records]
-    dicts = [
-        record_to_dict((pair[0][len("name=") :], convert_time_string_to_ms(pair[1])))
-        for pair in pairs
+    return [(pair[0][len("name=") :], convert_time_string_to_ms(pair[1])) for pair in pairs]
+
+
+def is_sync_event(name: str) -> bool:
+    return name == SYNC_EVENT or name.startswith(SYNC_EVENT + "_")
+
+
+def parse_bookmarks_record(bookmarks: str) -> List[Dict]:
+    # sync events only tie the video to the tracker clock, see sync.py
+    return [
+        record_to_dict(record)
+        for record in parse_bookmark_times(bookmarks)
+        if not is_sync_event(record[0])
     ]
-    return dicts
 
 
 def group_insertions(dicts: List[Dict]) -> pd.DataFrame:
@@ -90,8 +108,10 @@ def group_insertions(dicts: List[Dict]) -> pd.DataFrame:
     return result
 
 
-def extract_bookmarks_from_playlist(filename: str, exclude_invalid=True) -> pd.DataFrame:
+def playlist_bookmarks(filename: str) -> List[str]:
     """
+    Bookmarks option of every track of a VLC playlist.
+
     :param filename: Path to *.xspf file
     """
     tree = ET.parse(filename)
@@ -100,16 +120,35 @@ def extract_bookmarks_from_playlist(filename: str, exclude_invalid=True) -> pd.D
 
     trackList = playlist.find("{http://xspf.org/ns/0/}trackList")
     tracks = trackList.findall("{http://xspf.org/ns/0/}track")
-    # we typically only have a single track inside a playlist file
-    dfs = []
+    bookmarks = []
     for track in tracks:
         extension = track.find("{http://xspf.org/ns/0/}extension")
         option = extension.find("{http://www.videolan.org/vlc/playlist/ns/0/}option")
-        bookmarks = option.text[len("bookmarks=") :]
+        bookmarks.append(option.text[len("bookmarks=") :])
+    return bookmarks
+
+
+def extract_bookmarks_from_playlist(filename: str, exclude_invalid=True) -> pd.DataFrame:
+    """
+    :param filename: Path to *.xspf file
+    """
+    # we typically only have a single track inside a playlist file
+    dfs = []
+    for bookmarks in playlist_bookmarks(filename):
         dicts = parse_bookmarks_record(bookmarks)
         insertions = group_insertions(dicts)
         df = pd.DataFrame(insertions)
         if exclude_invalid:
             df = df[~df.name.str.contains("invalid")]
         dfs.append(df)
-    return dfs
\ No newline at end of file
+    return dfs
+
+
+def extract_bookmarks_from_folder(folder, exclude_invalid=True) -> pd.DataFrame:
+    """
+    :param folder: Directory containing one *.xspf playlist per video
+    """
+    dfs = []
+    for path in sorted(Path(folder).glob("*.xspf")):
+        dfs.extend(extract_bookmarks_from_playlist(path, exclude_invalid=exclude_invalid))
+    return pd.concat(dfs)
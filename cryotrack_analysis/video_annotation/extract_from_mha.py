@@ -2,6 +2,8 @@ from pathlib import Path
 import json
 import pandas as pd
 
+from .mha_sequence import MhaSequence
+
 
 def extract_timestamps_from_sequences(input_folder):
     """
@@ -12,27 +14,13 @@ def extract_timestamps_from_sequences(input_folder):
     end_timestamps = []
 
     # Timestamps are written like : Seq_Frame*_Timestamp = value
-    # For each file, get the name, starting time and end time
+    # For each file, get the name, starting time and end time. Only the
+    # header is read, not the image data.
     for filename in Path(input_folder).glob("*.mha"):
         file_names.append(filename.stem)
-        with open(filename, "r") as f:
-            lines = f.readlines()
-            # find the first instance of Seq_Frame*_Timestamp
-            start_timestamp = None
-            end_timestamp = None
-            for line in lines:
-                if "Seq_Frame" in line and "Timestamp" in line:
-                    start_timestamp = float(line.split("=")[1].strip())
-                    break
-
-            # find the last instance of Seq_Frame*_Timestamp
-            for line in reversed(lines):
-                if "Seq_Frame" in line and "Timestamp" in line:
-                    end_timestamp = float(line.split("=")[1].strip())
-                    break
-
-            start_timestamps.append(start_timestamp)
-            end_timestamps.append(end_timestamp)
+        timestamps = MhaSequence(filename).timestamps
+        start_timestamps.append(timestamps[0] if len(timestamps) else None)
+        end_timestamps.append(timestamps[-1] if len(timestamps) else None)
 
     # Create a dict with the data
     # (file_name, start_timestamp, end_timestamp, duration)
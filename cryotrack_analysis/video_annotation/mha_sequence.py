@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+from pathlib import Path
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# MetaImage element types, see https://itk.org/Wiki/ITK/MetaIO/Documentation
+ELEMENT_TYPES = {
+    "MET_CHAR": np.int8,
+    "MET_UCHAR": np.uint8,
+    "MET_SHORT": np.int16,
+    "MET_USHORT": np.uint16,
+    "MET_INT": np.int32,
+    "MET_UINT": np.uint32,
+    "MET_LONG": np.int32,
+    "MET_ULONG": np.uint32,
+    "MET_LONG_LONG": np.int64,
+    "MET_ULONG_LONG": np.uint64,
+    "MET_FLOAT": np.float32,
+    "MET_DOUBLE": np.float64,
+}
+
+# The text header is read in blocks of this size until its last entry
+HEADER_BLOCK_SIZE = 1 << 20
+
+FRAME_FIELD_NAME = re.compile(r"Seq_Frame\d+_([^\s=]+)")
+
+
+def nearest_frames(timestamps, t, tolerance=None):
+    """
+    Index of the frame closest in time to every t (scalar or array), all at
+    once with one np.searchsorted over the sorted timestamps. With a
+    tolerance [s], times further outside the recording get index -1.
+    """
+    t = np.asarray(t, dtype=float)
+    if len(timestamps) == 0:
+        return np.full(t.shape, -1)
+    if len(timestamps) == 1:
+        frames = np.zeros(t.shape, dtype=int)
+    else:
+        i = np.clip(np.searchsorted(timestamps, t), 1, len(timestamps) - 1)
+        before = timestamps[i - 1]
+        after = timestamps[i]
+        frames = np.where(t - before <= after - t, i - 1, i)
+    if tolerance is not None:
+        outside = (t < timestamps[0] - tolerance) | (t > timestamps[-1] + tolerance)
+        frames = np.where(outside, -1, frames)
+    return frames
+
+
+class MhaSequence:
+    """
+    Tracked ultrasound sequence stored as MetaImage (*.mha / *.mhd) file, as
+    written by PLUS. Only the text header is parsed on construction; the
+    pixel data is exposed as a read-only np.memmap of shape
+    (frames, rows, columns[, channels]), so slicing frames only reads the
+    requested part of the file.
+
+    Per-frame header entries (Seq_FrameNNNN_<field> = value) are extracted on
+    demand with frame_field(<field>), one regular expression pass per field,
+    which keeps sequences with tens of thousands of frames fast to open.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.fields: Dict[str, str] = {}
+        self._frame_fields: Dict[str, Tuple[List[str], np.ndarray]] = {}
+        self._frames = None
+        self.read_header()
+        self.timestamps = self.frame_field_as_array("Timestamp")
+
+    def read_header(self):
+        # Read the text header in blocks; ElementDataFile is always its last entry
+        keyword = b"ElementDataFile"
+        header = bytearray()
+        i = -1
+        with open(self.path, "rb") as f:
+            while True:
+                block = f.read(HEADER_BLOCK_SIZE)
+                if not block:
+                    raise Exception(f"{self.path} has no ElementDataFile entry")
+                start = len(header)
+                header += block
+                if i < 0:
+                    i = header.find(keyword, max(0, start - len(keyword)))
+                if i >= 0:
+                    # its line may end in a later block than the keyword
+                    newline = header.find(b"\n", max(i, start))
+                    if newline >= 0:
+                        self.header_end = newline + 1
+                        break
+        self.header = header[: self.header_end].decode("latin-1")
+        for line in self.header.splitlines():
+            if line.startswith("Seq_Frame"):
+                continue
+            key, _, value = line.partition("=")
+            if key.strip():
+                self.fields[key.strip()] = value.strip()
+
+    def frame_field_names(self):
+        return list(dict.fromkeys(FRAME_FIELD_NAME.findall(self.header)))
+
+    def frame_field(self, field) -> List[str]:
+        """
+        Raw values of Seq_FrameNNNN_<field> for all frames that have it, in
+        frame order.
+        """
+        if field not in self._frame_fields:
+            pattern = re.compile(r"Seq_Frame(\d+)_" + re.escape(field) + r" *= *([^\r\n]*)")
+            matches = pattern.findall(self.header)
+            indices = np.array([int(i) for i, _ in matches], dtype=int)
+            values = [value.rstrip() for _, value in matches]
+            if np.any(np.diff(indices) < 0):
+                order = np.argsort(indices, kind="stable")
+                values = [values[i] for i in order]
+                indices = indices[order]
+            self._frame_fields[field] = (values, indices)
+        return self._frame_fields[field][0]
+
+    def frame_indices(self, field) -> np.ndarray:
+        """
+        Frame numbers NNNN of the values of frame_field(field).
+        """
+        self.frame_field(field)
+        return self._frame_fields[field][1]
+
+    def timestamp_rows(self, field) -> np.ndarray:
+        """
+        Index into timestamps of the frame of every value of
+        frame_field(field), -1 for frames without a Timestamp.
+        """
+        frames = self.frame_indices("Timestamp")
+        indices = self.frame_indices(field)
+        if len(frames) == 0:
+            return np.full(len(indices), -1)
+        rows = np.minimum(np.searchsorted(frames, indices), len(frames) - 1)
+        return np.where(frames[rows] == indices, rows, -1)
+
+    @property
+    def dim_size(self):
+        return [int(d) for d in self.fields["DimSize"].split()]
+
+    @property
+    def number_of_frames(self):
+        return self.dim_size[-1]
+
+    @property
+    def dtype(self):
+        dtype = np.dtype(ELEMENT_TYPES[self.fields["ElementType"]])
+        msb = self.fields.get(
+            "BinaryDataByteOrderMSB", self.fields.get("ElementByteOrderMSB", "False")
+        )
+        return dtype.newbyteorder(">" if msb.lower() == "true" else "<")
+
+    @property
+    def shape(self):
+        # DimSize is fastest-varying first, i.e. columns rows frames
+        shape = tuple(reversed(self.dim_size))
+        channels = int(self.fields.get("ElementNumberOfChannels", 1))
+        if channels > 1:
+            shape = shape + (channels,)
+        return shape
+
+    def frame_field_as_array(self, field, dtype=float):
+        return np.array(self.frame_field(field), dtype=dtype)
+
+    def transform_names(self):
+        """
+        Names of all tracked transforms, e.g. "ProbeToTracker" for
+        Seq_FrameNNNN_ProbeToTrackerTransform entries.
+        """
+        return [
+            field[: -len("Transform")]
+            for field in self.frame_field_names()
+            if field.endswith("Transform")
+        ]
+
+    def transforms(self, name):
+        """
+        All per-frame matrices of one transform, parsed in a single pass and
+        aligned with timestamps by frame number.
+
+        :return: (F, 4, 4) transforms and (F,) boolean validity for the F
+                 frames with a Timestamp. Frames without the transform are
+                 NaN and invalid, as are frames whose <name>TransformStatus
+                 is not OK.
+        """
+        values = self.frame_field(f"{name}Transform")
+        if not values:
+            raise Exception(f"No transform {name} in {self.path}")
+        parsed = np.fromstring(" ".join(values), sep=" ").reshape(len(values), 4, 4)
+        rows = self.timestamp_rows(f"{name}Transform")
+        matrices = np.full((len(self.timestamps), 4, 4), np.nan)
+        valid = np.zeros(len(self.timestamps), dtype=bool)
+        matrices[rows[rows >= 0]] = parsed[rows >= 0]
+        valid[rows[rows >= 0]] = True
+        statuses = self.frame_field(f"{name}TransformStatus")
+        if statuses:
+            rows = self.timestamp_rows(f"{name}TransformStatus")
+            invalid = (np.array(statuses) != "OK") & (rows >= 0)
+            valid[rows[invalid]] = False
+        return matrices, valid
+
+    def tip_trajectory(self, name, tip_offset=(0.0, 0.0, 0.0)):
+        """
+        Position of a tool tip over time. tip_offset is the tip position in
+        the coordinate system of the tracked tool (e.g. from a pivot
+        calibration). Frames without valid tracking are NaN.
+
+        :return: (F,) timestamps and (F, 3) tip positions
+        """
+        matrices, valid = self.transforms(name)
+        tip = np.append(np.asarray(tip_offset, dtype=float), 1.0)
+        positions = (matrices @ tip)[:, :3]
+        positions[~valid] = np.nan
+        return self.timestamps, positions
+
+    def _data_location(self):
+        data_file = self.fields["ElementDataFile"]
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        if data_file == "LOCAL":
+            return self.path, self.header_end
+        if data_file.startswith("LIST") or "%" in data_file:
+            raise Exception(f"Multi-file sequences are not supported ({self.path})")
+        data_path = self.path.parent / data_file
+        header_size = int(self.fields.get("HeaderSize", 0))
+        if header_size == -1:
+            # data is stored at the end of the file
+            return data_path, data_path.stat().st_size - nbytes
+        return data_path, header_size
+
+    @property
+    def frames(self) -> np.memmap:
+        if self._frames is None:
+            if self.fields.get("CompressedData", "False").lower() == "true":
+                raise Exception(f"Compressed data in {self.path} cannot be memory-mapped")
+            data_path, offset = self._data_location()
+            self._frames = np.memmap(
+                data_path, dtype=self.dtype, mode="r", offset=offset, shape=self.shape
+            )
+        return self._frames
+
+    def _check_timestamps(self):
+        if np.any(np.diff(self.timestamps) < 0):
+            raise Exception(f"Timestamps in {self.path} are not monotonic")
+
+    def frame_index(self, t, tolerance=None):
+        """
+        Index of the frame closest in time to t (scalar or array), -1 for
+        times more than tolerance [s] outside the sequence (if given).
+        """
+        self._check_timestamps()
+        return nearest_frames(self.timestamps, t, tolerance)
+
+    def frame_range(self, t_start, t_end):
+        """
+        Slice of all frames with t_start <= timestamp <= t_end.
+        """
+        self._check_timestamps()
+        start = int(np.searchsorted(self.timestamps, t_start, side="left"))
+        stop = int(np.searchsorted(self.timestamps, t_end, side="right"))
+        return slice(start, stop)
+
+    def frames_between(self, t_start, t_end):
+        """
+        View of all frames recorded in [t_start, t_end], without reading any
+        other part of the file.
+        """
+        return self.frames[self.frame_range(t_start, t_end)]
+
+    def frame_at(self, t):
+        return self.frames[int(self.frame_index(t))]
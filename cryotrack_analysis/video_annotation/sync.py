@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+from pathlib import Path
+from typing import Optional, Tuple
+
+import click
+import numpy as np
+import pandas as pd
+
+from .extract_bookmarks import (
+    SYNC_EVENT,
+    is_sync_event,
+    parse_bookmark_times,
+    playlist_bookmarks,
+    record_to_dict,
+)
+from .mha_sequence import MhaSequence
+
+# Phases between consecutive P (planning), S (insertion start) and E
+# (insertion end) bookmarks
+PHASES = {"planning": ("P", "S"), "insertion": ("S", "E")}
+
+
+def bookmark_events(filename) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    All P/S/E bookmark events of a playlist, in playlist order, and its sync
+    events, both with their video time t [ms].
+    """
+    events, syncs = [], []
+    for bookmarks in playlist_bookmarks(filename):
+        for name, t in parse_bookmark_times(bookmarks):
+            if is_sync_event(name):
+                syncs.append(dict(name=name, recording=name[len(SYNC_EVENT) + 1 :] or None, t=t))
+            else:
+                events.append(record_to_dict((name, t)))
+    return pd.DataFrame(events), pd.DataFrame(syncs, columns=["name", "recording", "t"])
+
+
+def clock_offset(video_times, tracker_times) -> float:
+    """
+    Offset [s] of the tracker clock against the video time, such that
+    tracker time = video time [ms] / 1000 + offset, from one or more anchor
+    pairs (the median over all pairs).
+    """
+    video_times = np.atleast_1d(np.asarray(video_times, dtype=float))
+    tracker_times = np.atleast_1d(np.asarray(tracker_times, dtype=float))
+    if len(video_times) == 0 or len(video_times) != len(tracker_times):
+        raise Exception("Clock offset needs at least one pair of video and tracker times")
+    return float(np.median(tracker_times - video_times / 1000))
+
+
+def recording_offset(syncs: pd.DataFrame, sequence: MhaSequence, anchor=None) -> float:
+    """
+    Clock offset of one MHA recording. Either from an explicit anchor
+    (video time [ms], tracker time [s]), or from the sync event of the
+    recording ("SYNC_<recording stem>", or a single plain "SYNC"), which marks
+    the video time of its first tracked frame.
+    """
+    if anchor is not None:
+        return clock_offset(*anchor)
+    stem = sequence.path.stem
+    sync = syncs[syncs["recording"] == stem]
+    if len(sync) == 0:
+        sync = syncs[syncs["recording"].isna()]
+    if len(sync) != 1:
+        raise Exception(
+            f"Expected one {SYNC_EVENT} or {SYNC_EVENT}_{stem} bookmark for {sequence.path}, "
+            f"found {len(sync)}; pass an anchor instead"
+        )
+    return clock_offset(sync["t"].to_numpy(), sequence.timestamps[:1])
+
+
+def map_events(events: pd.DataFrame, sequence: MhaSequence, offset, tolerance=1.0) -> pd.DataFrame:
+    """
+    events with their time on the tracker clock and the index of the nearest
+    tracked frame (-1 outside the recording).
+    """
+    events = events.copy()
+    events["tracker time [s]"] = events["t"].to_numpy(dtype=float) / 1000 + offset
+    events["frame"] = sequence.frame_index(events["tracker time [s]"].to_numpy(), tolerance)
+    return events
+
+
+def phase_intervals(events: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per insertion and phase with the half-open frame interval
+    [start_frame, stop_frame), e.g. positions[start_frame:stop_frame] of a
+    tip trajectory. Like extract_bookmarks.group_insertions, every E event
+    closes an insertion with the preceding P and S events; the preceding
+    events of all E events are found with one np.searchsorted per phase.
+    Phases with an event outside the recording are left out.
+    """
+    position = np.arange(len(events))
+    phase = events["phase"].to_numpy()
+    frame = events["frame"].to_numpy()
+    tracker_time = events["tracker time [s]"].to_numpy()
+    closing = position[phase == "E"]
+    latest = {"E": closing}
+    for p in ("P", "S"):
+        candidates = position[phase == p]
+        i = np.searchsorted(candidates, closing) - 1
+        latest[p] = np.where(i >= 0, candidates[np.maximum(i, 0)], -1)
+
+    dfs = []
+    key = events.iloc[closing][["name", "target", "Operator", "Plane", "attempt"]].reset_index(drop=True)
+    key["name"] = key["name"].str[2:]
+    for name, (first, last) in PHASES.items():
+        start, stop = latest[first], latest[last]
+        valid = (start >= 0) & (start < stop)
+        valid[valid] &= (frame[start[valid]] >= 0) & (frame[stop[valid]] >= 0)
+        df = key[valid].copy()
+        df["phase"] = name
+        df["start_frame"] = frame[start[valid]]
+        # the insertion includes the frame of its E event
+        df["stop_frame"] = frame[stop[valid]] + (1 if last == "E" else 0)
+        df["start [s]"] = tracker_time[start[valid]]
+        df["end [s]"] = tracker_time[stop[valid]]
+        dfs.append(df)
+    df = pd.concat(dfs)
+    return df.sort_values(["start_frame", "phase"], kind="stable").reset_index(drop=True)
+
+
+def synchronize(
+    playlist,
+    sequence_path,
+    anchor: Optional[Tuple[float, float]] = None,
+    tolerance=1.0,
+    exclude_invalid=True,
+) -> pd.DataFrame:
+    """
+    Frame-indexed planning and insertion intervals of all bookmarked
+    insertions of a video within one MHA recording.
+
+    :param playlist: *.xspf file with P/S/E bookmarks and sync events
+    :param sequence_path: *.mha recording on the tracker clock
+    :param anchor: (video time [ms], tracker time [s]) of any one moment,
+                   instead of a sync event
+    :param tolerance: events up to this many seconds outside the recording
+                      are mapped to its first or last frame
+    """
+    events, syncs = bookmark_events(playlist)
+    sequence = MhaSequence(sequence_path)
+    offset = recording_offset(syncs, sequence, anchor)
+    print(f"{Path(sequence_path).name}: tracker time = video time + {offset:.3f} s")
+    intervals = phase_intervals(map_events(events, sequence, offset, tolerance))
+    if exclude_invalid:
+        intervals = intervals[~intervals["name"].str.contains("invalid")].reset_index(drop=True)
+    intervals.insert(0, "recording", Path(sequence_path).stem)
+    return intervals
+
+
+@click.command()
+@click.argument("playlist", type=click.Path(exists=True, dir_okay=False))
+@click.argument("sequences", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--anchor", nargs=2, type=float, default=None, help="Video time [ms] and tracker time [s] of one moment.")
+@click.option("--output", type=click.Path(dir_okay=False), default=None, help="Write the intervals to this *.xlsx file.")
+def main(playlist, sequences, anchor, output):
+    """Tie the P/S/E bookmarks of a video to the frames of MHA recordings."""
+    df = pd.concat([synchronize(playlist, sequence, anchor) for sequence in sequences], ignore_index=True)
+    if output:
+        df.to_excel(output)
+    print(df.to_string())
+
+
+if __name__ == "__main__":
+    main()
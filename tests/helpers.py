@@ -0,0 +1,38 @@
+import numpy as np
+
+
+def sphere(center, radius, resolution=24):
+    # imported here, so that tests without vtk can use the other helpers
+    import vtk
+
+    source = vtk.vtkSphereSource()
+    source.SetCenter(*center)
+    source.SetRadius(radius)
+    source.SetThetaResolution(resolution)
+    source.SetPhiResolution(resolution)
+    source.Update()
+    return source.GetOutput()
+
+
+def write_sequence(path, frames, timestamps, transforms=None, statuses=None):
+    n, rows, columns = frames.shape
+    header = [
+        "ObjectType = Image",
+        "NDims = 3",
+        "BinaryData = True",
+        "BinaryDataByteOrderMSB = False",
+        "CompressedData = False",
+        f"DimSize = {columns} {rows} {n}",
+        "ElementType = MET_UCHAR",
+    ]
+    for i, t in enumerate(timestamps):
+        header.append(f"Seq_Frame{i:04d}_Timestamp = {t}")
+        header.append(f"Seq_Frame{i:04d}_ImageStatus = OK")
+        if transforms is not None:
+            matrix = " ".join(str(v) for v in transforms[i].ravel())
+            header.append(f"Seq_Frame{i:04d}_NeedleToTrackerTransform = {matrix}")
+            header.append(f"Seq_Frame{i:04d}_NeedleToTrackerTransformStatus = {statuses[i]}")
+    header.append("ElementDataFile = LOCAL")
+    with open(path, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode())
+        f.write(frames.astype(np.uint8).tobytes())
@@ -0,0 +1,32 @@
+import pandas as pd
+import pytest
+
+from cryotrack_analysis.batch import combine_studies, run_batch
+
+
+def test_combine_studies_in_study_order():
+    results = {
+        "phantom-02": {"cryotrack": pd.DataFrame({"name": ["c"]})},
+        "phantom-01": {
+            "cryotrack": pd.DataFrame({"name": ["a", "b"]}),
+            "ctbaseline": pd.DataFrame({"name": ["d"]}),
+        },
+    }
+    combined = combine_studies(results)
+
+    assert list(combined) == ["ctbaseline", "cryotrack"]
+    assert combined["cryotrack"].columns.tolist() == ["study", "name"]
+    assert combined["cryotrack"]["study"].tolist() == ["phantom-02", "phantom-01", "phantom-01"]
+    assert combined["cryotrack"]["name"].tolist() == ["c", "a", "b"]
+    assert combined["ctbaseline"]["study"].tolist() == ["phantom-01"]
+    # the per-study tables are left unchanged
+    assert "study" not in results["phantom-01"]["cryotrack"]
+
+
+def test_run_batch_rejects_duplicate_study_names(tmp_path):
+    paths = [tmp_path / "a" / "phantom-01", tmp_path / "b" / "phantom-01"]
+    for path in paths:
+        path.mkdir(parents=True)
+    with pytest.raises(Exception, match="phantom-01"):
+        run_batch(paths, tmp_path / "spreadsheets", jobs=1)
+    assert not (tmp_path / "spreadsheets").exists()
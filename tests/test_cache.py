@@ -0,0 +1,37 @@
+import os
+
+import pandas as pd
+
+from cryotrack_analysis.cache import RowCache, cache_key, memoized_rows
+
+
+def test_memoized_rows_only_evaluates_misses(tmp_path):
+    cache = RowCache(tmp_path)
+    evaluated = []
+
+    def evaluate(items):
+        evaluated.extend(items)
+        return pd.DataFrame({"item": items, "square": [i * i for i in items]})
+
+    keys = [cache_key("item", i) for i in range(4)]
+    first = memoized_rows([0, 1, 2, 3], keys, evaluate, cache)
+    second = memoized_rows([0, 1, 2, 3, 4], keys + [cache_key("item", 4)], evaluate, cache)
+
+    assert evaluated == [0, 1, 2, 3, 4]
+    assert cache.stats() == dict(hits=4, misses=5, evictions=0)
+    pd.testing.assert_frame_equal(first, second.iloc[:4])
+    assert second["square"].tolist() == [0, 1, 4, 9, 16]
+
+
+def test_least_recently_used_rows_are_evicted(tmp_path):
+    cache = RowCache(tmp_path)
+    for i in range(3):
+        cache.put(str(i), dict(value=i))
+        os.utime(tmp_path / f"{i}.pkl", ns=(i, i))
+    cache.get("0")  # refreshes row 0
+    cache.max_bytes = 2 * (tmp_path / "0.pkl").stat().st_size
+    cache.evict()
+
+    assert cache.evictions == 1
+    assert cache.get("1") is None
+    assert cache.get("0") == dict(value=0) and cache.get("2") == dict(value=2)
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+vtk = pytest.importorskip("vtk")
+
+from cryotrack_analysis.coverage import Iceball, iceball_coverage, probe_combinations
+from tests.helpers import sphere
+
+
+def test_iceball_coverage():
+    tumors = {0: sphere((0, 0, 0), 5), 1: sphere((60, 0, 0), 5)}
+    risks = {"Portal": sphere((0, 0, -25), 10), "Hepatic": vtk.vtkPolyData()}
+    iceball = Iceball(length=40, diameter=20, distal=10)
+    # needles along -z: centred on tumor 0, missing it laterally, centred on tumor 1
+    entries = [(0, 0, 50), (20, 0, 50), (60, 0, 50)]
+    tips = [(0, 0, -10), (20, 0, -10), (60, 0, -10)]
+    df = iceball_coverage(entries, tips, [0, 0, 1], tumors, risks, iceball, spacing=0.5)
+    assert df["Tumor coverage"].tolist() == pytest.approx([1.0, 0.0, 1.0])
+    assert df["Iceball volume [ml]"].to_numpy() == pytest.approx(iceball.volume() / 1000, rel=0.02)
+    assert "Ice in Hepatic [ml]" not in df.columns
+    # the ice ball of the first needle reaches 5 mm into the portal sphere
+    assert 0 < df["Ice in Portal [ml]"][0] < np.pi * 5**2 * (3 * 10 - 5) / 3 / 1000
+    assert df["Ice in Portal [ml]"][2] == 0
+
+    sets = probe_combinations([0, 0, 1], 2)
+    assert sets == [(0, 1)]
+    union = iceball_coverage(entries, tips, [0, 0, 1], tumors, risks, iceball, 0.5, sets)
+    assert union["Tumor coverage"][0] == pytest.approx(1.0)
+    assert union["Iceball volume [ml]"][0] > df["Iceball volume [ml]"][0]
+    with pytest.raises(Exception):
+        iceball_coverage(entries, tips, [0, 0, 1], tumors, risks, iceball, 0.5, [(0, 2)])
+
+    # no target has three insertions
+    empty = iceball_coverage(entries, tips, [0, 0, 1], tumors, risks, iceball, 0.5, probe_combinations([0, 0, 1], 3))
+    assert empty.empty
+    assert empty.columns.tolist() == df.columns.tolist()
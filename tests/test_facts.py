@@ -0,0 +1,58 @@
+import pandas as pd
+
+from cryotrack_analysis.facts import fact_table
+
+
+def test_fact_table_joins_timing_and_accuracy_on_normalised_keys():
+    cryotrack = pd.DataFrame(
+        {
+            "name": ["t1-cryo-HK-oop", "t1-cryo-HK-ip", "t1-cryo-HK-oop"],
+            "target": ["t1", "t1", "t1"],
+            "Operator": ["HK", "HK", "HK"],
+            "Plane": ["op", "ip", "op"],
+            "Lateral Error (final)": [1.0, 2.0, 3.0],
+        }
+    )
+    cryotrack_time = pd.DataFrame(
+        {
+            "name": ["t1_HK_oop", "t1_HK_oop_002"],
+            "target": ["t1", "t1"],
+            "Operator": ["HK", "HK"],
+            "Plane": ["oop", "oop"],
+            "attempt": [1, 2],
+            "total time [s]": [60.0, 90.0],
+        }
+    )
+    ctbaseline = pd.DataFrame(
+        {
+            "name": ["19 T1-OP-sw-2", "3 T1-OP-sw-1"],
+            "target": ["t1", "t1"],
+            "Plane": ["op", "op"],
+            "Strokes": ["sw", "sw"],
+            "Operator": ["JV", "JV"],
+            "Lateral Error": [4.0, 5.0],
+        }
+    )
+    ctbaseline_time = pd.DataFrame(
+        {
+            "name": ["t1-OoP-sw-2", "t1-OoP-sw"],
+            "target": ["t1", "t1"],
+            "Plane": ["OoP", "OoP"],
+            "Strokes": ["sw", "sw"],
+            "operator": ["JV", "JV"],
+            "start_timestamp": [200.0, 100.0],
+            "duration": [30.0, 20.0],
+        }
+    )
+
+    facts = fact_table(cryotrack_time, ctbaseline_time, ctbaseline, cryotrack)
+
+    assert facts.index.names == ["Cryotrack", "target", "Operator", "Plane", "Strokes", "attempt"]
+    second = facts.loc[("with", "t1", "HK", "op", "ss", 2)]
+    assert second["Lateral Error"] == 3.0 and second["time [s]"] == 90.0
+    assert second["attempt (source)"] == 2
+    assert pd.isna(facts.loc[("with", "t1", "HK", "ip", "ss", 1), "time [s]"])
+    # chronological order: insertion 3 before 19, earlier start timestamp first
+    first = facts.loc[("without", "t1", "JV", "op", "sw", 1)]
+    assert first["name"] == "3 T1-OP-sw-1" and first["name (time)"] == "t1-OoP-sw"
+    assert first["Lateral Error"] == 5.0 and first["time [s]"] == 20.0
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+vtk = pytest.importorskip("vtk")
+
+from cryotrack_analysis.geometry import LodRiskIndex, RiskIndex, SurfaceIndex, classify_points
+from tests.helpers import sphere
+
+
+def test_risk_index_matches_per_structure_distances():
+    models = {
+        "Airway": sphere((0, 0, 0), 10),
+        "Portal": sphere((40, 0, 0), 5),
+        "Hepatic": vtk.vtkPolyData(),  # missing mesh
+    }
+    index = RiskIndex(models)
+    points = np.random.default_rng(0).uniform(-20, 60, (200, 3))
+    distances, names, _ = index.query_points(points)
+    for point, distance, name in zip(points, distances, names):
+        per_structure = {n: index.distance_to(point, n) for n in ("Airway", "Portal")}
+        assert name == min(per_structure, key=per_structure.get)
+        assert distance == pytest.approx(per_structure[name])
+    assert np.isnan(index.distance_to(points[0], "Hepatic"))
+
+
+def test_risk_distance_inside_a_structure_is_the_minimum_signed_one():
+    # 3 mm inside the airway, 2 mm outside the (closer) portal surface
+    models = {"Airway": sphere((0, 0, 0), 10, 64), "Portal": sphere((14, 0, 0), 5, 64)}
+    point = np.array([(7.0, 0.0, 0.0)])
+    for index in (RiskIndex(models), LodRiskIndex(models), LodRiskIndex(models, threshold=1.0)):
+        distances, names, exact = index.risk_distances(point)
+        assert names == ["Airway"] and exact.all()
+        assert distances[0] == pytest.approx(-3, abs=0.1)
+
+
+def test_classify_points_against_tumors():
+    tumors = {0: SurfaceIndex(sphere((0, 0, 0), 10)), 1: SurfaceIndex(sphere((50, 0, 0), 5))}
+    points = [(0, 0, 2), (0, 0, 20), (50, 0, 1), (0, 0, 2)]
+    distances, inside = classify_points(points, [0, 0, 1, 1], tumors)
+    assert inside.tolist() == [True, False, True, False]
+    assert distances[0] < 0 and distances[2] < 0
+    assert distances[1] == pytest.approx(10, abs=0.1)
+    assert distances[3] == pytest.approx(np.linalg.norm((50, 0, -2)) - 5, abs=0.1)
+
+
+def test_lod_risk_index_is_exact_where_it_matters():
+    models = {"Airway": sphere((0, 0, 0), 10, 64), "Portal": sphere((40, 0, 0), 5, 64)}
+    exact = RiskIndex(models)
+    points = np.random.default_rng(1).uniform(-20, 60, (300, 3))
+    expected, expected_names, _ = exact.query_points(points)
+
+    lod = LodRiskIndex(models)
+    distances, names, is_exact = lod.query_points(points)
+    assert is_exact.all() and names == expected_names
+    np.testing.assert_allclose(distances, expected, atol=1e-9)
+    assert lod.refined < lod.queried
+
+    lod = LodRiskIndex(models, threshold=5.0)
+    distances, names, is_exact = lod.query_points(points)
+    near = np.abs(expected) <= 5.0
+    assert is_exact[near].all()
+    np.testing.assert_allclose(distances[is_exact], expected[is_exact], atol=1e-9)
+    assert (np.abs(np.abs(distances) - np.abs(expected))[~is_exact] <= max(lod.bounds.values())).all()
+    assert (lod.risk_distances(points)[2] == is_exact).all()
+    assert exact.risk_distances(points)[2].all()
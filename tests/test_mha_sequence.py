@@ -0,0 +1,80 @@
+import numpy as np
+
+from cryotrack_analysis.video_annotation.mha_sequence import HEADER_BLOCK_SIZE, MhaSequence
+from tests.helpers import write_sequence
+
+
+def test_memory_mapped_frames_by_time(tmp_path):
+    frames = np.arange(6 * 4 * 5).reshape(6, 4, 5) % 256
+    timestamps = [10.0, 10.5, 11.0, 11.5, 12.0, 12.5]
+    write_sequence(tmp_path / "seq.mha", frames, timestamps)
+
+    sequence = MhaSequence(tmp_path / "seq.mha")
+    assert sequence.shape == (6, 4, 5)
+    assert isinstance(sequence.frames, np.memmap)
+    np.testing.assert_array_equal(sequence.timestamps, timestamps)
+    np.testing.assert_array_equal(sequence.frames_between(10.9, 12.0), frames[2:5])
+    np.testing.assert_array_equal(sequence.frame_at(11.6), frames[3])
+    np.testing.assert_array_equal(sequence.frame_index([9.0, 10.7, 13.0]), [0, 1, 5])
+
+
+def test_tip_trajectory(tmp_path):
+    transforms = np.tile(np.eye(4), (3, 1, 1))
+    transforms[:, :3, 3] = [[0, 0, 0], [1, 2, 3], [4, 5, 6]]
+    transforms[2, :3, :3] = [[0, -1, 0], [1, 0, 0], [0, 0, 1]]
+    write_sequence(
+        tmp_path / "seq.mha", np.zeros((3, 2, 2)), [0.0, 0.1, 0.2],
+        transforms, ["OK", "INVALID", "OK"],
+    )
+
+    sequence = MhaSequence(tmp_path / "seq.mha")
+    assert sequence.transform_names() == ["NeedleToTracker"]
+    timestamps, positions = sequence.tip_trajectory("NeedleToTracker", tip_offset=(1, 0, 0))
+    np.testing.assert_array_equal(timestamps, [0.0, 0.1, 0.2])
+    np.testing.assert_array_equal(positions[0], [1, 0, 0])
+    assert np.isnan(positions[1]).all()
+    np.testing.assert_array_equal(positions[2], [4, 6, 6])
+
+
+def test_header_entry_across_block_boundary(tmp_path):
+    frames = np.arange(2 * 3 * 4).reshape(2, 3, 4)
+    header = (
+        "ObjectType = Image\nNDims = 3\nBinaryData = True\nCompressedData = False\n"
+        "DimSize = 4 3 2\nElementType = MET_UCHAR\n"
+        "Seq_Frame0000_Timestamp = 1.0\nSeq_Frame0001_Timestamp = 2.0\n"
+    )
+    # ElementDataFile starts 20 bytes before the end of the first block, its
+    # newline is in the second one
+    padding = "Comment = " + "x" * (HEADER_BLOCK_SIZE - 20 - len(header) - len("Comment = \n")) + "\n"
+    header = header + padding + "ElementDataFile = LOCAL\n"
+    assert header.index("ElementDataFile") == HEADER_BLOCK_SIZE - 20
+    with open(tmp_path / "seq.mha", "wb") as f:
+        f.write(header.encode())
+        f.write(frames.astype(np.uint8).tobytes())
+
+    sequence = MhaSequence(tmp_path / "seq.mha")
+    assert sequence.header_end == len(header)
+    np.testing.assert_array_equal(sequence.timestamps, [1.0, 2.0])
+    np.testing.assert_array_equal(sequence.frames, frames)
+
+
+def test_tip_trajectory_aligned_by_frame_number(tmp_path):
+    # frame 1 has no transform, frame 3 no status
+    header = ["ObjectType = Image", "NDims = 3", "DimSize = 1 1 4", "ElementType = MET_UCHAR"]
+    for i in range(4):
+        header.append(f"Seq_Frame{i:04d}_Timestamp = {i / 10}")
+        if i != 1:
+            matrix = np.eye(4)
+            matrix[:3, 3] = i
+            header.append(f"Seq_Frame{i:04d}_NeedleToTrackerTransform = {' '.join(map(str, matrix.ravel()))}")
+        if i < 3:
+            header.append(f"Seq_Frame{i:04d}_NeedleToTrackerTransformStatus = {'INVALID' if i == 2 else 'OK'}")
+    header.append("ElementDataFile = LOCAL")
+    with open(tmp_path / "seq.mha", "wb") as f:
+        f.write(("\n".join(header) + "\n").encode() + bytes(4))
+
+    sequence = MhaSequence(tmp_path / "seq.mha")
+    timestamps, positions = sequence.tip_trajectory("NeedleToTracker")
+    assert positions.shape == (len(timestamps), 3) == (4, 3)
+    np.testing.assert_array_equal(positions[[0, 3]], [[0, 0, 0], [3, 3, 3]])
+    assert np.isnan(positions[[1, 2]]).all()
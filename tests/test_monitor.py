@@ -0,0 +1,33 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+vtk = pytest.importorskip("vtk")
+
+from cryotrack_analysis.monitor import TipMonitor, replay_sequence, run_monitor
+
+from tests.helpers import sphere, write_sequence
+
+
+def test_replay_monitor(tmp_path):
+    transforms = np.tile(np.eye(4), (3, 1, 1))
+    transforms[:, :3, 3] = [[0, 0, 20], [0, 0, 0], [0, 0, 30]]
+    write_sequence(
+        tmp_path / "seq.mha", np.zeros((3, 2, 2)), [0.0, 0.01, 0.02],
+        transforms, ["OK", "INVALID", "OK"],
+    )
+    monitor = TipMonitor(
+        sphere((0, 0, 0), 10), {"Airway": sphere((0, 0, 50), 5), "Portal": sphere((0, 0, -40), 5)}
+    )
+    results = []
+    stats = asyncio.run(
+        run_monitor(replay_sequence(tmp_path / "seq.mha", "NeedleToTracker", speed=None), monitor, results.append)
+    )
+
+    assert [r["Nearest risk"] for r in results] == ["Airway", None, "Airway"]
+    assert results[0]["Tumor"] == pytest.approx(10, abs=0.1)
+    assert results[0]["Portal"] == pytest.approx(55, abs=0.1)
+    assert results[2]["D_risk_min"] == pytest.approx(15, abs=0.1)
+    assert np.isnan(results[1]["Tumor"]) and np.isnan(results[1]["D_risk_min"])
+    assert stats["samples"] == 3 and stats["p99"] < 50
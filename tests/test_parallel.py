@@ -0,0 +1,37 @@
+import os
+
+import pandas as pd
+
+from cryotrack_analysis.parallel import ParallelEvaluator, split
+
+
+class Squares:
+    def __init__(self):
+        self.pid = None
+
+    def __call__(self, items):
+        # set once per worker process, like the indexes of LazyEvaluator
+        if self.pid is None:
+            self.pid = os.getpid()
+        return pd.DataFrame([dict(item=i, square=float(i) ** 2, pid=self.pid) for i in items])
+
+    def key(self, item):
+        return str(item)
+
+
+def test_split():
+    chunks = split(list(range(10)), 4)
+    assert [len(c) for c in chunks] == [3, 3, 2, 2]
+    assert sum(chunks, []) == list(range(10))
+    assert split([1, 2], 8) == [[1], [2]]
+
+
+def test_parallel_evaluator():
+    items = list(range(37))
+    serial = Squares()(items).drop(columns="pid")
+    with ParallelEvaluator(Squares(), jobs=2) as evaluate:
+        assert evaluate.key(3) == "3"
+        result = evaluate(items)
+    assert result["pid"].nunique() <= 2
+    assert (result["pid"] != os.getpid()).all()
+    pd.testing.assert_frame_equal(result.drop(columns="pid"), serial)
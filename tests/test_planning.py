@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+vtk = pytest.importorskip("vtk")
+
+from cryotrack_analysis.geometry import SurfaceIndex
+from cryotrack_analysis.planning import (
+    ClearanceField,
+    candidate_directions,
+    relative_clearances,
+    safest_trajectory,
+    segment_clearances,
+)
+from tests.helpers import sphere
+
+
+def test_segment_clearances_match_dense_sampling():
+    models = {"Portal": sphere((25, 0, 0), 10), "Airway": sphere((-25, 0, 0), 10)}
+    field = ClearanceField(models, max_clearance=30)
+    rng = np.random.default_rng(0)
+    starts = rng.uniform(-10, 10, (40, 3))
+    ends = starts + rng.normal(size=(40, 3)) * 30
+    clearances, _, exact = segment_clearances(field, starts, ends, tolerance=0.1)
+    assert exact.all()
+
+    surfaces = [SurfaceIndex(m) for m in models.values()]
+    t = np.linspace(0, 1, 2001)
+    for start, end, clearance in zip(starts, ends, clearances):
+        points = start + (end - start) * t[:, None]
+        dense = min(min(s.signed_distances(points).min() for s in surfaces), 30)
+        assert clearance == pytest.approx(dense, abs=0.1)
+
+
+def test_safest_trajectory_avoids_both_structures():
+    models = {"Portal": sphere((25, 0, 0), 10), "Airway": sphere((-25, 0, 0), 10), "Hepatic": vtk.vtkPolyData()}
+    field = ClearanceField(models, max_clearance=30)
+    directions = candidate_directions(2048, axis=(1, 0, 0), cone_angle=90)
+    best = safest_trajectory(field, (0, 0, 0), directions, depth=60)
+    # the target itself is 15 mm from both spheres, any sideways path keeps that
+    assert best["Clearance (optimal)"] == pytest.approx(15, abs=0.3)
+    assert abs(best["Direction (optimal)"][0]) < 0.5
+    # pruning skips most of the refinement of an exhaustive search
+    field.queries = 0
+    segment_clearances(field, np.zeros((len(directions), 3)), directions * 60)
+    assert best["Distance queries"] < field.queries / 2
+
+    df = relative_clearances(field, [(60, 0, 0), (0, 60, 0)], [(0, 0, 0), (0, 0, 0)], [15, 15])
+    assert df["Clearance"][0] < 0
+    assert df["Nearest risk"][0] == "Portal"
+    assert df["Clearance ratio"][1] == pytest.approx(1, abs=0.02)
@@ -0,0 +1,98 @@
+import json
+
+import numpy as np
+import pytest
+
+from cryotrack_analysis.registration import (
+    LandmarkRegistration,
+    apply_transform,
+    leave_one_out_tre,
+    register_points,
+)
+from tests.helpers import sphere
+
+
+def random_transform(rng, scale=1.0):
+    q, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    if np.linalg.det(q) < 0:
+        q[:, 0] = -q[:, 0]
+    matrix = np.eye(4)
+    matrix[:3, :3] = scale * q
+    matrix[:3, 3] = rng.normal(scale=100, size=3)
+    return matrix
+
+
+def test_recovers_rigid_and_similarity_transforms():
+    rng = np.random.default_rng(0)
+    source = rng.normal(scale=50, size=(8, 3))
+    rigid = random_transform(rng)
+    np.testing.assert_allclose(register_points(source, apply_transform(rigid, source)), rigid, atol=1e-9)
+    similarity = random_transform(rng, scale=1.2)
+    np.testing.assert_allclose(
+        register_points(source, apply_transform(similarity, source), similarity=True), similarity, atol=1e-9
+    )
+    # the scale is reported separately from the rigid part
+    registration = LandmarkRegistration(source, apply_transform(similarity, source), similarity=True)
+    assert registration.scale == pytest.approx(1.2)
+    np.testing.assert_allclose(registration.rigid_matrix, register_points(source, apply_transform(similarity, source)))
+
+
+def test_fre_and_batched_leave_one_out_tre():
+    rng = np.random.default_rng(1)
+    source = rng.normal(scale=50, size=(7, 3))
+    target = apply_transform(random_transform(rng), source) + rng.normal(size=(7, 3))
+
+    registration = LandmarkRegistration(source, target)
+    assert np.isclose(registration.fre, np.sqrt(np.mean(registration.residuals**2)))
+
+    expected = []
+    for i in range(len(source)):
+        keep = np.arange(len(source)) != i
+        matrix = register_points(source[keep], target[keep])
+        expected.append(np.linalg.norm(apply_transform(matrix, source[i]) - target[i]))
+    np.testing.assert_allclose(leave_one_out_tre(source, target), expected)
+
+
+def write_markups(path, positions):
+    control_points = [{"id": str(i), "position": np.ravel(p).tolist()} for i, p in positions.items()]
+    path.write_text(json.dumps({"markups": [{"controlPoints": control_points}]}))
+
+
+def test_registration_maps_measured_points_to_the_planning_frame(tmp_path):
+    vtk = pytest.importorskip("vtk")
+    from cryotrack_analysis.insertion_analysis.cryotrack_validation.analyze_cryotrack import (
+        FIDUCIAL_PAIRS,
+        run_cryotrack_analysis,
+    )
+
+    # planning frame: target 1 in a tumor of radius 10 at the origin, an airway at 40 mm
+    study = tmp_path / "cryotrack_validation"
+    (study / "markups").mkdir(parents=True)
+    (study / "models").mkdir()
+    for name, center, radius in (("tumor-1", (0, 0, 0), 10), ("airway", (40, 0, 0), 5)):
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetInputData(sphere(center, radius))
+        writer.SetFileName(str(study / "models" / f"{name}.vtk"))
+        writer.Write()
+    (study / "acquisitions.txt").write_text("1 t1-cryo-HK-ip\n")
+    write_markups(study / "markups" / "target.mrk.json", {1: (0, 0, 0)})
+
+    # the tip and entry point are measured in an intraoperative frame
+    to_intraoperative = random_transform(np.random.default_rng(2))
+    fiducials = np.random.default_rng(3).normal(scale=50, size=(len(FIDUCIAL_PAIRS), 3))
+    write_markups(study / "markups" / "From.mrk.json", dict(zip(FIDUCIAL_PAIRS, fiducials)))
+    write_markups(
+        study / "markups" / "To.mrk.json",
+        dict(zip(FIDUCIAL_PAIRS.values(), apply_transform(to_intraoperative, fiducials))),
+    )
+    write_markups(study / "markups" / "tip.mrk.json", {1: apply_transform(to_intraoperative, (2, 0, 0))})
+    write_markups(study / "markups" / "entry-point.mrk.json", {1: apply_transform(to_intraoperative, (2, 0, 50))})
+
+    unregistered = run_cryotrack_analysis(tmp_path).iloc[0]
+    assert unregistered["Euclidean Error (final)"] > 20 and not unregistered["Tip in tumor"]
+    for registration in ("rigid", "similarity"):
+        row = run_cryotrack_analysis(tmp_path, registration=registration).iloc[0]
+        assert row["Euclidean Error (final)"] == pytest.approx(2)
+        assert row["Lateral Error (final)"] == pytest.approx(2)
+        assert row["Tip in tumor"] and row["Signed (tip to tumor)"] == pytest.approx(-8, abs=0.2)
+        assert row["D_risk_min"] == pytest.approx(33, abs=0.2) and row["Nearest risk"] == "Airway"
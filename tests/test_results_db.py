@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from cryotrack_analysis.results_db import ResultsDB
+
+
+def study_tables(lateral_error):
+    cryotrack = pd.DataFrame(
+        {
+            "name": ["t1-cryo-HK-oop", "t1-cryo-HK-ip", "t2-cryo-AB-ip"],
+            "target": ["t1", "t1", "t2"],
+            "Operator": ["HK", "HK", "AB"],
+            "Plane": ["op", "ip", "ip"],
+            "Lateral Error (final)": lateral_error,
+            "Tip in tumor": [True, False, True],
+        }
+    )
+    ctbaseline = pd.DataFrame(
+        {
+            "name": ["19 T1-OP-sw-2", "3 T1-OP-sw-1"],
+            "target": ["t1", "t1"],
+            "Plane": ["op", "op"],
+            "Strokes": ["sw", "sw"],
+            "Operator": ["JV", "JV"],
+            "Lateral Error": [4.0, np.nan],
+        }
+    )
+    return {"cryotrack": cryotrack, "ctbaseline": ctbaseline}
+
+
+def test_runs_are_appended_and_queried_by_key(tmp_path):
+    data_path = tmp_path / "study"
+    (data_path / "CT_baseline").mkdir(parents=True)
+    (data_path / "CT_baseline" / "timestamps.json").write_text("{}")
+    (data_path / "CT_baseline" / "recording.mha").write_bytes(b"not an input")
+    summaries = pd.DataFrame({"Cryotrack": ["with"], "Operator": ["S"], "time [s]": [60.0]})
+
+    with ResultsDB(tmp_path / "results.sqlite") as db:
+        first = db.record_run("study", data_path, study_tables([1.0, 2.0, 3.0]), summaries=summaries)
+        tables = study_tables([5.0, 6.0, 7.0])
+        tables["cryotrack"]["Clearance"] = [10.0, 11.0, 12.0]
+        second = db.record_run("study", data_path, tables, options=dict(jobs=2))
+
+    with ResultsDB(tmp_path / "results.sqlite") as db:
+        runs = db.runs("study")
+        assert runs["run_id"].tolist() == [first, second]
+        assert runs["input_hash"].nunique() == 1
+        assert db.query("SELECT path FROM inputs WHERE run_id = ?", (first,))["path"].tolist() == [
+            "CT_baseline/timestamps.json"
+        ]
+
+        latest = db.insertions(operator="HK")
+        assert latest["run_id"].unique().tolist() == [second]
+        assert latest["Lateral Error"].tolist() == [6.0, 5.0]
+        assert latest["Clearance"].tolist() == [11.0, 10.0]
+
+        # every selection has the full schema, metrics a run lacks are NULL
+        old = db.insertions(run=first, plane=["op"], source="cryotrack")
+        assert old.columns.tolist() == latest.columns.tolist() == db.columns("insertions")
+        assert old["Lateral Error"].tolist() == [1.0] and old["Clearance"].isna().all()
+        assert db.insertions(run=first, source="cryotrack")["Strokes"].tolist() == ["ss"] * 3
+        # a flag only some tables have is still stored as a number
+        assert db.insertions(run=first, source="cryotrack")["Tip in tumor"].tolist() == [0, 1, 1]
+
+        baseline = db.insertions(run="all", strokes="sw").sort_values(["run_id", "attempt"])
+        assert baseline["name"].tolist() == ["3 T1-OP-sw-1", "19 T1-OP-sw-2"] * 2
+        assert baseline["Cryotrack"].unique().tolist() == ["without"]
+        assert baseline["Lateral Error"].isna().sum() == 2
+
+        assert db.summaries(run=first)["time [s]"].tolist() == [60.0]
+        assert db.summaries().empty
+        index_names = db.query("SELECT name FROM sqlite_master WHERE type = 'index'")["name"]
+        assert {"insertions_Operator", "insertions_target", "insertions_Plane", "insertions_Strokes"} <= set(index_names)
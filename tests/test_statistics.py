@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cryotrack_analysis.statistics import permutation_test
+
+
+def test_permutation_test_matches_loop():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "group": np.repeat(["a", "b", "c"], 6),
+            "x": rng.normal(size=18) + np.repeat([0, 1, 3], 6),
+            "y": rng.normal(size=18),
+        }
+    )
+    df.loc[3, "y"] = np.nan
+    result = permutation_test(df, "group", ["x", "y"], n_permutations=2000, jobs=1, shard_size=500)
+    with ThreadPoolExecutor(2) as executor:
+        shared = permutation_test(df, "group", ["x", "y"], n_permutations=2000, shard_size=500, executor=executor)
+    pd.testing.assert_frame_equal(shared, result)
+
+    # same permutations, evaluated one by one
+    seeds = np.random.SeedSequence(0).spawn(4)
+    codes = pd.Categorical(df["group"]).codes
+    for i, column in enumerate(["x", "y"]):
+        valid = df[column].notna().to_numpy()
+        values = df[column].to_numpy()
+
+        def ss(labels):
+            labels, v = labels[valid], values[valid]
+            return sum(
+                (labels == k).sum() * (v[labels == k].mean() - v.mean()) ** 2 for k in range(3)
+            )
+
+        observed = ss(codes)
+        exceedances = 0
+        for seed in seeds:
+            permuted = np.random.default_rng(seed).permuted(np.tile(codes, (500, 1)), axis=1)
+            exceedances += sum(ss(labels) >= observed - 1e-12 for labels in permuted)
+        assert np.isclose(result["observed"][i], observed)
+        assert np.isclose(result["p_value"][i], (1 + exceedances) / 2001)
+    assert result["p_value"][0] < 0.01
+    assert result["n"].tolist() == [18, 17]
+
+
+def test_two_groups_effect_size():
+    df = pd.DataFrame({"group": [0, 0, 0, 1, 1, 1], "x": [1.0, 2.0, 3.0, 3.0, 4.0, 5.0]})
+    result = permutation_test(df, "group", ["x"], n_permutations=100, jobs=1)
+    assert result["observed"][0] == 2.0
+    assert result["effect_size"][0] == 2.0
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from cryotrack_analysis.streaming import StreamingAggregate, chunked
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked(range(5), None)) == [[0, 1, 2, 3, 4]]
+
+
+def test_streaming_aggregate_matches_full_frame():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "Operator": rng.choice(["S", "N1", "N2"], 500),
+            "Plane": rng.choice(["ip", "op"], 500),
+            "D_risk_min": rng.gamma(2.0, 5.0, 500),
+        }
+    )
+    aggregate = StreamingAggregate(["Operator", "Plane"], ["D_risk_min"], bin_width=0.01)
+    for chunk in chunked(range(len(df)), 64):
+        aggregate.update(df.iloc[chunk])
+
+    grouped = df.groupby(["Operator", "Plane"])[["D_risk_min"]]
+    pd.testing.assert_frame_equal(aggregate.mean(), grouped.mean())
+    pd.testing.assert_frame_equal(aggregate.std(), grouped.std())
+    for key, sub in df.groupby(["Operator", "Plane"]):
+        for q in (0.0, 0.25, 0.5, 0.75, 1.0):
+            expected = np.quantile(sub["D_risk_min"], q)
+            assert abs(aggregate.quantile(key, "D_risk_min", q) - expected) <= 0.005
@@ -0,0 +1,40 @@
+import numpy as np
+
+from cryotrack_analysis.video_annotation.sync import clock_offset, synchronize
+from tests.helpers import write_sequence
+
+BOOKMARKS = (
+    "{name=P_t1_HK_ip,time=10,500},{name=SYNC,time=12,000},{name=S_t1_HK_ip,time=15,000},"
+    "{name=E_t1_HK_ip,time=20,000},{name=P_t2_HK_ip,time=21,000},{name=S_t2_HK_ip,time=23,000},"
+    "{name=E_t2_HK_ip,time=25,250},{name=P_t3_HK_ip,time=90,000},{name=S_t3_HK_ip,time=95,000},"
+    "{name=E_t3_HK_ip,time=99,000}"
+)
+
+
+def write_playlist(path, bookmarks):
+    path.write_text(
+        '<playlist xmlns="http://xspf.org/ns/0/" xmlns:vlc="http://www.videolan.org/vlc/playlist/ns/0/" version="1">'
+        '<trackList><track><extension application="http://www.videolan.org/vlc/playlist/0">'
+        f"<vlc:id>0</vlc:id><vlc:option>bookmarks={bookmarks}</vlc:option>"
+        "</extension></track></trackList></playlist>"
+    )
+
+
+def test_synchronize_bookmarks_with_recording(tmp_path):
+    write_playlist(tmp_path / "video.xspf", BOOKMARKS)
+    # 10 Hz recording starting at the SYNC bookmark (video 12 s), 20 s long
+    timestamps = 1000.0 + np.arange(200) / 10
+    write_sequence(tmp_path / "recording.mha", np.zeros((200, 1, 1)), timestamps)
+
+    df = synchronize(tmp_path / "video.xspf", tmp_path / "recording.mha")
+    # P of t1 is 1.5 s before the recording started, t3 is outside entirely
+    assert df["name"].tolist() == ["t1_HK_ip", "t2_HK_ip", "t2_HK_ip"]
+    assert df["phase"].tolist() == ["insertion", "planning", "insertion"]
+    assert df["start_frame"].tolist() == [30, 90, 110]
+    assert df["stop_frame"].tolist() == [81, 110, 133]
+    np.testing.assert_allclose(df["start [s]"], [1003.0, 1009.0, 1011.0])
+
+    # an anchor instead of the sync event: video 0 s is tracker 988 s
+    shifted = synchronize(tmp_path / "video.xspf", tmp_path / "recording.mha", anchor=(0, 988))
+    assert shifted.equals(df)
+    assert clock_offset([1000, 3000], [5, 7.2]) == 4.1